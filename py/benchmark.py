@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark harness for the :cpl toolchain.
+
+Generates synthetic modules, times every stage from parsing to running the
+virtual machine and writes the results as JSON. If a baseline file is given,
+the results are compared against it and regressions are reported.
+
+Run with `--help` for the available options.
+"""
+
+import sys, json, platform, traceback
+from optparse import OptionParser
+from timeit import default_timer as timer
+from array import array
+from datetime import datetime
+
+import cpl.compiler
+from cpl.compiler import BinaryOp, List, EmptyList, Integer, Variable
+from cpl.compiler_base import Instruction, TokenVisitor, TokenTransformer, countTokens
+from cpl.interpreter import VM
+from cpl.interpreter_base import Interpreter, ProgramStorage, Pointer, Heap, HeapObject, HeapObjAttr
+from cpl.kvo.interface import IKeyValueObserver, IRangeObserver, implements
+from cpl.profiler import Profiler
+from cpl.vector import applyKernel, fold
+
+#=============================================================================#
+#                            Program generators                               #
+#=============================================================================#
+
+def generateExpression(depth, var="X"):
+    """
+    Returns a nested arithmetic expression of the given depth using the
+    variable `var`.
+    """
+    expr = var
+    ops = ["+", "*", "-"]
+    for i in xrange(depth):
+        expr = "(%s %s %d)" % (expr, ops[i % len(ops)], i + 1)
+    return expr
+
+def generateList(size):
+    """Returns a list literal with `size` alternating integer/float elements."""
+    return "[%s]" % (", ".join([str(i) if i % 2 == 0 else "%d.5" % (i) for i in xrange(size)]))
+
+def generateFunction(index, clauses, depth, listSize):
+    """
+    Returns a function declaration `fINDEX/2` with the given number of clauses.
+    Every clause body holds an expression of the given depth, a list literal of
+    `listSize` elements, a case expression and a call to the previous function.
+    """
+    name = "f%d" % (index)
+    parts = []
+    for j in xrange(clauses):
+        if j == clauses - 1:
+            pattern = "N"
+        else:
+            pattern = "%d" % (j)
+        call = "f%d(X, Y)" % (index - 1) if index > 0 else "Y"
+        parts.append(
+            "%s(%s, X) ->\n"
+            "  Y = %s,\n"
+            "  L = %s,\n"
+            "  case Y of\n"
+            "    {ok, Z} -> Z;\n"
+            "    _ -> {L, %s}\n"
+            "  end" % (name, pattern, generateExpression(depth), generateList(listSize), call)
+        )
+    return ";\n".join(parts) + ".\n"
+
+def generateModule(functions=20, clauses=3, depth=4, listSize=20, name="bench"):
+    """Returns the source of a synthetic module scaled by the given parameters."""
+    source = ["-module(%s).\n" % (name)]
+    for i in xrange(functions):
+        source.append(generateFunction(i, clauses, depth, listSize))
+    return "\n".join(source)
+
+def generateLoopModule():
+    """
+    Returns a module `loop` whose function `run/2` calls an arithmetic
+    function `step/2` in a loop.
+    """
+    return (
+        "-module(loop).\n"
+        "run(0, Acc) -> Acc;\n"
+        "run(N, Acc) -> run(N - 1, step(N, Acc)).\n"
+        "step(X, A) -> Y = X * X + A, Z = Y - X * 3, (Z + Y) mod 1000003.\n"
+    )
+
+def generateInstructions(count):
+    """
+    Returns a list of `count` instructions with labels and `nop` instructions
+    in the patterns produced by branching code.
+    """
+    instrs = []
+    for i in xrange(count):
+        if i % 4 == 0:
+            instrs.append(Instruction("nop", label="l%d" % (i)))
+        elif i % 4 == 1:
+            instrs.append(Instruction("nop"))
+        else:
+            instrs.append(Instruction("push", i))
+    return instrs
+
+def generateDeepTree(size):
+    """
+    Returns a list holding a left-deep chain of `size` additions, like the ones
+    created by `BinaryOp.fromParser`, followed by `size` elements as a chain of
+    `List` tokens.
+    """
+    expr = Variable("X")
+    for i in xrange(size):
+        expr = BinaryOp(expr, "+", Integer(i))
+    lst = EmptyList()
+    for i in xrange(size):
+        lst = List(Integer(i), lst)
+    return [expr, lst]
+
+#=============================================================================#
+#                            Benchmark objects                                #
+#=============================================================================#
+
+class BenchVM(Interpreter):
+    """A minimal interpreter counting a register down to zero in a loop."""
+    
+    registerNames = ["PC", "C"]
+    
+    def __init__(self):
+        Interpreter.__init__(self)
+        self.C = Pointer(None)
+    
+    def resetVM(self):
+        Interpreter.resetVM(self)
+        self.C.v = 0
+    
+    def load(n):
+        C.v = n
+    
+    def dec():
+        C << 1
+    
+    def jnz(target):
+        if C != 0:
+            PC.v = target
+
+def loopProgram(n):
+    return [
+        Instruction("load", n),
+        Instruction("dec", label="loop"),
+        Instruction("nop"),
+        Instruction("jnz", 1),
+        Instruction("halt"),
+    ]
+
+class NullObserver(object):
+    implements(IKeyValueObserver, IRangeObserver)
+    
+    def observedPropertyWillChange(self, srcobject, propertyName):
+        pass
+    
+    def observedPropertyDidChange(self, srcobject, propertyName):
+        pass
+    
+    def observedRangeWillChange(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeDidChange(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeWillIncrease(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeDidIncrease(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeWillDecrease(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeDidDecrease(self, srcobject, rangeFrom, rangeTo):
+        pass
+
+class IntegerCounter(TokenVisitor):
+    def __init__(self):
+        self.count = 0
+    
+    def visit_Integer(self, token):
+        self.count += 1
+
+class IntegerIncrementer(TokenTransformer):
+    def transform_Integer(self, token):
+        return Integer(token.value + 1, loc=token.loc)
+
+class Cons(HeapObject):
+    head = HeapObjAttr()
+    tail = HeapObjAttr()
+
+#=============================================================================#
+#                               Benchmarks                                    #
+#=============================================================================#
+
+def measure(f, repeat):
+    """
+    Calls `f` `repeat` times and returns the best time in seconds along with
+    the last return value.
+    """
+    best = None
+    for i in xrange(repeat):
+        t = timer()
+        result = f()
+        t = timer() - t
+        if best == None or t < best:
+            best = t
+    return best, result
+
+def benchParse(opts):
+    source = generateModule(opts.functions, opts.clauses, opts.depth, opts.list_size)
+    t, tree = measure(lambda: cpl.compiler.parse(source), opts.repeat)
+    return {"seconds": t, "ops": len(source), "unit": "chars"}
+
+def benchCompile(opts):
+    tree = cpl.compiler.parse(generateModule(opts.functions, opts.clauses, opts.depth, opts.list_size))
+    t, instrs = measure(lambda: cpl.compiler.compile(tree, {"optimize": False}), opts.repeat)
+    return {"seconds": t, "ops": len(instrs), "unit": "instructions"}
+
+def benchOptimize(opts):
+    instrs = generateInstructions(opts.instructions)
+    t, optinstrs = measure(lambda: cpl.compiler.optimize(instrs), opts.repeat)
+    return {"seconds": t, "ops": len(instrs), "unit": "instructions"}
+
+def benchLoad(opts):
+    instrs = generateInstructions(opts.instructions)
+    PS = ProgramStorage()
+    t, r = measure(lambda: PS.load(instrs), opts.repeat)
+    return {"seconds": t, "ops": len(instrs), "unit": "instructions"}
+
+def benchWalk(opts):
+    tree = generateDeepTree(opts.tree_size)
+    t, r = measure(lambda: IntegerCounter().walk(tree), opts.repeat)
+    return {"seconds": t, "ops": countTokens(tree), "unit": "tokens"}
+
+def benchTransform(opts):
+    tree = generateDeepTree(opts.tree_size)
+    t, r = measure(lambda: IntegerIncrementer().transform(tree), opts.repeat)
+    return {"seconds": t, "ops": countTokens(tree), "unit": "tokens"}
+
+def runLoop(vm):
+    vm.resetVM()
+    vm.runVM()
+
+def benchVM(opts, profiled=False):
+    vm = BenchVM()
+    vm.loadVM(loopProgram(opts.steps // 3))
+    if profiled:
+        Profiler(vm)
+    t, r = measure(lambda: runLoop(vm), opts.repeat)
+    return {"seconds": t, "ops": opts.steps, "unit": "steps"}
+
+def benchKVO(opts, observed=False):
+    p = Pointer(None)
+    if observed:
+        observer = NullObserver()
+        p.addObserver(observer)
+    def run():
+        for i in xrange(opts.notifications):
+            p >> 1
+    t, r = measure(run, opts.repeat)
+    return {"seconds": t, "ops": opts.notifications, "unit": "notifications"}
+
+def benchHeap(opts, observed=False):
+    if observed:
+        observer = NullObserver()
+    def run():
+        H = Heap()
+        if observed:
+            H.addRangeObserver(observer)
+        p = H.new(Cons(0, None))
+        for i in xrange(opts.allocations - 1):
+            p = H.new(Cons(i, p))
+    t, r = measure(run, opts.repeat)
+    return {"seconds": t, "ops": opts.allocations, "unit": "allocations"}
+
+def runCompiled(vm, iterations):
+    vm.resetVM()
+    return vm.callVM("loop:run/2", iterations, 0)
+
+def countExecuted(code, iterations):
+    """
+    Runs the loop module compiled to `code` once with a profiler and returns
+    the number of executed instructions and of frame accesses.
+    """
+    vm = VM()
+    vm.loadVM(code)
+    profiler = Profiler(vm)
+    runCompiled(vm, iterations)
+    counts = dict([(name, count) for name, (count, t) in profiler.nameStats().iteritems()])
+    frame = sum([counts.get(name, 0) for name in ("sload", "sstore", "spill", "reload")])
+    return sum(counts.values()), frame
+
+def benchRegalloc(opts):
+    source = generateLoopModule()
+    iterations = max(opts.steps // 30, 1)
+    code = cpl.compiler.compile(source, {"registers": opts.registers})
+    stack = cpl.compiler.compile(source, {"registers": 0})
+    vm = VM()
+    vm.loadVM(code)
+    t, r = measure(lambda: runCompiled(vm, iterations), opts.repeat)
+    vm.loadVM(stack)
+    tStack, r = measure(lambda: runCompiled(vm, iterations), opts.repeat)
+    instructions, frame = countExecuted(code, iterations)
+    stackInstructions, stackFrame = countExecuted(stack, iterations)
+    return {
+        "seconds": t, "ops": instructions, "unit": "instructions",
+        "seconds_without_registers": tStack,
+        "instructions_without_registers": stackInstructions,
+        "frame_accesses": frame,
+        "frame_accesses_without_registers": stackFrame,
+    }
+
+def benchVector(opts):
+    samples = array('d', [float(i) for i in xrange(opts.samples)])
+    kernel = (("x",), ("c", 2.0), ("op", "*"), ("c", 1.0), ("op", "+"))
+    t, r = measure(lambda: fold("+", 0.0, applyKernel(kernel, samples)), opts.repeat)
+    return {"seconds": t, "ops": opts.samples, "unit": "samples"}
+
+benchmarks = [
+    ("parse", benchParse),
+    ("compile", benchCompile),
+    ("optimize", benchOptimize),
+    ("walk", benchWalk),
+    ("transform", benchTransform),
+    ("load", benchLoad),
+    ("vm", benchVM),
+    ("vm_profiled", lambda opts: benchVM(opts, True)),
+    ("kvo", benchKVO),
+    ("kvo_observed", lambda opts: benchKVO(opts, True)),
+    ("heap", benchHeap),
+    ("heap_observed", lambda opts: benchHeap(opts, True)),
+    ("regalloc", benchRegalloc),
+    ("vector", benchVector),
+]
+
+def runBenchmarks(opts, names=None):
+    """
+    Runs all benchmarks (or only those listed in `names`) and returns a
+    dictionary of results. Failing stages are recorded with their error instead
+    of a time.
+    """
+    results = {}
+    for name, bench in benchmarks:
+        if names and name not in names:
+            continue
+        try:
+            result = bench(opts)
+            if result["seconds"] > 0:
+                result["per_second"] = result["ops"] / result["seconds"]
+        except Exception, e:
+            if opts.verbose:
+                traceback.print_exc()
+            result = {"error": "%s: %s" % (e.__class__.__name__, e)}
+        results[name] = result
+    return results
+
+def compareResults(results, baseline, threshold):
+    """
+    Prints a comparison of `results` against the `baseline` results and returns
+    the names of all stages that got slower by more than `threshold` (a
+    fraction).
+    """
+    regressions = []
+    print "%-16s %12s %12s %9s" % ("stage", "baseline", "current", "change")
+    for name, bench in benchmarks:
+        if not results.has_key(name) or not baseline.has_key(name):
+            continue
+        cur = results[name]
+        base = baseline[name]
+        if cur.has_key("error") or base.has_key("error"):
+            print "%-16s %12s %12s" % (name, "error" if base.has_key("error") else "%.3fms" % (base["seconds"] * 1000), "error" if cur.has_key("error") else "%.3fms" % (cur["seconds"] * 1000))
+            continue
+        change = (cur["seconds"] - base["seconds"]) / base["seconds"] if base["seconds"] > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print "%-16s %10.3fms %10.3fms %+8.1f%%%s" % (name, base["seconds"] * 1000, cur["seconds"] * 1000, change * 100, flag)
+    return regressions
+
+def main():
+    parser = OptionParser(usage="%prog [options] [stage ...]")
+    parser.add_option("-f", "--functions", type="int", default=20, help="number of functions in the generated module")
+    parser.add_option("-c", "--clauses", type="int", default=3, help="number of clauses per function")
+    parser.add_option("-d", "--depth", type="int", default=4, help="depth of generated expressions")
+    parser.add_option("-l", "--list-size", type="int", default=20, help="number of elements in generated list literals")
+    parser.add_option("-e", "--tree-size", type="int", default=100000, help="depth of the generated trees for walk/transform")
+    parser.add_option("-i", "--instructions", type="int", default=10000, help="number of instructions for optimize/load")
+    parser.add_option("-s", "--steps", type="int", default=30000, help="number of VM steps")
+    parser.add_option("-n", "--notifications", type="int", default=10000, help="number of KVO notifications")
+    parser.add_option("-a", "--allocations", type="int", default=10000, help="number of heap allocations")
+    parser.add_option("-g", "--registers", type="int", default=8, help="number of registers for the register allocation")
+    parser.add_option("-m", "--samples", type="int", default=100000, help="number of list elements for the vector kernels")
+    parser.add_option("-r", "--repeat", type="int", default=3, help="repetitions per stage, the best time is kept")
+    parser.add_option("-o", "--output", help="write the results as JSON to this file")
+    parser.add_option("-b", "--baseline", help="compare against the results in this JSON file")
+    parser.add_option("-t", "--threshold", type="float", default=0.1, help="relative slowdown reported as regression")
+    parser.add_option("-v", "--verbose", action="store_true", default=False, help="print tracebacks of failing stages")
+    opts, args = parser.parse_args()
+    
+    results = runBenchmarks(opts, args)
+    report = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": vars(opts),
+        },
+        "results": results,
+    }
+    
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    
+    if opts.baseline:
+        with open(opts.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        if compareResults(results, baseline, opts.threshold):
+            sys.exit(1)
+    elif not opts.output:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print ""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Erlang-style binaries for virtual machines.
+
+A :class:`BinaryData` holds a `memoryview` over a buffer; slicing and matching
+sub-binaries creates new views on the same buffer without copying. Assets
+loaded with :func:`loadAsset` are memory-mapped, so their data is only read
+from disk when it is accessed.
+
+Segments of binaries are described by specs, tuples of
+`(type, bits, signed, little)`: `type` is "integer", "float" or "binary",
+`bits` is the size of the segment in bits (`None` for a trailing binary
+segment matching the rest), `signed` and `little` select signedness and byte
+order of integers and floats. Integer segments may have any size and position;
+binary and float segments have to start at a byte boundary and binaries as a
+whole always consist of full bytes.
+
+Bitwise operations on binaries convert them to a single long integer, so even
+multi-megabyte binaries never get exploded into separate python objects.
+"""
+
+__all__ = ["BinaryData", "loadAsset", "match", "build", "bitwise", "bnot"]
+
+import mmap, struct
+from binascii import hexlify, unhexlify
+
+class BinaryData(object):
+    """
+    An immutable binary. `data` may be a string, a bytearray, an mmap, a
+    memoryview or another binary; its buffer is shared, not copied.
+    """
+    
+    __slots__ = ("view",)
+    
+    def __init__(self, data=""):
+        if isinstance(data, BinaryData):
+            data = data.view
+        elif isinstance(data, mmap.mmap):
+            data = buffer(data)
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
+        self.view = data
+    
+    def __len__(self):
+        return len(self.view)
+    
+    def slice(self, offset, length=None):
+        """
+        Returns the sub-binary of `length` bytes starting at `offset` (up to
+        the end if `length` is `None`) without copying.
+        """
+        size = len(self.view)
+        if length == None:
+            length = size - offset
+        if offset < 0 or length < 0 or offset + length > size:
+            raise IndexError("slice %d+%d out of range for binary of %d bytes" % (offset, length, size))
+        return BinaryData(self.view[offset:offset+length])
+    
+    def tobytes(self):
+        """Returns a copy of the data as string."""
+        return self.view.tobytes()
+    
+    def toInteger(self):
+        """Returns the whole binary as a single unsigned big-endian integer."""
+        if len(self.view) == 0:
+            return 0
+        return int(hexlify(self.view), 16)
+    
+    @classmethod
+    def fromInteger(cls, value, size):
+        """Creates a binary of `size` bytes from the lowest bits of `value`."""
+        if size == 0:
+            return cls("")
+        return cls(unhexlify("%0*x" % (size * 2, value & ((1 << (size * 8)) - 1))))
+    
+    def __eq__(self, other):
+        if not isinstance(other, BinaryData):
+            return NotImplemented
+        return len(self.view) == len(other.view) and self.view.tobytes() == other.view.tobytes()
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    def __hash__(self):
+        return hash(self.view.tobytes())
+    
+    def __reduce__(self):
+        return (BinaryData, (self.view.tobytes(),))
+    
+    def __repr__(self):
+        head = ",".join(map(str, bytearray(self.view[:16].tobytes())))
+        if len(self.view) > 16:
+            return "<<%s,...>> (%d bytes)" % (head, len(self.view))
+        return "<<%s>>" % (head)
+
+def loadAsset(path):
+    """
+    Returns a binary with the contents of the file at `path`. The file is
+    memory-mapped read-only instead of being read.
+    """
+    with open(path, "rb") as f:
+        try:
+            return BinaryData(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError:
+            # Empty files cannot be mapped
+            return BinaryData("")
+
+structFormats = {8: "B", 16: "H", 32: "I", 64: "Q"}
+
+def readInteger(view, pos, bits, signed, little):
+    """Reads an integer of `bits` bits at the bit position `pos` of `view`."""
+    if pos % 8 == 0 and structFormats.has_key(bits):
+        fmt = structFormats[bits]
+        if signed:
+            fmt = fmt.lower()
+        return struct.unpack_from(("<" if little else ">") + fmt, view, pos // 8)[0]
+    
+    if bits == 0:
+        return 0
+    first = pos // 8
+    last = (pos + bits + 7) // 8
+    value = int(hexlify(view[first:last]), 16)
+    value = (value >> (last * 8 - pos - bits)) & ((1 << bits) - 1)
+    if little:
+        if bits % 8 != 0:
+            raise ValueError("little endian integers must consist of full bytes")
+        value = int(hexlify(unhexlify("%0*x" % (bits // 4, value))[::-1]), 16)
+    if signed and value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+def match(data, specs):
+    """
+    Matches the binary `data` against the segment `specs` and returns the list
+    of segment values, or `None` if it does not match. Binary segments are
+    returned as sub-binaries sharing the buffer of `data`.
+    """
+    view = data.view
+    total = len(view) * 8
+    pos = 0
+    values = []
+    for type, bits, signed, little in specs:
+        if type == "binary":
+            if pos % 8 != 0:
+                return None
+            start = pos // 8
+            if bits == None:
+                end = len(view)
+            elif bits % 8 != 0 or pos + bits > total:
+                return None
+            else:
+                end = start + bits // 8
+            values.append(BinaryData(view[start:end]))
+            pos = end * 8
+        elif bits == None or pos + bits > total:
+            return None
+        elif type == "float":
+            if pos % 8 != 0 or bits not in (32, 64):
+                return None
+            values.append(struct.unpack_from(("<" if little else ">") + ("f" if bits == 32 else "d"), view, pos // 8)[0])
+            pos += bits
+        else:
+            values.append(readInteger(view, pos, bits, signed, little))
+            pos += bits
+    if pos != total:
+        return None
+    return values
+
+def build(specs, values):
+    """
+    Builds a new binary from the `values` of the segments described by
+    `specs`. Raises `ValueError` if a value does not fit its segment or the
+    result would not consist of full bytes.
+    """
+    out = bytearray()
+    acc = 0
+    accBits = 0
+    for (type, bits, signed, little), value in zip(specs, values):
+        if type == "binary":
+            if not isinstance(value, BinaryData):
+                raise ValueError("binary segment requires a binary, not %r" % (value,))
+            if accBits != 0:
+                raise ValueError("binary segment does not start at a byte boundary")
+            if bits == None:
+                out.extend(value.view.tobytes())
+            elif bits % 8 != 0 or bits // 8 > len(value):
+                raise ValueError("binary of %d bytes does not fit %d bits" % (len(value), bits))
+            else:
+                out.extend(value.view[:bits // 8].tobytes())
+            continue
+        
+        if type == "float":
+            if bits not in (32, 64):
+                raise ValueError("floats must have 32 or 64 bits")
+            raw = struct.pack(("<" if little else ">") + ("f" if bits == 32 else "d"), value)
+            value = int(hexlify(raw), 16)
+        elif little:
+            if bits % 8 != 0:
+                raise ValueError("little endian integers must consist of full bytes")
+            raw = unhexlify("%0*x" % (bits // 4, value & ((1 << bits) - 1)))
+            value = int(hexlify(raw[::-1]), 16) if bits > 0 else 0
+        
+        acc = (acc << bits) | (value & ((1 << bits) - 1))
+        accBits += bits
+        if accBits >= 8:
+            n = accBits // 8
+            accBits -= n * 8
+            out.extend(unhexlify("%0*x" % (n * 2, acc >> accBits)))
+            acc &= (1 << accBits) - 1
+    if accBits != 0:
+        raise ValueError("binary does not consist of full bytes")
+    return BinaryData(out)
+
+def bitwise(op, a, b):
+    """
+    Applies the bitwise operator `op` ("band", "bor", "bxor", "bsl" or "bsr").
+    Operands are integers or binaries of the same size; for "bsl" and "bsr"
+    the second operand is the shift count and bits shifted out of a binary are
+    lost.
+    """
+    if op in ("bsl", "bsr"):
+        if isinstance(a, BinaryData):
+            size = len(a)
+            value = a.toInteger()
+            return BinaryData.fromInteger(value << b if op == "bsl" else value >> b, size)
+        return a << b if op == "bsl" else a >> b
+    
+    size = None
+    if isinstance(a, BinaryData) or isinstance(b, BinaryData):
+        if not isinstance(a, BinaryData) or not isinstance(b, BinaryData) or len(a) != len(b):
+            raise ValueError("%s requires two integers or two binaries of the same size" % (op))
+        size = len(a)
+        a = a.toInteger()
+        b = b.toInteger()
+    if op == "band":
+        value = a & b
+    elif op == "bor":
+        value = a | b
+    elif op == "bxor":
+        value = a ^ b
+    else:
+        raise ValueError("unknown bitwise operator %r" % (op))
+    if size != None:
+        return BinaryData.fromInteger(value, size)
+    return value
+
+def bnot(a):
+    """Returns the bitwise complement of an integer or a binary."""
+    if isinstance(a, BinaryData):
+        return BinaryData.fromInteger(~a.toInteger(), len(a))
+    return ~a
@@ -0,0 +1,258 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__all__ = ["build", "ModuleInterface", "CompiledModule", "BuildError"]
+
+import os, hashlib, cPickle, traceback
+from multiprocessing import Pool, cpu_count
+
+from compiler import parse, compile, FunApplExpression, FunName
+from compiler_base import CompilerMetrics, iterTokens
+
+class ModuleInterface(object):
+    """
+    Describes what a module provides to and requires from other modules.
+    
+    :param name: the module name
+    :param functions: a set of `(name, arity)` tuples of all declared functions
+    :param exports: a set of `(name, arity)` tuples of the exported functions
+    :param calls: a set of `(module, name, arity)` tuples of all function
+      calls; local calls have the module name set to `name`
+    """
+    
+    def __init__(self, name, functions, exports, calls):
+        self.name = name
+        self.functions = functions
+        self.exports = exports
+        self.calls = calls
+    
+    @property
+    def dependencies(self):
+        """The set of names of other modules this module calls into."""
+        return set([module for module, name, arity in self.calls if module != self.name])
+    
+    def digest(self):
+        """
+        Returns a digest of the parts of the interface other modules depend on,
+        i.e. the module name and its exports.
+        """
+        return hashlib.sha1(repr((self.name, sorted(self.exports)))).hexdigest()
+    
+    @classmethod
+    def fromParseTree(cls, parse_tree, name=None):
+        """
+        Creates the interface of the given module parse tree. The module name
+        defaults to the one declared in the tree.
+        """
+        if name == None:
+            name = parse_tree.name
+        functions = set([(f.name.name, f.arity) for f in parse_tree.functions])
+        exports = parse_tree.exports
+        if exports == None:
+            exports = set(functions)
+        calls = set()
+        for token in iterTokens(parse_tree):
+            if isinstance(token, FunApplExpression) and isinstance(token.fun, FunName):
+                calls.add((token.fun.module or name, token.fun.name, len(token.args)))
+        return cls(name, functions, exports, calls)
+    
+    def __repr__(self):
+        return "ModuleInterface(%s)" % (", ".join(map(repr, [self.name, self.functions, self.exports, self.calls])))
+
+class CompiledModule(object):
+    """
+    Holds the result of compiling one module. Instances are stored in the build
+    cache.
+    
+    `depDigests` maps the names of the modules this module depends on to the
+    digests of their interfaces at the time this module was compiled.
+    `rebuilt` is `False` if the module was taken from the cache by the last
+    build.
+    """
+    
+    def __init__(self, path, digest, interface, instructions, metrics):
+        self.path = path
+        self.digest = digest
+        self.interface = interface
+        self.instructions = instructions
+        self.metrics = metrics
+        self.depDigests = {}
+        self.rebuilt = True
+    
+    @property
+    def name(self):
+        return self.interface.name
+
+class BuildError(Exception):
+    """
+    Raised if modules failed to compile or to link. `errors` holds a list of
+    `(module, message)` tuples where `module` is the module name or the path
+    if the name is not known.
+    """
+    
+    def __init__(self, errors):
+        Exception.__init__(self, "\n".join(["%s: %s" % e for e in errors]))
+        self.errors = errors
+
+def compileModule(job):
+    """
+    Parses and compiles a single module. This is run in the worker processes.
+    Returns a tuple `(path, module, error)`; `module` is a
+    :class:`CompiledModule` (without instructions if compiling failed) or
+    `None` if parsing failed.
+    """
+    path, source, digest, options = job
+    metrics = CompilerMetrics()
+    try:
+        parse_tree = parse(source, metrics)
+        name = parse_tree.name
+        if name == None:
+            name = os.path.splitext(os.path.basename(path))[0]
+        interface = ModuleInterface.fromParseTree(parse_tree, name)
+    except Exception:
+        return path, None, traceback.format_exc().strip().splitlines()[-1]
+    
+    module = CompiledModule(path, digest, interface, None, None)
+    options = dict(options)
+    options["namespace"] = name
+    options["metrics"] = metrics
+    metrics.name = name
+    try:
+        module.instructions = compile(parse_tree, options)
+    except Exception:
+        return path, module, traceback.format_exc().strip().splitlines()[-1]
+    module.metrics = metrics.asDict()
+    return path, module, None
+
+def linkErrors(modules):
+    """
+    Checks that all calls between the given compiled modules (a dictionary
+    mapping names to :class:`CompiledModule` objects) can be resolved. Returns
+    a list of `(module, message)` tuples for all unresolved calls.
+    """
+    errors = []
+    for name, module in sorted(modules.iteritems()):
+        interface = module.interface
+        for target, fname, arity in sorted(interface.calls):
+            if target == name:
+                if (fname, arity) not in interface.functions:
+                    errors.append((name, "function %s/%d undefined" % (fname, arity)))
+            elif not modules.has_key(target):
+                errors.append((name, "call to %s:%s/%d: module %s not found" % (target, fname, arity, target)))
+            elif (fname, arity) not in modules[target].interface.exports:
+                errors.append((name, "function %s:%s/%d undefined or not exported" % (target, fname, arity)))
+    return errors
+
+def build(paths, cache=None, options={}, processes=None):
+    """
+    Compiles the modules in the given source files and returns a dictionary
+    mapping module names to :class:`CompiledModule` objects.
+    
+    Modules are compiled in parallel by a pool of `processes` worker processes
+    (defaults to the number of CPUs). Every module gets its module name as label
+    namespace, so labels are unique across modules.
+    
+    If `cache` is the path of a cache file, the results are stored there and
+    on subsequent builds only modules are recompiled whose source or compiler
+    options changed, or whose dependencies changed their interface.
+    
+    After compiling, all calls between modules are resolved. Raises
+    :class:`BuildError` if any module failed to compile or link; successfully
+    compiled modules are cached nonetheless.
+    
+    `options` are passed to the compiler, except for `metrics`; the metrics of
+    every module are stored in its `metrics` attribute instead.
+    """
+    options = dict(options)
+    options.pop("metrics", None)
+    
+    cached = {}
+    if cache != None and os.path.exists(cache):
+        try:
+            with open(cache, "rb") as f:
+                cached = cPickle.load(f)
+        except Exception:
+            cached = {}
+    
+    jobs = {}
+    compiled = {}
+    for path in paths:
+        with open(path, "r") as f:
+            source = f.read()
+        digest = hashlib.sha1(repr((source, sorted(options.iteritems())))).hexdigest()
+        entry = cached.get(path)
+        if entry != None and entry.digest == digest and entry.instructions != None:
+            entry.rebuilt = False
+            compiled[path] = entry
+        else:
+            jobs[path] = (path, source, digest, options)
+    
+    errors = []
+    rebuilt = set()
+    pool = None
+    try:
+        while len(jobs) > 0:
+            if processes == 1 or len(jobs) == 1:
+                results = map(compileModule, jobs.values())
+            else:
+                if pool == None:
+                    pool = Pool(processes or cpu_count())
+                results = pool.imap_unordered(compileModule, jobs.values())
+            for path, module, error in results:
+                rebuilt.add(path)
+                if module != None:
+                    compiled[path] = module
+                if error != None:
+                    errors.append((module.name if module != None else path, error))
+            
+            # Recompile cached modules whose dependencies changed their interface
+            digests = dict([(m.name, m.interface.digest()) for m in compiled.itervalues()])
+            jobs = {}
+            for path, module in compiled.iteritems():
+                depDigests = dict([(dep, digests.get(dep)) for dep in module.interface.dependencies])
+                if path not in rebuilt and module.depDigests != depDigests:
+                    with open(path, "r") as f:
+                        jobs[path] = (path, f.read(), module.digest, options)
+                else:
+                    module.depDigests = depDigests
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+    
+    if cache != None:
+        cached.update(compiled)
+        with open(cache, "wb") as f:
+            cPickle.dump(cached, f, 2)
+    
+    modules = {}
+    for path in paths:
+        module = compiled.get(path)
+        if module == None:
+            continue
+        if modules.has_key(module.name):
+            errors.append((module.name, "module defined in both %s and %s" % (modules[module.name].path, path)))
+        modules[module.name] = module
+    
+    if len(errors) == 0:
+        errors = linkErrors(modules)
+    if len(errors) > 0:
+        raise BuildError(errors)
+    
+    return modules
@@ -0,0 +1,692 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Control flow graphs and dataflow optimizations over instruction lists.
+
+A :class:`CFG` splits a list of instructions into basic blocks at labels and
+control flow instructions, with labels resolved like in
+`ProgramStorage.load`. What the instructions of a machine do is described by
+an :class:`InstructionSemantics` object, so the framework works for any
+instruction set.
+
+The passes work on locations (registers, stack slots, ...) named by the
+instruction arguments as reported by `InstructionSemantics.effects`:
+
+- `removeUnreachable` removes blocks which cannot be reached
+- `threadJumps` retargets jumps to blocks which only jump on
+- `eliminateDeadCode` removes pure instructions whose results are never used
+- `eliminateCommonSubexpressions` replaces recomputations of available values
+  by moves
+- `hoistLoopInvariants` moves invariant computations out of loops into a
+  preheader
+
+`linearize` turns the graph back into a list of instructions.
+"""
+
+__all__ = ["CFG", "Block", "InstructionSemantics", "EVERYTHING", "optimize"]
+
+from compiler_base import Instruction, parseFunLabel
+
+#: Stands for all locations in the defs or uses reported by `InstructionSemantics.effects`.
+EVERYTHING = object()
+
+class InstructionSemantics(object):
+    """
+    Describes the control and data flow of an instruction set. Subclass this
+    for every machine.
+    
+    `jumps` and `branches` map the names of unconditional and conditional
+    jump instructions to the index of their target argument; conditional jumps
+    fall through to the next instruction otherwise. `calls` does the same for
+    instructions which refer to code without jumping to it, like calls or the
+    creation of closures; they continue with the next instruction.
+    Instructions in `terminators` never continue with the next instruction.
+    """
+    
+    jumps = {}
+    branches = {}
+    calls = {}
+    terminators = set(["halt"])
+    
+    def targetArgs(self, instr):
+        """
+        Returns the indexes of the arguments of `instr` which refer to code:
+        the target of a jump, branch or call.
+        """
+        for table in (self.jumps, self.branches, self.calls):
+            index = table.get(instr.name)
+            if index != None:
+                return (index,)
+        return ()
+    
+    def effects(self, instr):
+        """
+        Returns a tuple `(defs, uses, pure)` for the instruction: the
+        locations it writes and reads (sequences, or `EVERYTHING`) and whether
+        it is pure, i.e. it has no other effects and cannot fail, so it may be
+        removed or moved if its results are not needed. The default treats
+        instructions as touching no locations but having other effects.
+        """
+        return (), (), False
+    
+    def valueKey(self, instr):
+        """
+        Returns a key identifying the value computed by a pure instruction
+        with a single result, equal for all instructions computing the same
+        value, or `None` if its value should not be reused. The default
+        disables common subexpression elimination.
+        """
+        return None
+    
+    def makeMove(self, dst, src):
+        """
+        Returns an instruction copying location `src` to `dst` or `None` if the
+        machine has none, which disables common subexpression elimination.
+        """
+        return None
+
+class Block(object):
+    """
+    A basic block. `label` is the label of its first instruction (or `None`),
+    `instructions` holds its instructions without that label. `succs` and
+    `preds` hold the neighbouring blocks; `next` is the block following in
+    the layout, which is also the successor if control falls through.
+    """
+    
+    def __init__(self, label, instructions):
+        self.label = label
+        self.instructions = instructions
+        self.succs = []
+        self.preds = []
+        self.next = None
+    
+    def __repr__(self):
+        return "<Block %s (%d instructions)>" % (self.label, len(self.instructions))
+
+class CFG(object):
+    """
+    Control flow graph of a list of instructions; see the module
+    documentation. `blocks` holds the blocks in layout order, the first one
+    is the entry.
+    
+    Jump and call targets given as instruction indexes start blocks like
+    labels and are replaced by labels. Raises `ValueError` if such a target
+    lies outside of the instructions.
+    """
+    
+    def __init__(self, instructions, semantics):
+        self.semantics = semantics
+        self.blocks = []
+        self.__labelCounter = 0
+        
+        instructions = list(instructions)
+        leaders = set([0])
+        for i, instr in enumerate(instructions):
+            if instr.label != None:
+                leaders.add(i)
+            if semantics.jumps.has_key(instr.name) or semantics.branches.has_key(instr.name) or instr.name in semantics.terminators:
+                leaders.add(i + 1)
+            for index in semantics.targetArgs(instr):
+                target = instr.args[index]
+                if isinstance(target, (int, long)):
+                    if target < 0 or target >= len(instructions):
+                        raise ValueError("target %d of instruction %d is out of range" % (target, i))
+                    leaders.add(target)
+        
+        starts = {}
+        block = None
+        for i, instr in enumerate(instructions):
+            if i in leaders:
+                block = Block(instr.label, [])
+                starts[i] = block
+                self.blocks.append(block)
+                if instr.label != None:
+                    instr = Instruction(instr.name, *instr.args, loc=instr.loc)
+            block.instructions.append(instr)
+        
+        # Jumps and calls to instruction indexes (like in linked images) refer
+        # to labels from now on, as the indexes change with the layout
+        for block in self.blocks:
+            for i, instr in enumerate(block.instructions):
+                for index in semantics.targetArgs(instr):
+                    if isinstance(instr.args[index], (int, long)):
+                        target = starts[instr.args[index]]
+                        if target.label == None:
+                            target.label = self.newLabel()
+                        block.instructions[i] = self.retarget(instr, target.label)
+        
+        self.updateEdges()
+    
+    # ------------------------------------------------------------------------ #
+    
+    def newLabel(self):
+        """Returns a label not used in the graph yet."""
+        used = set([block.label for block in self.blocks])
+        while True:
+            self.__labelCounter += 1
+            label = "cfg.l%d" % (self.__labelCounter)
+            if label not in used:
+                return label
+    
+    def targetIndex(self, instr):
+        """
+        Returns the index of the target argument if `instr` is a jump or
+        branch, otherwise `None`.
+        """
+        index = self.semantics.jumps.get(instr.name)
+        if index == None:
+            index = self.semantics.branches.get(instr.name)
+        return index
+    
+    def retarget(self, instr, label):
+        """Returns a copy of the jump, branch or call `instr` going to `label`."""
+        args = list(instr.args)
+        args[self.semantics.targetArgs(instr)[0]] = label
+        return Instruction(instr.name, *args, label=instr.label, loc=instr.loc)
+    
+    def fallsThrough(self, block):
+        """Checks whether control can continue at the next block."""
+        if len(block.instructions) == 0:
+            return True
+        last = block.instructions[-1]
+        return not self.semantics.jumps.has_key(last.name) and last.name not in self.semantics.terminators
+    
+    def updateEdges(self):
+        """Recomputes all edges from the instructions and the layout."""
+        labels = dict([(block.label, block) for block in self.blocks if block.label != None])
+        for i, block in enumerate(self.blocks):
+            block.next = self.blocks[i + 1] if i + 1 < len(self.blocks) else None
+            block.succs = []
+            block.preds = []
+        for block in self.blocks:
+            if len(block.instructions) > 0:
+                index = self.targetIndex(block.instructions[-1])
+                if index != None:
+                    target = labels.get(block.instructions[-1].args[index])
+                    if target != None:
+                        block.succs.append(target)
+            if block.next != None and self.fallsThrough(block) and block.next not in block.succs:
+                block.succs.append(block.next)
+            for succ in block.succs:
+                succ.preds.append(block)
+    
+    def roots(self):
+        """
+        Returns the blocks where control may enter from outside: the entry,
+        blocks with function labels and blocks whose label is referenced by
+        an instruction other than as jump target.
+        """
+        referenced = set()
+        for block in self.blocks:
+            for instr in block.instructions:
+                index = self.targetIndex(instr)
+                for i, arg in enumerate(instr.args):
+                    if i != index and isinstance(arg, str):
+                        referenced.add(arg)
+        roots = self.blocks[:1]
+        for block in self.blocks[1:]:
+            if block.label != None and (block.label in referenced or parseFunLabel(block.label) != None):
+                roots.append(block)
+        return roots
+    
+    def reversePostorder(self):
+        """Returns the blocks reachable from the roots in reverse postorder."""
+        order = []
+        seen = set()
+        for root in reversed(self.roots()):
+            if root in seen:
+                continue
+            seen.add(root)
+            stack = [(root, iter(root.succs))]
+            while len(stack) > 0:
+                block, succs = stack[-1]
+                for succ in succs:
+                    if succ not in seen:
+                        seen.add(succ)
+                        stack.append((succ, iter(succ.succs)))
+                        break
+                else:
+                    stack.pop()
+                    order.append(block)
+        order.reverse()
+        return order
+    
+    def dominators(self):
+        """
+        Returns a dictionary mapping every reachable block to its immediate
+        dominator; roots map to `None`.
+        """
+        order = self.reversePostorder()
+        position = dict([(block, i) for i, block in enumerate(order)])
+        roots = set(self.roots())
+        idom = dict([(block, None) for block in roots])
+        
+        def intersect(a, b):
+            while a is not b:
+                while a != None and b != None and position[a] > position[b]:
+                    a = idom[a]
+                while a != None and b != None and position[b] > position[a]:
+                    b = idom[b]
+                if a == None or b == None:
+                    return None
+            return a
+        
+        changed = True
+        while changed:
+            changed = False
+            for block in order:
+                if block in roots:
+                    continue
+                new = False
+                for pred in block.preds:
+                    if not idom.has_key(pred) or pred not in position:
+                        continue
+                    new = pred if new is False else intersect(pred, new)
+                if new is False:
+                    continue
+                if idom.get(block, False) is not new:
+                    idom[block] = new
+                    changed = True
+        return idom
+    
+    def dominance(self, idom):
+        """
+        Returns a function `dominates(a, b)` checking in constant time whether
+        block `a` dominates block `b`, given the immediate dominators.
+        """
+        children = {}
+        for block, dominator in idom.iteritems():
+            children.setdefault(dominator, []).append(block)
+        pre = {}
+        post = {}
+        counter = 0
+        stack = [(None, iter(children.get(None, [])))]
+        while len(stack) > 0:
+            block, blocks = stack[-1]
+            for child in blocks:
+                counter += 1
+                pre[child] = counter
+                stack.append((child, iter(children.get(child, []))))
+                break
+            else:
+                stack.pop()
+                counter += 1
+                post[block] = counter
+        
+        def dominates(a, b):
+            return pre.has_key(a) and pre.has_key(b) and pre[a] <= pre[b] and post[b] <= post[a]
+        return dominates
+    
+    def resolve(self, locations, universe):
+        if locations == EVERYTHING:
+            return universe
+        return set(locations)
+    
+    def universe(self):
+        """Returns the set of all locations named by any instruction."""
+        locations = set()
+        for block in self.blocks:
+            for instr in block.instructions:
+                defs, uses, pure = self.semantics.effects(instr)
+                if defs != EVERYTHING:
+                    locations.update(defs)
+                if uses != EVERYTHING:
+                    locations.update(uses)
+        return locations
+    
+    def liveness(self):
+        """
+        Returns a dictionary mapping every block to the set of locations live
+        at its end. Everything is live where control leaves the graph.
+        """
+        universe = self.universe()
+        effects = {}
+        for block in self.blocks:
+            gen = set()
+            kill = set()
+            for instr in reversed(block.instructions):
+                defs, uses, pure = self.semantics.effects(instr)
+                defs = self.resolve(defs, universe)
+                uses = self.resolve(uses, universe)
+                gen -= defs
+                kill |= defs
+                gen |= uses
+            effects[block] = (gen, kill)
+        
+        liveOut = dict([(block, set()) for block in self.blocks])
+        liveIn = dict([(block, set(effects[block][0])) for block in self.blocks])
+        changed = True
+        while changed:
+            changed = False
+            for block in reversed(self.blocks):
+                out = set()
+                if len(block.succs) == 0:
+                    out = set(universe)
+                for succ in block.succs:
+                    out |= liveIn[succ]
+                gen, kill = effects[block]
+                new = gen | (out - kill)
+                if out != liveOut[block] or new != liveIn[block]:
+                    liveOut[block] = out
+                    liveIn[block] = new
+                    changed = True
+        return liveOut
+    
+    # ------------------------------------------------------------------------ #
+    
+    def removeUnreachable(self):
+        """Removes unreachable blocks. Returns the number of removed blocks."""
+        reachable = set(self.reversePostorder())
+        n = len(self.blocks)
+        self.blocks = [block for block in self.blocks if block in reachable]
+        self.updateEdges()
+        return n - len(self.blocks)
+    
+    def threadJumps(self):
+        """
+        Retargets jumps and branches to blocks which consist of nothing but an
+        unconditional jump or fall through without doing anything. Returns the
+        number of retargeted instructions.
+        """
+        labels = dict([(block.label, block) for block in self.blocks if block.label != None])
+        n = 0
+        for block in self.blocks:
+            if len(block.instructions) == 0:
+                continue
+            last = block.instructions[-1]
+            index = self.targetIndex(last)
+            if index == None or not labels.has_key(last.args[index]):
+                continue
+            target = labels[last.args[index]]
+            seen = set([target])
+            while True:
+                if len(target.instructions) == 0:
+                    following = target.next
+                elif len(target.instructions) == 1 and self.semantics.jumps.has_key(target.instructions[0].name):
+                    jump = target.instructions[0]
+                    following = labels.get(jump.args[self.targetIndex(jump)])
+                else:
+                    break
+                if following == None or following in seen:
+                    break
+                seen.add(following)
+                target = following
+            if target.label != last.args[index]:
+                if target.label == None:
+                    target.label = self.newLabel()
+                    labels[target.label] = target
+                block.instructions[-1] = self.retarget(last, target.label)
+                n += 1
+        self.updateEdges()
+        return n
+    
+    def eliminateDeadCode(self):
+        """
+        Removes pure instructions none of whose results are used later.
+        Returns the number of removed instructions.
+        """
+        universe = self.universe()
+        if len(universe) == 0:
+            return 0
+        liveOut = self.liveness()
+        n = 0
+        for block in self.blocks:
+            live = set(liveOut[block])
+            kept = []
+            for instr in reversed(block.instructions):
+                defs, uses, pure = self.semantics.effects(instr)
+                defs = self.resolve(defs, universe)
+                uses = self.resolve(uses, universe)
+                if pure and len(defs) > 0 and len(defs & live) == 0:
+                    n += 1
+                    continue
+                live -= defs
+                live |= uses
+                kept.append(instr)
+            kept.reverse()
+            block.instructions = kept
+        return n
+    
+    def eliminateCommonSubexpressions(self):
+        """
+        Replaces pure instructions computing a value which is still available
+        in another location on every path by a move from that location.
+        Returns the number of replaced instructions.
+        """
+        universe = self.universe()
+        if len(universe) == 0:
+            return 0
+        
+        def facts(instr):
+            defs, uses, pure = self.semantics.effects(instr)
+            defs = self.resolve(defs, universe)
+            uses = self.resolve(uses, universe)
+            key = None
+            if pure and len(defs) == 1 and len(defs & uses) == 0:
+                key = self.semantics.valueKey(instr)
+            return defs, uses, key
+        
+        def transfer(available, instr):
+            defs, uses, key = facts(instr)
+            available = dict([(k, (dst, u)) for k, (dst, u) in available.iteritems() if dst not in defs and len(u & defs) == 0])
+            if key != None:
+                available[key] = (iter(defs).next(), uses)
+            return available
+        
+        roots = set(self.roots())
+        availableOut = {}
+        order = self.reversePostorder()
+        changed = True
+        while changed:
+            changed = False
+            for block in order:
+                available = self.meet(block, roots, availableOut)
+                for instr in block.instructions:
+                    available = transfer(available, instr)
+                if availableOut.get(block) != available:
+                    availableOut[block] = available
+                    changed = True
+        
+        makeMove = self.semantics.makeMove
+        n = 0
+        for block in order:
+            available = self.meet(block, roots, availableOut)
+            instructions = []
+            for instr in block.instructions:
+                defs, uses, key = facts(instr)
+                if key != None and available.has_key(key):
+                    dst = iter(defs).next()
+                    src = available[key][0]
+                    move = makeMove(dst, src) if src != dst else None
+                    if src == dst or move != None:
+                        n += 1
+                        available = transfer(available, instr)
+                        if move != None:
+                            instructions.append(move)
+                        continue
+                available = transfer(available, instr)
+                instructions.append(instr)
+            block.instructions = instructions
+        return n
+    
+    def meet(self, block, roots, availableOut):
+        if block in roots:
+            return {}
+        available = None
+        for pred in block.preds:
+            out = availableOut.get(pred)
+            if out == None:
+                # Not computed yet, i.e. everything is available
+                continue
+            if available == None:
+                available = dict(out)
+            else:
+                available = dict([(k, v) for k, v in available.iteritems() if out.get(k) == v])
+        return available or {}
+    
+    def loops(self, dominates):
+        """
+        Returns the natural loops as a list of `(header, body)` tuples, where
+        `body` is the set of blocks of the loop, innermost loops first.
+        `dominates` is a function as returned by `dominance`.
+        """
+        loops = {}
+        for block in self.blocks:
+            for succ in block.succs:
+                if dominates(succ, block):
+                    body = loops.setdefault(succ, set([succ]))
+                    stack = [block]
+                    while len(stack) > 0:
+                        b = stack.pop()
+                        if b not in body:
+                            body.add(b)
+                            stack.extend(b.preds)
+        return sorted(loops.iteritems(), key=lambda item: len(item[1]))
+    
+    def hoistLoopInvariants(self):
+        """
+        Moves pure instructions whose operands do not change within a loop
+        into a new preheader block in front of the loop. Returns the number of
+        hoisted instructions.
+        """
+        universe = self.universe()
+        if len(universe) == 0:
+            return 0
+        loops = self.loops(self.dominance(self.dominators()))
+        n = 0
+        for header, body in loops:
+            # Back edges must be jumps, as the preheader goes in front of the header
+            if any([b in body and b.next is header and self.fallsThrough(b) for b in header.preds]):
+                continue
+            dominates = self.dominance(self.dominators())
+            liveOut = self.liveness()
+            
+            defCounts = {}
+            everything = False
+            for block in body:
+                for instr in block.instructions:
+                    defs, uses, pure = self.semantics.effects(instr)
+                    if defs == EVERYTHING:
+                        everything = True
+                        break
+                    for d in defs:
+                        defCounts[d] = defCounts.get(d, 0) + 1
+            if everything:
+                continue
+            
+            exits = [(block, succ) for block in body for succ in block.succs if succ not in body]
+            headerLive = self.liveAtStart(header, liveOut, universe)
+            hoisted = []
+            changed = True
+            while changed:
+                changed = False
+                for block in [b for b in self.blocks if b in body]:
+                    for instr in list(block.instructions):
+                        defs, uses, pure = self.semantics.effects(instr)
+                        if not pure or uses == EVERYTHING or len(defs) != 1:
+                            continue
+                        dst = list(defs)[0]
+                        if dst in uses or defCounts.get(dst) != 1 or dst in headerLive:
+                            continue
+                        if any([defCounts.get(u, 0) > 0 for u in uses]):
+                            continue
+                        if not all([dominates(block, x) or dst not in self.liveAtStart(y, liveOut, universe) for x, y in exits]):
+                            continue
+                        block.instructions.remove(instr)
+                        hoisted.append(instr)
+                        defCounts[dst] = 0
+                        changed = True
+            
+            if len(hoisted) == 0:
+                continue
+            
+            # The preheader takes over the label of the header, so all entries
+            # into the loop pass it; back edges jump to the header's new label.
+            label = self.newLabel()
+            preheader = Block(header.label, hoisted)
+            header.label = label
+            for block in body:
+                if len(block.instructions) > 0 and header in block.succs:
+                    last = block.instructions[-1]
+                    if self.targetIndex(last) != None and last.args[self.targetIndex(last)] == preheader.label:
+                        block.instructions[-1] = self.retarget(last, label)
+            self.blocks.insert(self.blocks.index(header), preheader)
+            for outerHeader, outerBody in loops:
+                if header in outerBody and outerBody is not body:
+                    outerBody.add(preheader)
+            self.updateEdges()
+            n += len(hoisted)
+        return n
+    
+    def liveAtStart(self, block, liveOut, universe):
+        """Returns the locations live at the start of `block`."""
+        live = set(liveOut[block])
+        for instr in reversed(block.instructions):
+            defs, uses, pure = self.semantics.effects(instr)
+            live -= self.resolve(defs, universe)
+            live |= self.resolve(uses, universe)
+        return live
+    
+    # ------------------------------------------------------------------------ #
+    
+    def linearize(self):
+        """
+        Returns the instructions of the graph as a list. Unconditional jumps to
+        the following block and empty blocks whose label is not referenced
+        are left out.
+        """
+        referenced = set()
+        for block in self.blocks:
+            for instr in block.instructions:
+                referenced.update([arg for arg in instr.args if isinstance(arg, str)])
+        
+        instructions = []
+        for block in self.blocks:
+            if len(block.instructions) == 0 and block.label not in referenced and parseFunLabel(block.label or "") == None:
+                continue
+            instrs = list(block.instructions)
+            if len(instrs) > 0 and block.next != None and block.next.label != None:
+                last = instrs[-1]
+                if self.semantics.jumps.has_key(last.name) and last.args[self.targetIndex(last)] == block.next.label:
+                    instrs.pop()
+            if block.label != None:
+                if len(instrs) == 0:
+                    instrs.append(Instruction("nop", label=block.label))
+                else:
+                    first = instrs[0]
+                    instrs[0] = Instruction(first.name, *first.args, label=block.label, loc=first.loc)
+            instructions.extend(instrs)
+        return instructions
+
+def optimize(instructions, semantics, rounds=4):
+    """
+    Runs all passes over the instructions until nothing changes any more (or
+    for at most `rounds` rounds) and returns the resulting instructions.
+    """
+    cfg = CFG(instructions, semantics)
+    for i in xrange(rounds):
+        n = cfg.removeUnreachable()
+        n += cfg.threadJumps()
+        n += cfg.eliminateCommonSubexpressions()
+        n += cfg.hoistLoopInvariants()
+        n += cfg.eliminateDeadCode()
+        if n == 0:
+            break
+    return cfg.linearize()
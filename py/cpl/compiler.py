@@ -18,17 +18,17 @@
 #  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-__all__ = ["compile", "parse", "optimize", "instrs", "compile_options"]
+__all__ = ["compile", "CompileError", "parse", "optimize", "vectorize", "inline", "instrs", "compile_options", "setMetricsSink"]
 
+import threading
 from cStringIO import StringIO
-from time import time
-import operator
+from array import array
 
-from pyparsing import Literal, Suppress, Keyword, Regex, Combine, Group, Forward, Word, OneOrMore, ZeroOrMore, Optional, White, NotAny
-from pyparsing import alphas, nums, oneOf, delimitedList
-
-from compiler_base import Token, Instruction, InstructionSet, InstructionLabel
-from compiler_base import putLabel, newOptimizerBase
+from compiler_base import Token, Instruction, InstructionSet, InstructionLabel, CompilerMetrics
+from compiler_base import putLabel, newOptimizerBase, countTokens, iterTokens, TokenTransformer, parseFunLabel, funLabel
+from cfg import InstructionSemantics, EVERYTHING
+import cfg
+from bisect import insort
 
 #=============================================================================#
 #                               Token objects                                 #
@@ -67,12 +67,61 @@ class FunName(Token):
     def fromParser(cls, s, loc, toks):
         return cls(str(toks[0]), str(toks[1]), loc=loc)
 
+def packNumbers(elements):
+    """
+    Returns an array holding the values of the given `Integer` or `Float`
+    tokens, if all of them are of the same type and at least one is given.
+    Returns `None` otherwise.
+    """
+    if len(elements) == 0:
+        return None
+    
+    if isinstance(elements[0], Integer):
+        typecode, cls = 'l', Integer
+    elif isinstance(elements[0], Float):
+        typecode, cls = 'd', Float
+    else:
+        return None
+    
+    for e in elements:
+        if e.__class__ is not cls:
+            return None
+    
+    try:
+        return array(typecode, [e.value for e in elements])
+    except OverflowError:
+        return None
+
+def unpackNumbers(values):
+    """
+    Returns a list of `Integer` or `Float` tokens for the values of an array
+    created by `packNumbers`.
+    """
+    cls = Float if values.typecode == 'd' else Integer
+    return [cls(v) for v in values]
+
 class Tuple(Token):
     Attributes = ["elements"]
     
     @classmethod
     def fromParser(cls, s, loc, toks):
-        return cls(toks.asList(), loc=loc)
+        elements = toks.asList()
+        values = packNumbers(elements)
+        if values != None:
+            return PackedTuple(values, loc=loc)
+        return cls(elements, loc=loc)
+
+class PackedTuple(Tuple):
+    """
+    A tuple literal consisting only of integers or only of floats. The values
+    are stored in an array instead of separate tokens.
+    """
+    
+    Attributes = ["values"]
+    
+    @property
+    def elements(self):
+        return unpackNumbers(self.values)
 
 class EmptyList(Token):
     @classmethod
@@ -84,17 +133,115 @@ class List(Token):
     
     @classmethod
     def fromParser(cls, s, loc, toks):
+        """
+        Creates a chain of List tokens for lists with a tail. Proper lists are
+        created as a single `FlatList` or `PackedList` token instead.
+        """
         tail = toks[-1]
         if tail is None:
-            obj = EmptyList()
-        else:
-            obj = tail
+            if len(toks) == 1:
+                return EmptyList(loc=loc)
+            elements = toks.asList()[:-1]
+            values = packNumbers(elements)
+            if values != None:
+                return PackedList(values, loc=loc)
+            return FlatList(elements, loc=loc)
         
+        obj = tail
         for i in xrange(len(toks)-2,-1,-1):
             obj = cls(toks[i], obj)
         
         return obj
 
+class FlatList(Token):
+    """
+    A proper list literal stored as a python list of its elements instead of a
+    chain of `List` tokens.
+    """
+    
+    Attributes = ["elements"]
+    
+    def toCons(self):
+        """Returns the equivalent chain of `List` tokens."""
+        obj = EmptyList(loc=self.loc)
+        for e in reversed(self.elements):
+            obj = List(e, obj, loc=self.loc)
+        return obj
+
+class PackedList(FlatList):
+    """
+    A proper list literal consisting only of integers or only of floats. The
+    values are stored in an array instead of separate tokens.
+    """
+    
+    Attributes = ["values"]
+    
+    @property
+    def elements(self):
+        return unpackNumbers(self.values)
+
+def listElements(token):
+    """
+    Returns the elements of a proper list literal as a python list. The list
+    may be given as a chain of `List` tokens ending with `EmptyList` or a
+    `FlatList` (or any mix of both). Returns `None` if `token` is not a proper
+    list.
+    """
+    elements = []
+    while isinstance(token, List):
+        elements.append(token.head)
+        token = token.tail
+    if isinstance(token, FlatList):
+        return elements + token.elements
+    if not isinstance(token, EmptyList):
+        return None
+    return elements
+
+class BinarySegment(Token):
+    """
+    A segment `Value:Size/Types` of a binary expression or pattern. `size` is
+    an `Integer` token or `None`, `types` is a list of type specifiers like
+    "integer", "binary", "signed" or "little".
+    """
+    
+    Attributes = ["value", "size", "types"]
+    
+    @classmethod
+    def fromParser(cls, s, loc, toks):
+        return cls(toks[0], toks[1], map(str, toks[2]), loc=loc)
+    
+    def spec(self):
+        """
+        Returns the segment spec `(type, bits, signed, little)` as used by
+        :mod:`cpl.binary`. Sizes default to 8 bits for integers, 64 bits for
+        floats and the rest of the binary for binaries; binary sizes are given
+        in bytes.
+        """
+        type = "integer"
+        for t in self.types:
+            if t in ("integer", "float", "binary"):
+                type = t
+            elif t == "bytes":
+                type = "binary"
+        if self.size == None:
+            bits = {"integer": 8, "float": 64, "binary": None}[type]
+        elif type == "binary":
+            bits = self.size.value * 8
+        else:
+            bits = self.size.value
+        return (type, bits, "signed" in self.types, "little" in self.types)
+
+class Binary(Token):
+    Attributes = ["segments"]
+    
+    @classmethod
+    def fromParser(cls, s, loc, toks):
+        return cls(toks.asList(), loc=loc)
+    
+    def specs(self):
+        """Returns the specs of all segments."""
+        return tuple([segment.spec() for segment in self.segments])
+
 class UnaryOp(Token):
     Attributes = ["op", "expr"]
     
@@ -146,7 +293,7 @@ class FunExpression(Token):
     
     @property
     def arity(self):
-        return len(self.args)
+        return len(self.clauses[0].args)
     
     @classmethod
     def fromParser(cls, s, loc, toks):
@@ -202,6 +349,32 @@ class ModuleAttribute(Token):
 class Module(Token):
     Attributes = ["attributes", "functions"]
     
+    @property
+    def name(self):
+        """The name declared by the `-module` attribute or `None`."""
+        for attr in self.attributes:
+            if attr.tag.name == "module" and len(attr.value) == 1 and isinstance(attr.value[0], Atom):
+                return attr.value[0].name
+        return None
+    
+    @property
+    def exports(self):
+        """
+        The set of `(name, arity)` tuples declared by `-export` attributes or
+        `None` if there are none, in which case all functions are exported.
+        """
+        exports = None
+        for attr in self.attributes:
+            if attr.tag.name != "export":
+                continue
+            if exports == None:
+                exports = set()
+            for value in attr.value:
+                for e in listElements(value) or []:
+                    if isinstance(e, BinaryOp) and e.op == "/" and isinstance(e.lexpr, Atom) and isinstance(e.rexpr, Integer):
+                        exports.add((e.lexpr.name, e.rexpr.value))
+        return exports
+    
     @classmethod
     def fromParser(cls, s, loc, toks):
         attrs = []
@@ -213,6 +386,41 @@ class Module(Token):
                 funs.append(x)
         return cls(attrs, funs, loc=loc)
 
+class VectorMap(Token):
+    """
+    Applies an arithmetic kernel (see :mod:`cpl.vector`) to every element of a
+    numeric list. `fallback` is the expression to evaluate instead if the list
+    is not numeric. Created by the vectorizer, not by the parser.
+    """
+    
+    Attributes = ["list", "kernel", "fallback"]
+
+class VectorFold(Token):
+    """
+    Folds a numeric list with `op` ("+" or "*") after applying an arithmetic
+    kernel to every element. `fallback` is the expression to evaluate instead if
+    the list is not numeric. Created by the vectorizer, not by the parser.
+    """
+    
+    Attributes = ["list", "init", "op", "kernel", "fallback"]
+
+class VectorizedFunction(Token):
+    """
+    A function declaration recognized as map (`kind` is "map") or fold (`kind`
+    is "fold") over a numeric list. The original `declaration` is kept for
+    lists which are not numeric. Created by the vectorizer, not by the parser.
+    """
+    
+    Attributes = ["kind", "op", "kernel", "declaration"]
+    
+    @property
+    def name(self):
+        return self.declaration.name
+    
+    @property
+    def arity(self):
+        return self.declaration.arity
+
 #=============================================================================#
 #                               Instruction set                               #
 #=============================================================================#
@@ -223,141 +431,1969 @@ class instrs(InstructionSet):
         Does not do anything. This is needed temporarily to add labels to
         following instructions on branching operations.
         """
+    
+    def jmp(target):
+        """Continues at the instruction labeled `target`."""
+    
+    def jmpf(target):
+        """
+        Pops a value and continues at the instruction labeled `target` if it
+        is the atom `false`.
+        """
+    
+    def ret():
+        """
+        Removes the frame of the current function and returns to the caller;
+        the result stays on the stack.
+        """
+    
+    def enter(arity, size):
+        """
+        Starts the frame of the function being called: pops its `arity`
+        arguments into the slots from 0 on (the last argument on top) and
+        reserves `size` slots in total.
+        """
+    
+    def fail(reason):
+        """Raises an error for the atom `reason`, e.g. "badmatch"."""
+    
+    def push(value):
+        """Pushes the constant `value`."""
+    
+    def pop():
+        """Removes the topmost value."""
+    
+    def dup():
+        """Pushes the topmost value again."""
+    
+    def load(reg):
+        """Pushes the value of the register `reg`."""
+    
+    def store(reg):
+        """Pops a value into the register `reg`."""
+    
+    def sload(slot):
+        """Pushes the value of the stack slot `slot` of the current frame."""
+    
+    def sstore(slot):
+        """Pops a value into the stack slot `slot` of the current frame."""
+    
+    def move(dst, src):
+        """Copies the register `src` to the register `dst`."""
+    
+    def spill(reg, slot):
+        """Stores the register `reg` in the stack slot `slot`."""
+    
+    def reload(slot, reg):
+        """Loads the stack slot `slot` into the register `reg`."""
+    
+    def call(target, arity):
+        """
+        Calls the local function labeled `target` with the topmost `arity`
+        values on the stack as arguments. The target is resolved through the
+        inline cache of the interpreter (see `Interpreter.resolveVMCall`). When
+        loading modules, it is bound to the version of the calling code.
+        """
+    
+    def callext(target, arity):
+        """
+        Like `call`, but for fully-qualified calls. The target always resolves
+        to the current version of its module, so this is where code running in
+        an old module version switches to a newly loaded one.
+        """
+    
+    def callfun(arity):
+        """
+        Pops a fun value and calls it with the topmost `arity` values on the
+        stack as arguments. The label of the fun's code is resolved through
+        the inline cache of the interpreter, so call sites which keep calling
+        closures of the same funs avoid the lookup.
+        """
+    
+    def mkclosure(target, arity, size):
+        """
+        Pops `size` captured values (the last slot's value on top) and pushes
+        a new closure of the fun labeled `target` taking `arity` arguments.
+        The closure is a flat environment record on the heap holding only
+        these values.
+        """
+    
+    def loadfun(target, arity):
+        """
+        Pushes the closure of the fun labeled `target` taking `arity`
+        arguments, which captures no variables. It is created once on first
+        use and shared afterwards.
+        """
+    
+    def envget(slot):
+        """
+        Pushes the value in slot `slot` of the environment record of the
+        closure which is currently running.
+        """
+    
+    def arith(op, left, right):
+        """
+        Pushes the result of the arithmetic operator `op` ("+", "-", "*", "/",
+        "div" or "mod") applied to two numbers. An operand is either read from
+        the register given by `left` or `right` or, if that is `None`, popped
+        from the stack; the right operand is on top. After observing the
+        operand types, the instruction may be quickened into one of the
+        specialized variants below (see :func:`specializedArithmetic`).
+        """
+    
+    def addi(left, right):
+        """
+        Integer variant of `arith` for "+". Both operands must be integers;
+        if they are not, the generic operation is done instead and the
+        instruction may be rewritten back to `arith`. The same applies to the
+        other specialized variants.
+        """
+    
+    def subi(left, right):
+        """Integer variant of `arith` for "-"."""
+    
+    def muli(left, right):
+        """Integer variant of `arith` for "*"."""
+    
+    def divi(left, right):
+        """Integer variant of `arith` for "div"."""
+    
+    def modi(left, right):
+        """Integer variant of `arith` for "mod"."""
+    
+    def addf(left, right):
+        """Float variant of `arith` for "+"."""
+    
+    def subf(left, right):
+        """Float variant of `arith` for "-"."""
+    
+    def mulf(left, right):
+        """Float variant of `arith` for "*"."""
+    
+    def divf(left, right):
+        """Float variant of `arith` for "/"."""
+    
+    def cmp(op, left, right):
+        """
+        Compares two values with the operator `op` ("<", ">", "=<", ">=", "=="
+        or "/=") in the term order and pushes the atom `true` or `false`.
+        Operands are given like for `arith`.
+        """
+    
+    def logic(op):
+        """
+        Pops two booleans and pushes the result of the operator `op` ("and" or
+        "or").
+        """
+    
+    def neg():
+        """Pops a number and pushes it negated."""
+    
+    def not_():
+        """Pops a boolean and pushes its negation."""
+    
+    def nil():
+        """Pushes the empty list."""
+    
+    def cons():
+        """Pops a tail and a head and pushes the list cell of both."""
+    
+    def mklist(size):
+        """
+        Pops `size` values (the last element on top) and pushes the proper
+        list of them.
+        """
+    
+    def mktuple(size):
+        """
+        Pops `size` values (the last element on top) and pushes the tuple of
+        them.
+        """
+    
+    def mconst(value, fail):
+        """
+        Pops a value and jumps to `fail` unless it is exactly equal to the
+        constant `value`.
+        """
+    
+    def mequal(fail):
+        """Pops two values and jumps to `fail` unless they are exactly equal."""
+    
+    def mtuple(size, fail):
+        """
+        Pops a value; if it is a tuple of `size` elements, pushes them with the
+        first element on top, otherwise jumps to `fail`.
+        """
+    
+    def mcons(fail):
+        """
+        Pops a value; if it is a non-empty list, pushes its tail and then its
+        head, otherwise jumps to `fail`.
+        """
+    
+    def mnil(fail):
+        """Pops a value and jumps to `fail` unless it is the empty list."""
+    
+    def bbuild(specs):
+        """
+        Pops one value per segment (the last segment's value on top) and
+        pushes a new binary built from them according to `specs` (see
+        :mod:`cpl.binary`).
+        """
+    
+    def bmatch(specs, fail):
+        """
+        Pops a binary and pushes the values of its segments according to
+        `specs`, the first segment's value first. Sub-binaries share the
+        buffer of the matched binary. If it does not match, pushes the binary
+        back and jumps to `fail`.
+        """
+    
+    def bslice():
+        """
+        Pops a length, an offset and a binary and pushes the sub-binary,
+        without copying.
+        """
+    
+    def bsize():
+        """Pops a binary and pushes its size in bytes."""
+    
+    def bop(op):
+        """
+        Pops two operands, integers or binaries, and pushes the result of the
+        bitwise operator `op` ("band", "bor", "bxor", "bsl" or "bsr").
+        """
+    
+    def bnot():
+        """Pops an integer or a binary and pushes its bitwise complement."""
+    
+    def bload():
+        """
+        Pops an asset path and pushes a binary with the contents of the file,
+        which is memory-mapped instead of read.
+        """
+    
+    def vconst(values):
+        """
+        Pushes the packed numeric list holding the numbers of the array
+        `values`, which must not be modified.
+        """
+    
+    def vpack():
+        """
+        Pops a list and pushes it as packed numeric list if its elements are
+        either all integers or all floats, otherwise pushes it back unchanged.
+        """
+    
+    def vop(op):
+        """
+        Pops two operands, each a packed numeric list or a number, and pushes
+        the result of applying the arithmetic operator `op` elementwise.
+        """
+    
+    def vmap(kernel, fallback):
+        """
+        Pops a list and pushes the packed list of the results of applying
+        `kernel` to each of its elements. If the list is not numeric or an
+        integer overflows, pushes the list back and jumps to `fallback`.
+        """
+    
+    def vfold(op, kernel, fallback):
+        """
+        Pops an accumulator and a list, applies `kernel` to each element of the
+        list and pushes the result of folding them into the accumulator with
+        `op`. If the list is not numeric or an integer overflows, pushes both
+        back and jumps to `fallback`.
+        """
 
 #=============================================================================#
 #                        Helper objects for compiling                         #
 #=============================================================================#
 
+def freeVariables(fun, bound):
+    """
+    Returns the names of the variables in `bound` which are referenced by the
+    fun expression `fun` or by funs nested in it, in order of occurrence.
+    Variables in the argument patterns of a fun clause shadow outer ones.
+    """
+    free = []
+    stack = [(fun, frozenset())]
+    while len(stack) > 0:
+        value, shadowed = stack.pop()
+        if isinstance(value, list):
+            stack.extend([(entry, shadowed) for entry in reversed(value)])
+        elif isinstance(value, Variable):
+            if value.name in bound and value.name not in shadowed and value.name not in free:
+                free.append(value.name)
+        elif isinstance(value, FunExpressionClause):
+            names = [token.name for token in iterTokens(value.args) if isinstance(token, Variable)]
+            stack.append((value.body, shadowed.union(names)))
+        elif isinstance(value, Token):
+            stack.extend([(getattr(value, name), shadowed) for name in reversed(value.Attributes)])
+    return free
+
+def variableOccurrences(clause, environment=(), funs=None, calls=None):
+    """
+    Returns the occurrences of variables in a function clause in evaluation
+    order as a list of `(name, definition)` tuples; `definition` is `True` for
+    the binding occurrence in a pattern. Nested funs are separate scopes, only
+    their references to variables of the clause are counted, as uses at the
+    position of the fun. The function of an application is evaluated after
+    its arguments.
+    
+    :param environment: the names of variables which are bound before the
+      clause, i.e. the ones captured by the fun of a fun clause
+    :param funs: if given, a `(fun, free)` tuple is appended to this list for
+      every fun directly nested in the clause, holding the names of the
+      variables it captures
+    :param calls: if given, this dictionary maps every function application
+      in the clause to the number of occurrences before the call is made
+    """
+    bound = set(environment)
+    occurrences = []
+    stack = [(clause.body, False)] + [(arg, True) for arg in reversed(clause.args)]
+    while len(stack) > 0:
+        value, pattern = stack.pop()
+        if pattern == "call":
+            if calls != None:
+                calls[value] = len(occurrences)
+        elif isinstance(value, list):
+            stack.extend([(entry, pattern) for entry in reversed(value)])
+        elif isinstance(value, Variable):
+            if value.name == "_":
+                continue
+            if pattern and value.name not in bound:
+                bound.add(value.name)
+                occurrences.append((value.name, True))
+            else:
+                occurrences.append((value.name, False))
+        elif isinstance(value, Assignment) and not pattern:
+            stack.append((value.pattern, True))
+            stack.append((value.expr, False))
+        elif isinstance(value, CaseExpressionClause):
+            stack.append((value.body, False))
+            stack.append((value.pattern, True))
+        elif isinstance(value, FunApplExpression):
+            stack.append((value, "call"))
+            stack.append((value.fun, False))
+            stack.append((value.args, False))
+        elif isinstance(value, FunExpression):
+            captured = freeVariables(value, bound)
+            occurrences.extend([(name, False) for name in captured])
+            if funs != None:
+                funs.append((value, captured))
+        elif isinstance(value, Token):
+            stack.extend([(getattr(value, name), pattern) for name in reversed(value.Attributes)])
+    return occurrences
+
+def liveIntervals(occurrences):
+    """
+    Returns the live intervals `(start, end, name)` of the variables in the
+    given occurrences, from the first to the last occurrence.
+    """
+    intervals = {}
+    for i, (name, definition) in enumerate(occurrences):
+        if intervals.has_key(name):
+            intervals[name][1] = i
+        else:
+            intervals[name] = [i, i]
+    return sorted([(start, end, name) for name, (start, end) in intervals.iteritems()])
+
+def linearScan(intervals, registers):
+    """
+    Assigns the variables of the given live intervals to `registers`
+    registers. Where there are not enough, the variables living longest are
+    spilled to stack slots. Returns a dictionary mapping variable names to
+    `("reg", n)` or `("stack", n)`.
+    """
+    locations = {}
+    free = range(registers - 1, -1, -1)
+    active = []
+    slots = 0
+    for start, end, name in intervals:
+        while len(active) > 0 and active[0][0] < start:
+            free.append(active.pop(0)[2])
+        if len(free) > 0:
+            register = free.pop()
+            locations[name] = ("reg", register)
+            insort(active, (end, name, register))
+            continue
+        if len(active) > 0 and active[-1][0] > end:
+            spillEnd, spillName, register = active.pop()
+            locations[spillName] = ("stack", slots)
+            locations[name] = ("reg", register)
+            insort(active, (end, name, register))
+        else:
+            locations[name] = ("stack", slots)
+        slots += 1
+    return locations
+
+class RegisterAllocation(object):
+    """
+    Holds the locations of the variables of every function clause, assigned
+    by liveness analysis and linear scan allocation to a fixed number of
+    registers. Code functions look up where a variable lives with `location`.
+    With no registers, all variables live on the stack.
+    
+    Registers are not preserved by calls. Code functions save the registers
+    returned by `liveAcross` in the frame before a call and reload them
+    afterwards.
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self, registers=0):
+        self.registers = registers
+        self.clauses = {}
+        self.occurrences = {}
+        self.intervals = {}
+        self.calls = {}
+    
+    def allocate(self, parse_tree, environments={}):
+        """
+        Allocates the variables of all function clauses in the tree.
+        `environments` maps fun clauses to the names of the variables they
+        capture (see `ClosureConversion.environments`); these live in the
+        closure and are not allocated.
+        """
+        for token in iterTokens(parse_tree):
+            if isinstance(token, (FunDeclClause, FunExpressionClause)):
+                environment = environments.get(token, ())
+                calls = {}
+                occurrences = variableOccurrences(token, environment, calls=calls)
+                intervals = [i for i in liveIntervals(occurrences) if i[2] not in environment]
+                self.occurrences[token] = occurrences
+                self.intervals[token] = intervals
+                self.calls[token] = calls
+                self.clauses[token] = linearScan(intervals, self.registers)
+    
+    def location(self, clause, name):
+        """
+        Returns the location of the variable `name` in `clause`: either
+        `("reg", n)` or `("stack", n)`.
+        """
+        return self.clauses[clause][name]
+    
+    def stackSlots(self, clause):
+        """Returns the number of stack slots used by the variables of `clause`."""
+        return max([n + 1 for kind, n in self.clauses[clause].itervalues() if kind == "stack"] or [0])
+    
+    def hasCalls(self, clause):
+        """Checks whether `clause` calls functions itself, not only in funs."""
+        return len(self.calls[clause]) > 0
+    
+    def liveAcross(self, clause, call):
+        """
+        Returns `(register, name)` tuples for the variables of `clause` in
+        registers which are bound before the function application `call` and
+        used after it, ordered by register.
+        """
+        position = self.calls[clause][call]
+        locations = self.clauses[clause]
+        live = []
+        for start, end, name in self.intervals[clause]:
+            if start < position <= end and locations[name][0] == "reg":
+                live.append((locations[name][1], name))
+        return sorted(live)
+    
+    def stats(self):
+        """
+        Returns a dictionary with the number of `variables`, of `spilled`
+        variables and of `stack_accesses`, the occurrences of variables which
+        live on the stack and need to be moved.
+        """
+        variables = 0
+        spilled = 0
+        accesses = 0
+        for clause, locations in self.clauses.iteritems():
+            variables += len(locations)
+            spilled += len([l for l in locations.itervalues() if l[0] == "stack"])
+            accesses += len([n for n, d in self.occurrences[clause] if locations.has_key(n) and locations[n][0] == "stack"])
+        return {"variables": variables, "spilled": spilled, "stack_accesses": accesses}
+
+class ClosureConversion(object):
+    """
+    Holds the closure layout of every fun expression: the label of its code
+    and the names of the variables it captures. A closure is a flat record on
+    the heap with one slot per captured variable in that order (see
+    `cpl.interpreter_base.Closure`), so it keeps alive only the values it
+    needs, not the frames they came from. Funs nested in funs capture through
+    the environment of the enclosing fun.
+    
+    Funs which capture nothing are hoisted: they are created only once, as a
+    shared constant, instead of being allocated every time the expression is
+    evaluated.
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.funs = {}
+        self.environments = {}
+        self.constants = []
+    
+    def convert(self, parse_tree):
+        """Lays out the closures of all fun expressions in the tree."""
+        for token in iterTokens(parse_tree):
+            if isinstance(token, (FunDeclClause, FunExpressionClause)):
+                funs = []
+                variableOccurrences(token, self.environments.get(token, ()), funs)
+                for fun, captured in funs:
+                    label = instructionLabel.new()
+                    self.funs[fun] = (label, captured)
+                    for clause in fun.clauses:
+                        self.environments[clause] = captured
+                    if len(captured) == 0:
+                        self.constants.append((label, fun))
+    
+    def closure(self, fun):
+        """
+        Returns a tuple `(label, captured)` for the fun expression `fun`. If
+        `captured` is empty, the fun is a constant (see `constants`).
+        """
+        return self.funs[fun]
+    
+    def slot(self, clause, name):
+        """
+        Returns the environment slot of the variable `name` in the fun clause
+        `clause` or `None` if it is not captured.
+        """
+        environment = self.environments.get(clause, ())
+        if name in environment:
+            return environment.index(name)
+        return None
+    
+    def stats(self):
+        """
+        Returns a dictionary with the number of `closures` allocated at
+        runtime, of `hoisted_funs` and of `captured_variables`.
+        """
+        captured = sum(len(c) for label, c in self.funs.itervalues())
+        return {"closures": len(self.funs) - len(self.constants), "hoisted_funs": len(self.constants), "captured_variables": captured}
+
+arithmeticOperators = set(["+", "-", "*", "/", "div", "mod"])
+
+#: Maps `(op, type)` to the instruction specialized for operands of that type.
+specializedInstructions = {
+    ("+", "int"): "addi",
+    ("-", "int"): "subi",
+    ("*", "int"): "muli",
+    ("div", "int"): "divi",
+    ("mod", "int"): "modi",
+    ("+", "float"): "addf",
+    ("-", "float"): "subf",
+    ("*", "float"): "mulf",
+    ("/", "float"): "divf",
+}
+
+segmentTypes = {"integer": "int", "float": "float"}
+
+def arithmeticType(op, ltype, rtype):
+    """
+    Returns the type ("int" or "float") of the result of the arithmetic
+    operator `op` for operands of the given types, or `None` if unknown.
+    """
+    if ltype == None or rtype == None:
+        return None
+    if op == "/":
+        return "float"
+    if ltype == "int" and rtype == "int":
+        return "int"
+    if op in ("div", "mod"):
+        return None
+    return "float"
+
+def expressionType(expr, types, exprTypes):
+    """
+    Returns the type of `expr` given the types of variables and of already
+    typed arithmetic expressions, or `None` if unknown.
+    """
+    while isinstance(expr, UnaryOp) and expr.op in ("+", "-"):
+        expr = expr.expr
+    if isinstance(expr, Integer):
+        return "int"
+    elif isinstance(expr, Float):
+        return "float"
+    elif isinstance(expr, Variable):
+        return types.get(expr.name)
+    elif isinstance(expr, BinaryOp):
+        return exprTypes.get(expr)
+    return None
+
+def operandType(value):
+    """Returns "int" or "float" for a number or `None` for other values."""
+    if isinstance(value, bool):
+        return None
+    elif isinstance(value, (int, long)):
+        return "int"
+    elif isinstance(value, float):
+        return "float"
+    return None
+
+def specializedArithmetic(op, a, b):
+    """
+    Returns the name of the instruction specialized for applying the
+    arithmetic operator `op` to the operand values `a` and `b`, or `None` if
+    there is none. Handlers of `arith` use this for quickening.
+    """
+    t = operandType(a)
+    if t == None or t != operandType(b):
+        return None
+    return specializedInstructions.get((op, t))
+
+class NumericTyping(object):
+    """
+    Infers statically which variables of a function clause always hold
+    integers or floats, from number literals, arithmetic expressions and
+    binary segment patterns. Every arithmetic expression is assigned either a
+    specialized instruction like `addi` or the generic `arith`; code functions
+    look it up with `instruction`.
+    
+    Variables bound in several places (e.g. in different case clauses) only
+    get a type if all bindings agree. Variables captured by funs are untyped.
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.clauses = {}
+        self.operations = {}
+    
+    def infer(self, parse_tree):
+        """Infers the types of all function clauses in the tree."""
+        for token in iterTokens(parse_tree):
+            if isinstance(token, (FunDeclClause, FunExpressionClause)):
+                self.clauses[token] = self.inferClause(token)
+    
+    def inferClause(self, clause):
+        types = {}
+        exprTypes = {}
+        stack = [(clause.body, False)] + [(arg, True) for arg in reversed(clause.args)]
+        while len(stack) > 0:
+            value, pattern = stack.pop()
+            if pattern == "bind":
+                self.bind(types, value.pattern.name, expressionType(value.expr, types, exprTypes))
+            elif pattern == "arith":
+                ltype = expressionType(value.lexpr, types, exprTypes)
+                rtype = expressionType(value.rexpr, types, exprTypes)
+                exprTypes[value] = arithmeticType(value.op, ltype, rtype)
+                self.operations[value] = specializedInstructions.get((value.op, ltype), "arith") if ltype == rtype else "arith"
+            elif isinstance(value, list):
+                stack.extend([(entry, pattern) for entry in reversed(value)])
+            elif isinstance(value, Variable):
+                if pattern and value.name != "_":
+                    self.bind(types, value.name, None)
+            elif pattern and isinstance(value, BinarySegment) and isinstance(value.value, Variable):
+                self.bind(types, value.value.name, segmentTypes.get(value.spec()[0]))
+            elif isinstance(value, Assignment) and not pattern:
+                if isinstance(value.pattern, Variable):
+                    stack.append((value, "bind"))
+                else:
+                    stack.append((value.pattern, True))
+                stack.append((value.expr, False))
+            elif isinstance(value, BinaryOp) and not pattern and value.op in arithmeticOperators:
+                stack.append((value, "arith"))
+                stack.append((value.rexpr, False))
+                stack.append((value.lexpr, False))
+            elif isinstance(value, CaseExpressionClause):
+                stack.append((value.body, False))
+                stack.append((value.pattern, True))
+            elif isinstance(value, FunExpression):
+                # Separate scope, inferred on its own
+                continue
+            elif isinstance(value, Token):
+                stack.extend([(getattr(value, name), pattern) for name in reversed(value.Attributes)])
+        return dict((name, t) for name, t in types.iteritems() if t != None)
+    
+    def bind(self, types, name, type):
+        types[name] = type if types.get(name, type) == type else None
+    
+    def variableType(self, clause, name):
+        """Returns the type of the variable `name` in `clause` or `None`."""
+        return self.clauses[clause].get(name)
+    
+    def instruction(self, expr):
+        """
+        Returns the name of the instruction for the arithmetic expression
+        `expr`, a specialized one or "arith".
+        """
+        return self.operations.get(expr, "arith")
+    
+    def stats(self):
+        """
+        Returns a dictionary with the number of `specialized_operations` and
+        of `generic_operations`.
+        """
+        specialized = len([name for name in self.operations.itervalues() if name != "arith"])
+        return {"specialized_operations": specialized, "generic_operations": len(self.operations) - specialized}
+
 #=============================================================================#
 #                              Code functions                                 #
 #=============================================================================#
 
+class CompileContext(threading.local):
+    """
+    The analyses of the current compiling pass, which the code functions
+    consult. Like the label counter of `InstructionLabel`, they are kept per
+    thread, so compiling passes can run concurrently.
+    
+    `registers`
+        The :class:`RegisterAllocation` of the pass.
+    
+    `closures`
+        The :class:`ClosureConversion` of the pass.
+    
+    `types`
+        The :class:`NumericTyping` of the pass.
+    """
+    
+    def __init__(self):
+        self.registers = RegisterAllocation()
+        self.closures = ClosureConversion()
+        self.types = NumericTyping()
+
 instructionLabel = InstructionLabel()
+context = CompileContext()
 
-#=============================================================================#
-#                               Optimization                                  #
-#=============================================================================#
+class CompileError(Exception):
+    """
+    Raised if the code for a parse tree cannot be generated, e.g. because it
+    uses an unbound variable.
+    """
 
-Optimizer = newOptimizerBase()
+comparisonOperators = set(["<", ">", "=<", ">=", "==", "/="])
+bitwiseOperators = set(["band", "bor", "bxor", "bsl", "bsr"])
+booleanOperators = set(["and", "or"])
 
-#=============================================================================#
-#                                  Parser                                     #
-#=============================================================================#
+#: Operators whose operands may be read from registers directly.
+operandOperators = arithmeticOperators | comparisonOperators
 
-lparen = Suppress("(")
-rparen = Suppress(")")
-reserved = "and andalso band bnot bor bsl bsr bxor case div end fun if not of or orelse when xor".split()
-reserved = reduce(operator.or_, map(Keyword, reserved))
+#: Tokens which are evaluated without calls or bindings.
+simpleTokens = (Integer, Float, Atom, Variable, UnaryOp, BinaryOp, EmptyList, PackedList)
 
-simple_atom = (NotAny(reserved).suppress() + Regex(r'[a-z][a-zA-Z0-9_]*'))
-quoted_atom = (Suppress("'") + Regex(r'[a-zA-Z0-9_ ]+') + Suppress("'"))
+class CodeBuffer(object):
+    """
+    Collects the instructions generated for a module. A label is put onto the
+    next emitted instruction, so no `nop` is executed at branch targets;
+    labels placed at the same position as an earlier one are replaced by it
+    in `finish`. The code raising errors for failed matches is collected in
+    `errors` and emitted at the end of each function, the fun expressions
+    whose code is still to be generated in `funs`. `redirects` maps function
+    labels to the labels calls are generated to instead.
+    """
+    
+    def __init__(self, module):
+        self.module = module
+        self.instructions = []
+        self.errors = []
+        self.funs = []
+        self.redirects = {}
+        self.__label = None
+        self.__aliases = {}
+    
+    def emit(self, instr, token=None):
+        """Appends `instr`, taking its source location from `token`."""
+        if token != None and instr.loc == None:
+            instr.loc = token.loc
+        if self.__label != None:
+            instr.label = self.__label
+            self.__label = None
+        self.instructions.append(instr)
+    
+    def place(self, label):
+        """Puts `label` onto the next emitted instruction."""
+        if self.__label != None:
+            self.__aliases[label] = self.__label
+        else:
+            self.__label = label
+    
+    def error(self, reason):
+        """Returns the label of new code raising an error for `reason`."""
+        label = instructionLabel.new()
+        self.errors.append((label, reason))
+        return label
+    
+    def emitErrors(self):
+        """Emits the error code collected since the last call."""
+        for label, reason in self.errors:
+            self.place(label)
+            self.emit(instrs.fail(reason))
+        self.errors = []
+    
+    def finish(self):
+        """Returns the instructions with the jumps to replaced labels retargeted."""
+        aliases = self.__aliases
+        if len(aliases) == 0:
+            return self.instructions
+        instructions = []
+        for instr in self.instructions:
+            indexes = [i for i in semantics.targetArgs(instr) if aliases.has_key(instr.args[i])]
+            if len(indexes) > 0:
+                args = list(instr.args)
+                for i in indexes:
+                    args[i] = aliases[args[i]]
+                instr = Instruction(instr.name, *args, label=instr.label, loc=instr.loc)
+            instructions.append(instr)
+        return instructions
+
+class Failure(object):
+    """
+    The labels where the code continues if a pattern does not match, by the
+    number of values left on the stack. If `reason` is given, a failed match
+    raises an error for it. Otherwise the code emitted by `emit` pops the
+    values and continues with the next alternative, which follows it.
+    """
+    
+    def __init__(self, code, reason=None):
+        self.code = code
+        self.reason = reason
+        self.labels = {}
+    
+    def label(self, depth):
+        """Returns the label to jump to with `depth` values left."""
+        if self.reason != None:
+            depth = 0
+        label = self.labels.get(depth)
+        if label == None:
+            label = self.code.error(self.reason) if self.reason != None else instructionLabel.new()
+            self.labels[depth] = label
+        return label
+    
+    def emit(self):
+        """Emits the code popping the values left by failed matches."""
+        if self.reason != None or len(self.labels) == 0:
+            return
+        for depth in xrange(max(self.labels), 0, -1):
+            if self.labels.has_key(depth):
+                self.code.place(self.labels[depth])
+            self.code.emit(instrs.pop())
+        if self.labels.has_key(0):
+            self.code.place(self.labels[0])
+
+class ClauseEnvironment(object):
+    """
+    The state of generating code for a clause of a function or fun: where its
+    variables live, which of them are bound at the current position and the
+    `failure` labels of the pattern being matched.
+    
+    A frame holds the arguments in the slots from 0 on, followed by the
+    variables allocated to the stack and the slots registers are saved in
+    around calls. Variables bound to a whole argument which are allocated to
+    the stack stay in the slot of the argument. Variables captured by a fun
+    are read from its closure.
+    """
+    
+    def __init__(self, clause, code):
+        self.clause = clause
+        self.code = code
+        self.arity = len(clause.args)
+        self.bound = set(context.closures.environments.get(clause, ()))
+        self.failure = None
+        self.stackSlots = context.registers.stackSlots(clause)
+        self.arguments = {}
+        seen = set()
+        for i, arg in enumerate(clause.args):
+            if isinstance(arg, Variable) and arg.name not in seen and arg.name not in self.bound:
+                self.arguments[arg.name] = i
+            seen.update([token.name for token in iterTokens(arg) if isinstance(token, Variable)])
+    
+    def size(self):
+        """Returns the number of frame slots the clause needs."""
+        size = self.arity + self.stackSlots
+        if context.registers.hasCalls(self.clause):
+            size += context.registers.registers
+        return size
+    
+    def location(self, name):
+        """
+        Returns the location of the variable `name`: `("reg", n)` for a
+        register, `("slot", n)` for a frame slot or `("env", n)` for a slot
+        of the closure.
+        """
+        slot = context.closures.slot(self.clause, name)
+        if slot != None:
+            return ("env", slot)
+        kind, n = context.registers.location(self.clause, name)
+        if kind == "reg":
+            return ("reg", n)
+        if self.arguments.has_key(name):
+            return ("slot", self.arguments[name])
+        return ("slot", self.arity + n)
+    
+    def saveSlot(self, register, name):
+        """
+        Returns the frame slot the register holding the variable `name` is
+        saved in around calls. Variables are bound only once, so a variable
+        bound to a whole argument is still in the slot of the argument.
+        """
+        if self.arguments.has_key(name):
+            return self.arguments[name]
+        return self.arity + self.stackSlots + register
+
+def isSimple(expr):
+    """Checks whether `expr` is evaluated without calls or bindings."""
+    for token in iterTokens(expr):
+        if not isinstance(token, simpleTokens):
+            return False
+    return True
+
+def registerOperand(expr, env):
+    """Returns the register of `expr` if it is a variable living in one."""
+    if isinstance(expr, Variable) and expr.name in env.bound:
+        kind, n = env.location(expr.name)
+        if kind == "reg":
+            return n
+    return None
+
+def code_P(module):
+    """
+    Generates the code of a module: the code of each function, starting with
+    its function label (see :func:`funLabel`).
+    """
+    if not isinstance(module, Module):
+        raise CompileError("only modules can be compiled")
+    code = CodeBuffer(module.name or instructionLabel.namespace or "")
+    for decl in module.functions:
+        code_F(decl, code)
+    return code.finish()
+
+def code_F(decl, code):
+    """
+    Generates the code of the function declaration `decl`. A vectorized
+    function starts with its bulk instruction, which continues with the code
+    of the original declaration if the list is not numeric; the recursive
+    calls in there go to the original code directly.
+    """
+    label = funLabel(code.module, decl.name.name, decl.arity)
+    code.place(label)
+    if isinstance(decl, VectorizedFunction):
+        original = instructionLabel.new()
+        if decl.kind == "map":
+            code.emit(instrs.vmap(decl.kernel, original), decl)
+        else:
+            code.emit(instrs.vfold(decl.op, decl.kernel, original), decl)
+        code.emit(instrs.ret(), decl)
+        code.place(original)
+        code.redirects = {label: original}
+        decl = decl.declaration
+    code_clauses(decl.clauses, code, "function_clause", decl)
+    while len(code.funs) > 0:
+        code_fun(code.funs.pop(0), code)
+    code.redirects = {}
+
+def code_fun(fun, code):
+    """
+    Generates the code of the fun expression `fun`, starting with the label
+    of its closure (see :class:`ClosureConversion`).
+    """
+    label, captured = context.closures.closure(fun)
+    code.place(label)
+    code_clauses(fun.clauses, code, "function_clause", fun)
 
-atom = (quoted_atom | simple_atom).setParseAction(Atom.fromParser).setName("atom")
-var = Regex(r'[A-Z_][a-zA-Z0-9_]*').setParseAction(Variable.fromParser).setName("variable")
-number = (Regex(r'-?([1-9][0-9]*|0)') + Optional(Regex(r'\.[0-9]+'))).setParseAction(numberFromParser).setName("number")
+def code_clauses(clauses, code, reason, token):
+    """
+    Generates the code entering the frame and trying the clauses one after
+    the other. An error for `reason` is raised if none matches.
+    """
+    envs = [ClauseEnvironment(clause, code) for clause in clauses]
+    code.emit(instrs.enter(envs[0].arity, max([env.size() for env in envs])), token)
+    for i, env in enumerate(envs):
+        env.failure = Failure(code, reason if i == len(envs) - 1 else None)
+        for j, pattern in enumerate(env.clause.args):
+            code_A(pattern, j, env)
+        code_B(env.clause.body, env)
+        code.emit(instrs.ret(), env.clause)
+        env.failure.emit()
+    code.emitErrors()
+
+def code_A(pattern, i, env):
+    """Generates code matching the argument `i` against `pattern`."""
+    code = env.code
+    if isinstance(pattern, Variable) and pattern.name not in env.bound:
+        if pattern.name == "_":
+            return
+        location = env.location(pattern.name)
+        if location == ("slot", i):
+            env.bound.add(pattern.name)
+            return
+        if location[0] == "reg":
+            code.emit(instrs.reload(i, location[1]), pattern)
+            env.bound.add(pattern.name)
+            return
+    code.emit(instrs.sload(i), pattern)
+    code_M(pattern, env, 1)
+
+def code_B(body, env):
+    """Generates code evaluating `body`, leaving the value of the last expression."""
+    for expr in body[:-1]:
+        code_E(expr, env)
+    code_V(body[-1], env)
+
+def code_E(expr, env):
+    """Generates code evaluating `expr` for its effects only."""
+    if isinstance(expr, Assignment):
+        code_assignment(expr, env, False)
+    else:
+        code_V(expr, env)
+        env.code.emit(instrs.pop(), expr)
+
+def code_V(expr, env):
+    """Generates code pushing the value of `expr`."""
+    emit = env.code.emit
+    if isinstance(expr, (Integer, Float)):
+        emit(instrs.push(expr.value), expr)
+    elif isinstance(expr, Atom):
+        emit(instrs.push(expr.name), expr)
+    elif isinstance(expr, Variable):
+        code_variable(expr, env)
+    elif isinstance(expr, PackedTuple):
+        emit(instrs.push(tuple(expr.values)), expr)
+    elif isinstance(expr, Tuple):
+        for element in expr.elements:
+            code_V(element, env)
+        emit(instrs.mktuple(len(expr.elements)), expr)
+    elif isinstance(expr, EmptyList):
+        emit(instrs.nil(), expr)
+    elif isinstance(expr, PackedList):
+        emit(instrs.vconst(expr.values), expr)
+    elif isinstance(expr, FlatList):
+        for element in expr.elements:
+            code_V(element, env)
+        emit(instrs.mklist(len(expr.elements)), expr)
+    elif isinstance(expr, List):
+        cells = []
+        while isinstance(expr, List):
+            cells.append(expr)
+            code_V(expr.head, env)
+            expr = expr.tail
+        code_V(expr, env)
+        for cell in reversed(cells):
+            emit(instrs.cons(), cell)
+    elif isinstance(expr, Binary):
+        for segment in expr.segments:
+            code_V(segment.value, env)
+        emit(instrs.bbuild(expr.specs()), expr)
+    elif isinstance(expr, UnaryOp):
+        code_V(expr.expr, env)
+        if expr.op == "-":
+            emit(instrs.neg(), expr)
+        elif expr.op == "not":
+            emit(instrs.not_(), expr)
+        elif expr.op == "bnot":
+            emit(instrs.bnot(), expr)
+    elif isinstance(expr, BinaryOp):
+        code_operators(expr, env)
+    elif isinstance(expr, Assignment):
+        code_assignment(expr, env, True)
+    elif isinstance(expr, FunApplExpression):
+        code_call(expr, env)
+    elif isinstance(expr, CaseExpression):
+        code_case(expr, env)
+    elif isinstance(expr, (VectorMap, VectorFold)):
+        code_vector(expr, env)
+    elif isinstance(expr, FunExpression):
+        code_closure(expr, env)
+    else:
+        raise CompileError("cannot generate code for %s" % (expr.tokenName()))
 
-fun_name = (Optional((quoted_atom | simple_atom) + Suppress(":"), default="") + (quoted_atom | simple_atom)).setParseAction(FunName.fromParser).setName("fun_name")
+def code_vector(expr, env):
+    """
+    Generates code for a `VectorMap` or `VectorFold`: the bulk instruction
+    and the fallback for lists which are not numeric. The fallback evaluates
+    the operands again, so the bulk instruction is only used if they are
+    simple (see :func:`isSimple`).
+    """
+    code = env.code
+    if isinstance(expr, VectorMap):
+        operands = [expr.list]
+    else:
+        operands = [expr.list, expr.init]
+    if not all([isSimple(operand) for operand in operands]):
+        code_V(expr.fallback, env)
+        return
+    
+    for operand in operands:
+        code_V(operand, env)
+    fallback = instructionLabel.new()
+    end = instructionLabel.new()
+    if isinstance(expr, VectorMap):
+        code.emit(instrs.vmap(expr.kernel, fallback), expr)
+    else:
+        code.emit(instrs.vfold(expr.op, expr.kernel, fallback), expr)
+    code.emit(instrs.jmp(end), expr)
+    code.place(fallback)
+    for operand in operands:
+        code.emit(instrs.pop(), expr)
+    code_V(expr.fallback, env)
+    code.place(end)
+
+def code_variable(var, env):
+    """Generates code pushing the value of the variable `var`."""
+    if var.name not in env.bound:
+        raise CompileError("variable %s is unbound" % (var.name))
+    kind, n = env.location(var.name)
+    if kind == "reg":
+        env.code.emit(instrs.load(n), var)
+    elif kind == "slot":
+        env.code.emit(instrs.sload(n), var)
+    else:
+        env.code.emit(instrs.envget(n), var)
 
-term = Forward().setName("term")
+def code_closure(fun, env):
+    """
+    Generates code pushing the closure of the fun expression `fun`: the
+    shared one if it captures nothing, a new one with the values of the
+    captured variables otherwise. The code of the fun is generated after the
+    current function.
+    """
+    label, captured = context.closures.closure(fun)
+    env.code.funs.append(fun)
+    if len(captured) == 0:
+        env.code.emit(instrs.loadfun(label, fun.arity), fun)
+        return
+    for name in captured:
+        code_variable(Variable(name, loc=fun.loc), env)
+    env.code.emit(instrs.mkclosure(label, fun.arity, len(captured)), fun)
+
+def code_operators(expr, env):
+    """
+    Generates code for a binary operator expression. Chains of operators
+    nested on the left, like the ones created by `BinaryOp.fromParser`, are
+    generated without recursion. The left operand of the first operator is
+    read from its register only if the right one cannot change registers.
+    """
+    chain = []
+    while isinstance(expr, BinaryOp):
+        chain.append(expr)
+        expr = expr.lexpr
+    chain.reverse()
+    left = None
+    if chain[0].op in operandOperators and isSimple(chain[0].rexpr):
+        left = registerOperand(expr, env)
+    if left == None:
+        code_V(expr, env)
+    for op in chain:
+        code_operator(op, left, env)
+        left = None
+
+def code_operator(expr, left, env):
+    """
+    Generates code applying the operator of `expr` to the value on the stack
+    (or in register `left`) and its right operand.
+    """
+    emit = env.code.emit
+    op = expr.op
+    right = None
+    if op in operandOperators:
+        right = registerOperand(expr.rexpr, env)
+    if right == None:
+        code_V(expr.rexpr, env)
+    if op in arithmeticOperators:
+        name = context.types.instruction(expr)
+        if name == "arith":
+            emit(instrs.arith(op, left, right), expr)
+        else:
+            emit(getattr(instrs, name)(left, right), expr)
+    elif op in comparisonOperators:
+        emit(instrs.cmp(op, left, right), expr)
+    elif op in bitwiseOperators:
+        emit(instrs.bop(op), expr)
+    elif op in booleanOperators:
+        emit(instrs.logic(op), expr)
+    else:
+        raise CompileError("unknown operator %s" % (op))
 
-tuple = (Suppress("{") + Optional(delimitedList(term)) + Suppress("}")).setParseAction(Tuple.fromParser).setName("tuple")
-list = (Suppress("[") + Optional(delimitedList(term)) + Optional(Suppress("|") + term, default=None) + Suppress("]")).setParseAction(List.fromParser).setName("list")
+def code_assignment(expr, env, value):
+    """
+    Generates code matching the value of `expr.expr` against `expr.pattern`.
+    If `value` is `True`, the value is left on the stack.
+    """
+    pattern = expr.pattern
+    if not value and isinstance(pattern, Variable) and pattern.name != "_" and pattern.name not in env.bound:
+        source = registerOperand(expr.expr, env)
+        location = env.location(pattern.name)
+        if source != None and location[0] == "reg":
+            env.code.emit(instrs.move(location[1], source), expr)
+            env.bound.add(pattern.name)
+            return
+    code_V(expr.expr, env)
+    if value:
+        env.code.emit(instrs.dup(), expr)
+    failure = env.failure
+    env.failure = Failure(env.code, "badmatch")
+    code_M(pattern, env, 1)
+    env.failure = failure
+
+def code_call(call, env):
+    """
+    Generates code calling a function. The registers holding variables
+    which are used after the call are saved in the frame around it, unless
+    the variables are arguments, which are in the frame already.
+    """
+    code = env.code
+    for arg in call.args:
+        code_V(arg, env)
+    saved = [(register, env.saveSlot(register, name)) for register, name in context.registers.liveAcross(env.clause, call)]
+    for register, slot in saved:
+        if slot >= env.arity:
+            code.emit(instrs.spill(register, slot), call)
+    fun = call.fun
+    arity = len(call.args)
+    if not isinstance(fun, FunName):
+        code_variable(fun, env)
+        code.emit(instrs.callfun(arity), call)
+    elif fun.module in ("", code.module):
+        label = funLabel(code.module, fun.name, arity)
+        code.emit(instrs.call(code.redirects.get(label, label), arity), call)
+    else:
+        code.emit(instrs.callext(funLabel(fun.module, fun.name, arity), arity), call)
+    for register, slot in saved:
+        code.emit(instrs.reload(slot, register), call)
 
-term << (number | atom | list | tuple)
+def code_case(expr, env):
+    """
+    Generates code for a case expression. Every clause but the last matches
+    a copy of the value, so it is still there for the next one. Variables
+    are bound after the expression if all clauses bind them.
+    """
+    code = env.code
+    code_V(expr.expr, env)
+    end = instructionLabel.new()
+    before = env.bound
+    after = None
+    outer = env.failure
+    for i, clause in enumerate(expr.clauses):
+        last = i == len(expr.clauses) - 1
+        env.bound = set(before)
+        if last:
+            failure = env.failure = Failure(code, "case_clause")
+        else:
+            failure = env.failure = Failure(code)
+            code.emit(instrs.dup(), clause)
+        code_M(clause.pattern, env, 1)
+        env.failure = outer
+        if not last:
+            code.emit(instrs.pop(), clause)
+        code_B(clause.body, env)
+        after = env.bound if after == None else after & env.bound
+        if not last:
+            code.emit(instrs.jmp(end), clause)
+            failure.emit()
+    code.place(end)
+    env.bound = after
+
+def code_M(pattern, env, depth):
+    """
+    Generates code matching the topmost value against `pattern` and binding
+    the variables in it; the value is popped. `depth` is the number of values
+    on the stack taking part in the match, including this one. On failure,
+    the code continues at the label of `env.failure` for the values left.
+    """
+    code = env.code
+    fail = env.failure.label
+    while isinstance(pattern, (List, FlatList)):
+        if isinstance(pattern, FlatList):
+            pattern = pattern.toCons()
+            continue
+        code.emit(instrs.mcons(fail(depth - 1)), pattern)
+        code_M(pattern.head, env, depth + 1)
+        pattern = pattern.tail
+    
+    if isinstance(pattern, Variable):
+        if pattern.name == "_":
+            code.emit(instrs.pop(), pattern)
+        elif pattern.name in env.bound:
+            code_variable(pattern, env)
+            code.emit(instrs.mequal(fail(depth - 1)), pattern)
+        else:
+            code_bind(pattern, env)
+    elif isinstance(pattern, (Integer, Float)):
+        code.emit(instrs.mconst(pattern.value, fail(depth - 1)), pattern)
+    elif isinstance(pattern, Atom):
+        code.emit(instrs.mconst(pattern.name, fail(depth - 1)), pattern)
+    elif isinstance(pattern, Tuple):
+        elements = pattern.elements
+        code.emit(instrs.mtuple(len(elements), fail(depth - 1)), pattern)
+        for i, element in enumerate(elements):
+            code_M(element, env, depth - 1 + len(elements) - i)
+    elif isinstance(pattern, EmptyList):
+        code.emit(instrs.mnil(fail(depth - 1)), pattern)
+    elif isinstance(pattern, Binary):
+        segments = pattern.segments
+        code.emit(instrs.bmatch(pattern.specs(), fail(depth)), pattern)
+        for i, segment in enumerate(reversed(segments)):
+            code_M(segment.value, env, depth - 1 + len(segments) - i)
+    else:
+        raise CompileError("cannot match against %s" % (pattern.tokenName()))
 
-pattern = Forward().setName("pattern")
+def code_bind(var, env):
+    """Generates code popping a value into the unbound variable `var`."""
+    kind, n = env.location(var.name)
+    if kind == "reg":
+        env.code.emit(instrs.store(n), var)
+    else:
+        env.code.emit(instrs.sstore(n), var)
+    env.bound.add(var.name)
 
-p_tuple = (Suppress("{") + Optional(delimitedList(pattern)) + Suppress("}")).setParseAction(Tuple.fromParser).setName("p_tuple")
-p_list = (Suppress("[") + Optional(delimitedList(pattern)) + Optional(Suppress("|") + pattern, default=None) + Suppress("]")).setParseAction(List.fromParser).setName("p_list")
+#=============================================================================#
+#                                  Inlining                                   #
+#=============================================================================#
 
-pattern << (number | atom | var | p_tuple | p_list)
+literalTokens = (Integer, Float, Atom)
+structuredTokens = (Tuple, EmptyList, List, FlatList, Binary)
 
-expr = Forward().setName("expr")
+def literalValue(token):
+    return getattr(token, token.Attributes[0])
 
-body = Group(delimitedList(expr)).setName("body")
+def staticMatch(pattern, arg, bound):
+    """
+    Decides at compile time whether `pattern` matches the argument expression
+    `arg`. Returns `True` or `False` if this is known and `None` otherwise.
+    `bound` maps the names of the variables bound by the preceding patterns of
+    the same clause to their literal value or `None`; the variables of
+    `pattern` are added to it.
+    """
+    value = arg if isinstance(arg, literalTokens) else None
+    if isinstance(pattern, Variable):
+        if pattern.name == "_":
+            return True
+        if not bound.has_key(pattern.name):
+            bound[pattern.name] = value
+            return True
+        other = bound[pattern.name]
+        if value == None or other == None:
+            return None
+        return value.__class__ is other.__class__ and literalValue(value) == literalValue(other)
+    for token in iterTokens(pattern):
+        if isinstance(token, Variable) and token.name != "_":
+            bound.setdefault(token.name, None)
+    if not isinstance(arg, literalTokens):
+        return None
+    if isinstance(pattern, literalTokens):
+        return pattern.__class__ is arg.__class__ and literalValue(pattern) == literalValue(arg)
+    if isinstance(pattern, structuredTokens):
+        return False
+    return None
+
+def selectClauses(clauses, args):
+    """
+    Returns the clauses of a function which may be selected for a call with
+    the argument expressions `args`. Clauses which cannot match are dropped,
+    as well as all clauses following one which matches for sure.
+    """
+    selected = []
+    for clause in clauses:
+        bound = {}
+        results = [staticMatch(pattern, arg, bound) for pattern, arg in zip(clause.args, args)]
+        if False in results:
+            continue
+        selected.append(clause)
+        if None not in results:
+            break
+    return selected
+
+class VariableRenamer(TokenTransformer):
+    """Replaces variables by the tokens given for their names in `names`."""
+    
+    def __init__(self, names):
+        self.names = names
+    
+    def transform_Variable(self, var):
+        return self.names.get(var.name, var)
 
-e_tuple = (Suppress("{") + Optional(delimitedList(expr)) + Suppress("}")).setParseAction(Tuple.fromParser).setName("e_tuple")
-e_list = (Suppress("[") + Optional(delimitedList(expr)) + Optional(Suppress("|") + expr, default=None) + Suppress("]")).setParseAction(List.fromParser).setName("e_list")
+class Inliner(TokenTransformer):
+    """
+    Replaces calls to small, non-recursive local functions of a module by the
+    bodies of the functions.
+    
+    Clauses of the callee which cannot match the arguments of a call are
+    dropped at compile time, see :func:`selectClauses`; calls with literal
+    `Integer` or `Atom` arguments thereby get specialized to a single clause.
+    The remaining clauses become a case expression over a tuple of the
+    arguments whose variables are renamed, so they cannot clash with the ones
+    of the caller. Parameters bound to variables or literals are substituted
+    directly and if nothing else is left to match, the body of the clause
+    replaces the call.
+    
+    Only the original function bodies are inlined, so each call is expanded
+    at most one level deep.
+    
+    :param module: the module whose functions are inlined
+    :param maxSize: the maximum number of tokens of the selected clauses
+    :param profile: an optional dictionary mapping function labels or
+      `(name, arity)` tuples to call counts, like the one returned by
+      `Profiler.callCounts`; functions which were never called are not
+      inlined, functions called at least `hotCalls` times may be `hotFactor`
+      times larger than `maxSize`
+    """
+    
+    def __init__(self, module, maxSize=20, profile=None, hotCalls=1000, hotFactor=4):
+        self.moduleName = module.name
+        self.maxSize = maxSize
+        self.hotCalls = hotCalls
+        self.hotFactor = hotFactor
+        self.inlined = 0
+        self.counter = 0
+        
+        self.functions = {}
+        for decl in module.functions:
+            key = (decl.name.name, decl.arity)
+            if not self.isRecursive(decl, key):
+                self.functions[key] = decl
+        
+        self.profile = None
+        if profile != None:
+            self.profile = {}
+            for key, count in profile.iteritems():
+                if isinstance(key, basestring):
+                    parsed = parseFunLabel(key)
+                    if parsed == None or parsed[0] not in ("", self.moduleName):
+                        continue
+                    key = parsed[1:]
+                self.profile[key] = self.profile.get(key, 0) + count
+    
+    def isLocal(self, fun):
+        return isinstance(fun, FunName) and fun.module in ("", self.moduleName)
+    
+    def isRecursive(self, decl, key):
+        for token in iterTokens(decl):
+            if isinstance(token, FunApplExpression) and self.isLocal(token.fun) and (token.fun.name, len(token.args)) == key:
+                return True
+        return False
+    
+    def sizeLimit(self, key):
+        """Returns the size budget for inlining the function `key`."""
+        if self.profile == None:
+            return self.maxSize
+        calls = self.profile.get(key, 0)
+        if calls == 0:
+            return 0
+        elif calls >= self.hotCalls:
+            return self.maxSize * self.hotFactor
+        return self.maxSize
+    
+    def transform_FunApplExpression(self, call):
+        if not self.isLocal(call.fun):
+            return call
+        key = (call.fun.name, len(call.args))
+        decl = self.functions.get(key)
+        if decl == None:
+            return call
+        clauses = selectClauses(decl.clauses, call.args)
+        if len(clauses) == 0 or countTokens(clauses) > self.sizeLimit(key):
+            return call
+        self.inlined += 1
+        return self.expand(clauses, call)
+    
+    def expand(self, clauses, call):
+        """Returns the expression replacing `call` by the given clauses."""
+        self.counter += 1
+        prefix = "_I%d_" % (self.counter)
+        args = call.args
+        
+        substitute = {}
+        keep = range(len(args))
+        if len(clauses) == 1 and not any(isinstance(token, FunExpression) for token in iterTokens(clauses[0])):
+            keep = []
+            for i, (pattern, arg) in enumerate(zip(clauses[0].args, args)):
+                if isinstance(pattern, Variable) and pattern.name != "_" and not substitute.has_key(pattern.name) and isinstance(arg, (Variable,) + literalTokens):
+                    substitute[pattern.name] = arg
+                else:
+                    keep.append(i)
+        # Literal arguments matched by literal patterns are decided already
+        keep = [i for i in keep if not (isinstance(args[i], literalTokens) and all(isinstance(clause.args[i], literalTokens) or (isinstance(clause.args[i], Variable) and clause.args[i].name == "_") for clause in clauses))]
+        
+        caseClauses = []
+        for clause in clauses:
+            names = dict(substitute)
+            for token in iterTokens(clause):
+                if isinstance(token, Variable) and token.name != "_" and not names.has_key(token.name):
+                    names[token.name] = Variable(prefix + token.name, loc=token.loc)
+            renamer = VariableRenamer(names)
+            pattern = Tuple([renamer.transform(clause.args[i]) for i in keep], loc=clause.loc)
+            caseClauses.append(CaseExpressionClause(pattern, renamer.transform(clause.body), loc=clause.loc))
+        
+        if len(keep) == 0 and len(caseClauses) == 1 and len(caseClauses[0].body) == 1:
+            return caseClauses[0].body[0]
+        return CaseExpression(Tuple([args[i] for i in keep], loc=call.loc), caseClauses, loc=call.loc)
 
-atomic_expr = ((lparen + expr + rparen) | number | atom | var | e_tuple | e_list).setName("atomic_expr")
+def inline(parse_tree, maxSize=20, profile=None):
+    """
+    Returns the parse tree with calls to small local functions inlined. See
+    :class:`Inliner`.
+    """
+    if not isinstance(parse_tree, Module):
+        return parse_tree
+    return Inliner(parse_tree, maxSize, profile).transform(parse_tree)
 
-unaryop = oneOf("+ - not")
-arith_multop = oneOf("* / div mod")
-arith_addop = oneOf("+ -")
-bool_gtlt = oneOf("< > =< >=")
-bool_eq = oneOf("== /=")
-bool_and = Keyword("and")
-bool_or = Keyword("or")
+#=============================================================================#
+#                               Vectorization                                 #
+#=============================================================================#
 
-fun_appl_expr = ((fun_name | var) + lparen + Optional(delimitedList(expr)) + rparen).setParseAction(FunApplExpression.fromParser).setName("fun_appl_expr")
+vectorOperators = set(["+", "-", "*", "/", "div"])
 
-assignment_expr = (pattern + Suppress("=") + expr).setParseAction(Assignment.fromParser).setName("assignment_expr")
+def elementKernel(expr, var):
+    """
+    Returns the postfix kernel computing `expr` for an element bound to the
+    variable named `var` or `None` if `expr` is not an arithmetic expression of
+    that variable and number literals.
+    """
+    if isinstance(expr, Variable):
+        if expr.name == var:
+            return (("x",),)
+        return None
+    elif isinstance(expr, (Integer, Float)):
+        return (("c", expr.value),)
+    elif isinstance(expr, UnaryOp) and expr.op in ("+", "-"):
+        kernel = elementKernel(expr.expr, var)
+        if kernel == None or expr.op == "+":
+            return kernel
+        return kernel + (("neg",),)
+    elif isinstance(expr, BinaryOp) and expr.op in vectorOperators:
+        lkernel = elementKernel(expr.lexpr, var)
+        rkernel = elementKernel(expr.rexpr, var)
+        if lkernel == None or rkernel == None:
+            return None
+        return lkernel + rkernel + (("op", expr.op),)
+    return None
+
+def foldKernel(expr, acc, var):
+    """
+    Returns a tuple `(op, kernel)` if `expr` is `acc op E` or `E op acc` with
+    `op` being "+" or "*" and `E` an element kernel of `var`, or `None`.
+    """
+    if not isinstance(expr, BinaryOp) or expr.op not in ("+", "*"):
+        return None
+    for accExpr, elementExpr in ((expr.lexpr, expr.rexpr), (expr.rexpr, expr.lexpr)):
+        if isinstance(accExpr, Variable) and accExpr.name == acc:
+            kernel = elementKernel(elementExpr, var)
+            if kernel != None:
+                return expr.op, kernel
+    return None
+
+def consPattern(pattern):
+    """
+    Returns the variable names `(H, T)` if `pattern` is `[H|T]`, or `None`.
+    """
+    if isinstance(pattern, List) and isinstance(pattern.head, Variable) and isinstance(pattern.tail, Variable):
+        if pattern.head.name != pattern.tail.name and pattern.head.name != "_":
+            return pattern.head.name, pattern.tail.name
+    return None
+
+def isLocalCall(expr, name, args):
+    """Checks whether `expr` calls the local function `name` with `args`."""
+    if not isinstance(expr, FunApplExpression) or not isinstance(expr.fun, FunName):
+        return False
+    if expr.fun.module != "" or expr.fun.name != name or len(expr.args) != len(args):
+        return False
+    for arg, var in zip(expr.args, args):
+        if var != None and not (isinstance(arg, Variable) and arg.name == var):
+            return False
+    return True
+
+class Vectorizer(TokenTransformer):
+    """
+    Lowers list traversals with arithmetic element functions to bulk vector
+    operations. Recognized are recursive functions of the forms
+    
+    `f([]) -> []; f([H|T]) -> [E | f(T)].` (map) and
+    `f([], A) -> A; f([H|T], A) -> f(T, A op E).` (fold)
+    
+    in any clause order, as well as calls to `lists:map` and `lists:foldl` with
+    a literal fun of that kind and calls to `lists:sum`. `E` is an arithmetic
+    expression of `H` and number literals and `op` is "+" or "*".
+    """
+    
+    def transform_FunDeclaration(self, decl):
+        if len(decl.clauses) != 2 or decl.arity not in (1, 2):
+            return decl
+        name = decl.name.name
+        for base, step in (decl.clauses, reversed(decl.clauses)):
+            if len(step.body) != 1 or len(base.body) != 1 or not isinstance(base.args[0], EmptyList):
+                continue
+            cons = consPattern(step.args[0])
+            if cons == None:
+                continue
+            head, tail = cons
+            expr = step.body[0]
+            
+            if decl.arity == 1 and isinstance(base.body[0], EmptyList):
+                if isinstance(expr, List) and isLocalCall(expr.tail, name, [tail]):
+                    kernel = elementKernel(expr.head, head)
+                    if kernel != None:
+                        return VectorizedFunction("map", None, kernel, decl, loc=decl.loc)
+            
+            elif decl.arity == 2:
+                acc = base.args[1]
+                stepAcc = step.args[1]
+                if not isinstance(acc, Variable) or not isinstance(base.body[0], Variable) or base.body[0].name != acc.name:
+                    continue
+                if not isinstance(stepAcc, Variable) or stepAcc.name in cons or not isLocalCall(expr, name, [tail, None]):
+                    continue
+                fold = foldKernel(expr.args[1], stepAcc.name, head)
+                if fold != None:
+                    return VectorizedFunction("fold", fold[0], fold[1], decl, loc=decl.loc)
+        return decl
+    
+    def transform_FunApplExpression(self, call):
+        fun = call.fun
+        if not isinstance(fun, FunName) or fun.module != "lists":
+            return call
+        
+        if fun.name == "sum" and len(call.args) == 1:
+            return VectorFold(call.args[0], Integer(0, loc=call.loc), "+", (("x",),), call, loc=call.loc)
+        
+        if len(call.args) < 2 or not isinstance(call.args[0], FunExpression) or len(call.args[0].clauses) != 1:
+            return call
+        clause = call.args[0].clauses[0]
+        if len(clause.body) != 1 or not all(isinstance(arg, Variable) for arg in clause.args):
+            return call
+        
+        if fun.name == "map" and len(call.args) == 2 and clause.arity == 1:
+            kernel = elementKernel(clause.body[0], clause.args[0].name)
+            if kernel != None:
+                return VectorMap(call.args[1], kernel, call, loc=call.loc)
+        elif fun.name == "foldl" and len(call.args) == 3 and clause.arity == 2:
+            var, acc = clause.args[0].name, clause.args[1].name
+            if var != acc:
+                fold = foldKernel(clause.body[0], acc, var)
+                if fold != None:
+                    return VectorFold(call.args[2], call.args[1], fold[0], fold[1], call, loc=call.loc)
+        return call
+
+def vectorize(parse_tree):
+    """
+    Returns the parse tree with list traversals lowered to vector operations.
+    See :class:`Vectorizer`.
+    """
+    return Vectorizer().transform(parse_tree)
 
-case_expr_clause = (pattern + Suppress("->") + body).setParseAction(CaseExpressionClause.fromParser)
-case_expr = (Keyword("case").suppress() + expr + Keyword("of").suppress() + delimitedList(case_expr_clause, delim=";") + Keyword("end").suppress()).setParseAction(CaseExpression.fromParser).setName("case_expr")
+#=============================================================================#
+#                               Optimization                                  #
+#=============================================================================#
 
-def nextBinOpPrecLevelRAssoc(prev_pl, ops):
-    return (prev_pl + ZeroOrMore(ops + prev_pl)).setParseAction(BinaryOp.fromParser)
+Optimizer = newOptimizerBase()
 
-prec_expr = case_expr | fun_appl_expr | atomic_expr | (unaryop + atomic_expr).setParseAction(UnaryOp.fromParser)
-prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, arith_multop)
-prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, arith_addop)
-prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, bool_gtlt)
-prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, bool_eq)
-prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, bool_and)
-prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, bool_or)
+class Semantics(InstructionSemantics):
+    """
+    Describes `instrs` to the control flow graph optimizations of
+    :mod:`cpl.cfg`. Registers (`("reg", n)`) and frame slots (`("slot", n)`)
+    are tracked as locations; calls may read and clobber all of them. Only
+    `move`, `spill` and `reload` are pure, the other accesses of locations
+    (`load`, `store`, `sload`, `sstore` and the register operands of `arith`
+    and `cmp`) are never removed.
+    """
+    
+    jumps = {"jmp": 0}
+    branches = {"jmpf": 0, "mconst": 1, "mequal": 0, "mtuple": 1, "mcons": 0, "mnil": 0, "vmap": 1, "vfold": 2, "bmatch": 1}
+    calls = {"call": 0, "callext": 0, "mkclosure": 0, "loadfun": 0}
+    terminators = set(["halt", "ret", "fail", "purged"])
+    
+    #: Instructions with register operands, by the indexes of the operands
+    operands = dict([(name, (0, 1)) for name in ("addi", "subi", "muli", "divi", "modi", "addf", "subf", "mulf", "divf")])
+    operands.update({"arith": (1, 2), "cmp": (1, 2)})
+    
+    def effects(self, instr):
+        name = instr.name
+        if name == "move":
+            return [("reg", instr.args[0])], [("reg", instr.args[1])], True
+        elif name == "spill":
+            return [("slot", instr.args[1])], [("reg", instr.args[0])], True
+        elif name == "reload":
+            return [("reg", instr.args[1])], [("slot", instr.args[0])], True
+        elif name == "load":
+            return (), [("reg", instr.args[0])], False
+        elif name == "store":
+            return [("reg", instr.args[0])], (), False
+        elif name == "sload":
+            return (), [("slot", instr.args[0])], False
+        elif name == "sstore":
+            return [("slot", instr.args[0])], (), False
+        elif name in self.operands:
+            uses = [("reg", instr.args[i]) for i in self.operands[name] if instr.args[i] != None]
+            return (), uses, False
+        elif name in ("call", "callext", "callfun"):
+            return EVERYTHING, EVERYTHING, False
+        elif name in self.terminators:
+            return (), EVERYTHING, False
+        return (), (), False
+    
+    def valueKey(self, instr):
+        if instr.name == "reload":
+            return ("slot", instr.args[0])
+        return None
+    
+    def makeMove(self, dst, src):
+        if dst[0] == "reg" and src[0] == "reg":
+            return instrs.move(dst[1], src[1])
+        return None
 
-fun_expr_clause = (lparen + Optional(delimitedList(pattern)) + rparen + Suppress("->") + body).setParseAction(FunExpressionClause.fromParser)
-fun_expr = (Keyword("fun").suppress() + delimitedList(fun_expr_clause, delim=";") + Keyword("end").suppress()).setParseAction(FunExpression.fromParser).setName("fun_expr")
+semantics = Semantics()
 
-expr << (assignment_expr | fun_expr | prec_expr)
+#=============================================================================#
+#                                  Parser                                     #
+#=============================================================================#
 
-module_attribute = (Suppress("-") + atom + lparen + Optional(delimitedList(expr)) + rparen + Suppress(".")).setParseAction(ModuleAttribute.fromParser)
+grammar = None
 
-fun_decl_clause = (fun_name + lparen + Optional(delimitedList(pattern)) + rparen + Suppress("->") + body).setParseAction(FunDeclClause.fromParser)
-fun_decl = (delimitedList(fun_decl_clause, delim=";") + Suppress(".")).setParseAction(FunDeclaration.fromParser)
+def buildGrammar():
+    """
+    Builds the grammar and returns the parser element for modules.
+    
+    This is done on the first call to `parse` instead of on import, as building
+    the grammar takes longer than everything else needed to load this module.
+    """
+    import operator
+    from pyparsing import Literal, Suppress, Keyword, Regex, Combine, Group, Forward, Word, OneOrMore, ZeroOrMore, Optional, White, NotAny
+    from pyparsing import alphas, nums, oneOf, delimitedList
+    
+    lparen = Suppress("(")
+    rparen = Suppress(")")
+    reserved = "and andalso band bnot bor bsl bsr bxor case div end fun if not of or orelse when xor".split()
+    reserved = reduce(operator.or_, map(Keyword, reserved))
+    
+    simple_atom = (NotAny(reserved).suppress() + Regex(r'[a-z][a-zA-Z0-9_]*'))
+    quoted_atom = (Suppress("'") + Regex(r'[a-zA-Z0-9_ ]+') + Suppress("'"))
+    
+    atom = (quoted_atom | simple_atom).setParseAction(Atom.fromParser).setName("atom")
+    var = Regex(r'[A-Z_][a-zA-Z0-9_]*').setParseAction(Variable.fromParser).setName("variable")
+    number = (Regex(r'-?([1-9][0-9]*|0)') + Optional(Regex(r'\.[0-9]+'))).setParseAction(numberFromParser).setName("number")
+    
+    fun_name = (Optional((quoted_atom | simple_atom) + Suppress(":"), default="") + (quoted_atom | simple_atom)).setParseAction(FunName.fromParser).setName("fun_name")
+    
+    term = Forward().setName("term")
+    
+    tuple = (Suppress("{") + Optional(delimitedList(term)) + Suppress("}")).setParseAction(Tuple.fromParser).setName("tuple")
+    list = (Suppress("[") + Optional(delimitedList(term)) + Optional(Suppress("|") + term, default=None) + Suppress("]")).setParseAction(List.fromParser).setName("list")
+    
+    bin_size = Optional(Suppress(":") + number, default=None)
+    bin_types = Group(Optional(Suppress("/") + delimitedList(oneOf("integer float binary bytes signed unsigned big little"), delim="-")))
+    def binary(value, name):
+        segment = (value + bin_size + bin_types).setParseAction(BinarySegment.fromParser)
+        return (Suppress("<<") + Optional(delimitedList(segment)) + Suppress(">>")).setParseAction(Binary.fromParser).setName(name)
+    
+    term << (number | atom | list | tuple | binary(number, "binary"))
+    
+    pattern = Forward().setName("pattern")
+    
+    p_tuple = (Suppress("{") + Optional(delimitedList(pattern)) + Suppress("}")).setParseAction(Tuple.fromParser).setName("p_tuple")
+    p_list = (Suppress("[") + Optional(delimitedList(pattern)) + Optional(Suppress("|") + pattern, default=None) + Suppress("]")).setParseAction(List.fromParser).setName("p_list")
+    
+    p_binary = binary(number | var, "p_binary")
+    
+    pattern << (number | atom | var | p_tuple | p_list | p_binary)
+    
+    expr = Forward().setName("expr")
+    
+    body = Group(delimitedList(expr)).setName("body")
+    
+    e_tuple = (Suppress("{") + Optional(delimitedList(expr)) + Suppress("}")).setParseAction(Tuple.fromParser).setName("e_tuple")
+    e_list = (Suppress("[") + Optional(delimitedList(expr)) + Optional(Suppress("|") + expr, default=None) + Suppress("]")).setParseAction(List.fromParser).setName("e_list")
+    
+    e_binary = binary((lparen + expr + rparen) | number | var, "e_binary")
+    
+    atomic_expr = ((lparen + expr + rparen) | number | atom | var | e_tuple | e_list | e_binary).setName("atomic_expr")
+    
+    unaryop = oneOf("+ - not bnot")
+    arith_multop = oneOf("* / div mod band")
+    arith_addop = oneOf("+ - bor bxor bsl bsr")
+    bool_gtlt = oneOf("< > =< >=")
+    bool_eq = oneOf("== /=")
+    bool_and = Keyword("and")
+    bool_or = Keyword("or")
+    
+    fun_appl_expr = ((fun_name | var) + lparen + Optional(delimitedList(expr)) + rparen).setParseAction(FunApplExpression.fromParser).setName("fun_appl_expr")
+    
+    assignment_expr = (pattern + Suppress("=") + expr).setParseAction(Assignment.fromParser).setName("assignment_expr")
+    
+    case_expr_clause = (pattern + Suppress("->") + body).setParseAction(CaseExpressionClause.fromParser)
+    case_expr = (Keyword("case").suppress() + expr + Keyword("of").suppress() + delimitedList(case_expr_clause, delim=";") + Keyword("end").suppress()).setParseAction(CaseExpression.fromParser).setName("case_expr")
+    
+    def nextBinOpPrecLevelRAssoc(prev_pl, ops):
+        return (prev_pl + ZeroOrMore(ops + prev_pl)).setParseAction(BinaryOp.fromParser)
+    
+    prec_expr = case_expr | fun_appl_expr | atomic_expr | (unaryop + atomic_expr).setParseAction(UnaryOp.fromParser)
+    prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, arith_multop)
+    prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, arith_addop)
+    prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, bool_gtlt)
+    prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, bool_eq)
+    prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, bool_and)
+    prec_expr = nextBinOpPrecLevelRAssoc(prec_expr, bool_or)
+    
+    fun_expr_clause = (lparen + Optional(delimitedList(pattern)) + rparen + Suppress("->") + body).setParseAction(FunExpressionClause.fromParser)
+    fun_expr = (Keyword("fun").suppress() + delimitedList(fun_expr_clause, delim=";") + Keyword("end").suppress()).setParseAction(FunExpression.fromParser).setName("fun_expr")
+    
+    expr << (assignment_expr | fun_expr | prec_expr)
+    
+    module_attribute = (Suppress("-") + atom + lparen + Optional(delimitedList(expr)) + rparen + Suppress(".")).setParseAction(ModuleAttribute.fromParser)
+    
+    fun_decl_clause = (fun_name + lparen + Optional(delimitedList(pattern)) + rparen + Suppress("->") + body).setParseAction(FunDeclClause.fromParser)
+    fun_decl = (delimitedList(fun_decl_clause, delim=";") + Suppress(".")).setParseAction(FunDeclaration.fromParser)
+    
+    module = ZeroOrMore(module_attribute | fun_decl).setParseAction(Module.fromParser)
+    
+    return module
 
-module = ZeroOrMore(module_attribute | fun_decl).setParseAction(Module.fromParser)
+def getGrammar():
+    """Returns the parser element for modules, building it if necessary."""
+    global grammar
+    if grammar == None:
+        grammar = buildGrammar()
+    return grammar
 
 #=============================================================================#
 #                            Exported Functions                               #
 #=============================================================================#
 
-def parse(source):
-    #t = time()
-    parse_tree = module.parseString(source)[0] #expr.parseString(source)[0]
-    #t = time() - t
-    #print "Parse time: %dms" % (int(t*1000))
+metricsSink = None
+
+def setMetricsSink(sink):
+    """
+    Sets the default metrics sink for `compile`. The sink is a callable which
+    receives a :class:`CompilerMetrics` object after every compiler run. Pass
+    `None` to disable the collection of metrics (the default).
+    """
+    global metricsSink
+    metricsSink = sink
+
+def parse(source, metrics=None):
+    """
+    Parses the source code and returns the parse tree. If a
+    :class:`CompilerMetrics` object is given, the parse time and the number of
+    tokens will be recorded in it.
+    """
+    if metrics == None:
+        return getGrammar().parseString(source)[0]
+    
+    with metrics.phase("parse"):
+        parse_tree = getGrammar().parseString(source)[0]
+    metrics.set("tokens", countTokens(parse_tree))
     return parse_tree
 
 def compile(source, options = {}):
     """
+    Compiles the given source code or parse tree and returns a list of
+    instructions.
     
-    This compiler accepts the `optimize` option (`True` by default).
+    This compiler accepts the `optimize` option (`True` by default), the
+    `inline` option giving the maximum size of inlined functions in tokens
+    (20 by default, 0 disables inlining, see :class:`Inliner`), the `profile`
+    option holding call counts to guide inlining (e.g. from
+    `Profiler.callCounts`), the `vectorize` option (`True` by default, see
+    :class:`Vectorizer`), the `registers` option giving the number of
+    registers for variables (8 by default, 0 for a pure stack machine), the
+    `namespace` option which is prepended to all generated labels (none by
+    default) and the `metrics` option. The latter is either a
+    :class:`CompilerMetrics` object to be filled or a callable sink which will
+    receive a new one after compiling; it defaults to the sink set with
+    `setMetricsSink`. If there is neither, no metrics are collected.
     """
+    metrics = options.get("metrics", metricsSink)
+    sink = None
+    if metrics != None and not isinstance(metrics, CompilerMetrics):
+        sink = metrics
+        metrics = CompilerMetrics()
+    
     if isinstance(source, basestring):
-        parse_tree = parse(source)
+        parse_tree = parse(source, metrics)
     else:
         parse_tree = source
+        if metrics != None:
+            metrics.set("tokens", countTokens(parse_tree))
     
-    instructionLabel.reset()
-    t = time()
-    compiled_instructions = code_P(parse_tree)
-    t = time() - t
-    print "Compile time: %dms" % (int(t*1000))
-    if options.get("optimize", True):
-        return optimize(compiled_instructions)
+    if metrics != None and metrics.name == None and isinstance(parse_tree, Module):
+        metrics.name = parse_tree.name
+    
+    maxInline = options.get("inline", 20)
+    if maxInline > 0 and isinstance(parse_tree, Module):
+        inliner = Inliner(parse_tree, maxInline, options.get("profile"))
+        if metrics == None:
+            parse_tree = inliner.transform(parse_tree)
+        else:
+            with metrics.phase("inline"):
+                parse_tree = inliner.transform(parse_tree)
+            metrics.set("inlined_calls", inliner.inlined)
+    
+    if options.get("vectorize", True):
+        if metrics == None:
+            parse_tree = vectorize(parse_tree)
+        else:
+            with metrics.phase("vectorize"):
+                parse_tree = vectorize(parse_tree)
+    
+    instructionLabel.reset(options.get("namespace"))
+    closures = context.closures
+    closures.reset()
+    if metrics == None:
+        closures.convert(parse_tree)
+    else:
+        with metrics.phase("closures"):
+            closures.convert(parse_tree)
+        for name, value in closures.stats().iteritems():
+            metrics.set(name, value)
+    
+    types = context.types
+    types.reset()
+    if metrics == None:
+        types.infer(parse_tree)
+    else:
+        with metrics.phase("types"):
+            types.infer(parse_tree)
+        for name, value in types.stats().iteritems():
+            metrics.set(name, value)
+    
+    registers = context.registers
+    registers.reset(options.get("registers", 8))
+    if metrics == None:
+        registers.allocate(parse_tree, closures.environments)
+    else:
+        with metrics.phase("allocate"):
+            registers.allocate(parse_tree, closures.environments)
+        for name, value in registers.stats().iteritems():
+            metrics.set(name, value)
+    
+    if metrics == None:
+        compiled_instructions = code_P(parse_tree)
     else:
-        return compiled_instructions
+        with metrics.phase("compile"):
+            compiled_instructions = code_P(parse_tree)
+        metrics.set("instructions", len(compiled_instructions))
+    
+    if options.get("optimize", True):
+        compiled_instructions = optimize(compiled_instructions, metrics)
+    
+    if metrics != None:
+        metrics.recordPeakMemory()
+        if sink != None:
+            sink(metrics)
+    
+    return compiled_instructions
 
 compile_options = [
     ("optimize", "Optimize", "Runs the instructions through the optimizer on compiling.", 'bool', True),
+    ("registers", "Registers", "Number of registers variables are allocated to; the rest is spilled to the stack.", 'int', 8),
+    ("inline", "Inline", "Maximum size in tokens of local functions which are inlined into their callers, 0 disables inlining.", 'int', 20),
+    ("vectorize", "Vectorize", "Lowers list traversals with arithmetic element functions to vector instructions.", 'bool', True),
 ]
 
-def optimize(instructions):
-    t = time()
-    optinstrs = Optimizer.run_optimizers(instructions)
-    t = time() - t
-    print "Optimize time: %dms" % (int(t*1000))
+def optimize(instructions, metrics=None):
+    """
+    Runs the instructions through the peephole optimizer and the control flow
+    graph optimizations of :mod:`cpl.cfg` and returns the optimized
+    instructions. If a :class:`CompilerMetrics` object is given, the optimize
+    time and the instruction counts will be recorded in it.
+    """
+    if metrics == None:
+        return cfg.optimize(Optimizer.run_optimizers(instructions), semantics)
+    
+    with metrics.phase("optimize"):
+        optinstrs = Optimizer.run_optimizers(instructions)
+    with metrics.phase("cfg"):
+        optinstrs = cfg.optimize(optinstrs, semantics)
+    metrics.set("instructions", len(instructions))
+    metrics.set("optimized_instructions", len(optinstrs))
     
     return optinstrs
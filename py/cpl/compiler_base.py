@@ -18,10 +18,40 @@
 #  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import inspect
+import sys, threading
 from types import FunctionType
 from functools import wraps
+from contextlib import contextmanager
 from cStringIO import StringIO
+from time import time
+
+try:
+    import resource
+except ImportError:
+    # not available on all platforms
+    resource = None
+
+class TokenMetaClass(type):
+    """
+    Metaclass for tokens. See :class:`Token`.
+    
+    Generates the `__slots__` of token classes from their `Attributes`, unless
+    the class declares `__slots__` itself. All token classes are registered by
+    name in `tokenClasses`.
+    """
+    
+    tokenClasses = {}
+    
+    def __new__(meta, classname, bases, classDict):
+        if not classDict.has_key("__slots__"):
+            inherited = set()
+            for base in bases:
+                for cls in base.__mro__:
+                    inherited.update(getattr(cls, "__slots__", ()))
+            classDict["__slots__"] = tuple([name for name in classDict.get("Attributes", []) if name not in inherited])
+        token_class = type.__new__(meta, classname, bases, classDict)
+        meta.tokenClasses[classname] = token_class
+        return token_class
 
 class Token(object):
     """
@@ -31,6 +61,10 @@ class Token(object):
     of attribute names in your subclasses. That way the `__init__` method will
     pick up the right attributes and store them.
     
+    Tokens have no instance dictionary; their attributes are stored in slots
+    which are created from the `Attributes` by a metaclass. This keeps large
+    parse trees small.
+    
     :param loc: an optional location within a source. Should be passed as named
       argument.
     
@@ -38,6 +72,9 @@ class Token(object):
     .. automethod:: __repr__
     """
     
+    __metaclass__ = TokenMetaClass
+    __slots__ = ("loc",)
+    
     Attributes = []
     
     def __init__(self, *args, **kwargs):
@@ -51,6 +88,14 @@ class Token(object):
             value = args[i]
             setattr(self, name, value)
     
+    def __getstate__(self):
+        return (self.loc,) + tuple([getattr(self, name) for name in self.Attributes])
+    
+    def __setstate__(self, state):
+        self.loc = state[0]
+        for i in xrange(len(self.Attributes)):
+            setattr(self, self.Attributes[i], state[i+1])
+    
     def tokenName(self):
         """Returns the token's class name."""
         return self.__class__.__name__
@@ -63,45 +108,99 @@ class Token(object):
         for name in self.Attributes:
             yield name, getattr(self, name)
     
-    def __pp(self, out, level):
-        indent = "    " * (level + 1)
-        if len(self.Attributes) == 0:
-            out.write("%s {}\n" % (self.tokenName()))
-            return
-        out.write("%s {\n" % (self.tokenName()))
-        for name, attr in self.iter():
-            if isinstance(attr, list):
-                if len(attr) == 0:
-                    out.write("%s%s = []\n" % (indent, name))
+    def iterPrettyPrint(self):
+        """
+        Returns an iterator over the chunks of the pretty-printed token. The
+        tree is walked without recursion, so this works on arbitrarily deep
+        trees.
+        """
+        stack = [(self, 0)]
+        while len(stack) > 0:
+            item = stack.pop()
+            if isinstance(item, str):
+                yield item
+                continue
+            
+            token, level = item
+            indent = "    " * (level + 1)
+            if len(token.Attributes) == 0:
+                yield "%s {}\n" % (token.tokenName())
+                continue
+            yield "%s {\n" % (token.tokenName())
+            parts = []
+            for name, attr in token.iter():
+                if isinstance(attr, list):
+                    if len(attr) == 0:
+                        parts.append("%s%s = []\n" % (indent, name))
+                    else:
+                        parts.append("%s%s = [\n" % (indent, name))
+                        for entry in attr:
+                            if isinstance(entry, Token):
+                                parts.append("%s    " % (indent))
+                                parts.append((entry, level + 2))
+                            else:
+                                parts.append("%s    %s\n" % (indent, repr(entry)))
+                        parts.append("%s]\n" % (indent))
+                elif isinstance(attr, Token):
+                    parts.append("%s%s = " % (indent, name))
+                    parts.append((attr, level + 1))
                 else:
-                    out.write("%s%s = [\n" % (indent, name))
-                    for entry in attr:
-                        if isinstance(entry, Token):
-                            out.write("%s    " % (indent))
-                            entry.__pp(out, level + 2)
-                        else:
-                            out.write("%s    %s\n" % (indent, repr(entry)))
-                    out.write("%s]\n" % (indent))
-            elif isinstance(attr, Token):
-                out.write("%s%s = " % (indent, name))
-                attr.__pp(out, level + 1)
-            else:
-                out.write("%s%s = %s\n" % (indent, name, repr(attr)))
-        out.write("%s}\n" % ("    " * (level)))
+                    parts.append("%s%s = %s\n" % (indent, name, repr(attr)))
+            parts.append("%s}\n" % ("    " * (level)))
+            stack.extend(reversed(parts))
+    
+    def prettyPrint(self, out):
+        """Pretty-prints the token to the file object `out`."""
+        for chunk in self.iterPrettyPrint():
+            out.write(chunk)
     
     def __str__(self):
         """Pretty-print the token."""
         out = StringIO()
-        self.__pp(out, 0)
+        self.prettyPrint(out)
         return out.getvalue()
     
+    def iterRepr(self):
+        """
+        Returns an iterator over the chunks of the formal representation of the
+        token (see `__repr__`). Like `iterPrettyPrint`, this works without
+        recursion.
+        """
+        # Chunks are pushed as strings, values still to be represented as
+        # 1-tuples.
+        stack = [(self,)]
+        while len(stack) > 0:
+            item = stack.pop()
+            if isinstance(item, str):
+                yield item
+                continue
+            
+            value = item[0]
+            if isinstance(value, Token):
+                parts = ["%s(" % (value.tokenName())]
+                for i in xrange(len(value.Attributes)):
+                    if i > 0:
+                        parts.append(",")
+                    parts.append((getattr(value, value.Attributes[i]),))
+                parts.append(")")
+                stack.extend(reversed(parts))
+            elif isinstance(value, list):
+                parts = ["["]
+                for i in xrange(len(value)):
+                    if i > 0:
+                        parts.append(", ")
+                    parts.append((value[i],))
+                parts.append("]")
+                stack.extend(reversed(parts))
+            else:
+                yield repr(value)
+    
     def __repr__(self):
         """
         Returns a formal representation of the token, which can be used
         to instantiate a parse tree.
         """
-        attrs = [repr(getattr(self, name)) for name in self.Attributes]
-        return '%s(%s)' % (self.tokenName(), ",".join(attrs))
+        return "".join(self.iterRepr())
     
     @classmethod
     def fromParser(cls, s, loc, toks):
@@ -111,12 +210,158 @@ class Token(object):
         """
         raise NotImplementedError
 
+def iterTokens(token):
+    """
+    Returns an iterator over all tokens in the parse tree starting at `token`,
+    including `token` itself. Lists of tokens are traversed. The tree is walked
+    depth-first without recursion, so arbitrarily deep trees are supported.
+    """
+    stack = [token]
+    while len(stack) > 0:
+        obj = stack.pop()
+        if isinstance(obj, Token):
+            yield obj
+            for name in reversed(obj.Attributes):
+                stack.append(getattr(obj, name))
+        elif isinstance(obj, list):
+            stack.extend(reversed(obj))
+
+def countTokens(token):
+    """
+    Returns the number of tokens in the parse tree starting at `token`. Lists
+    of tokens are traversed but not counted.
+    """
+    n = 0
+    for obj in iterTokens(token):
+        n += 1
+    return n
+
+handlerCache = {}
+
+def findHandler(visitor_class, prefix, token_class):
+    """
+    Returns the method of `visitor_class` named `prefix` followed by the name
+    of `token_class` or of its nearest base class which has such a method.
+    Returns `None` if there is no such method. Results are cached per visitor
+    class and token class.
+    """
+    key = (visitor_class, prefix, token_class)
+    try:
+        return handlerCache[key]
+    except KeyError:
+        pass
+    handler = None
+    for cls in token_class.__mro__:
+        handler = getattr(visitor_class, prefix + cls.__name__, None)
+        if handler != None:
+            break
+    handlerCache[key] = handler
+    return handler
+
+class TokenVisitor(object):
+    """
+    Base class for passes which inspect parse trees.
+    
+    `walk` visits all tokens of a tree depth-first and calls the method
+    `visit_X(token)` of the visitor for every token of class X when entering the
+    token and `leave_X(token)` when leaving it. If there is no method for a
+    class, the ones for its base classes are tried, e.g. `visit_FlatList` is
+    used for a `PackedList` token. Tokens without any method are just walked
+    through. If a `visit_X` method returns `False`, the children of the token
+    are skipped.
+    
+    The tree is walked with an explicit work stack instead of recursion, so
+    arbitrarily deep trees (like long `List` chains) are supported.
+    """
+    
+    def walk(self, root):
+        """Walks the tree starting at `root`."""
+        cls = self.__class__
+        stack = [(root, False)]
+        while len(stack) > 0:
+            value, leaving = stack.pop()
+            if isinstance(value, Token):
+                if leaving:
+                    handler = findHandler(cls, "leave_", value.__class__)
+                    if handler != None:
+                        handler(self, value)
+                    continue
+                handler = findHandler(cls, "visit_", value.__class__)
+                if handler != None and handler(self, value) is False:
+                    continue
+                stack.append((value, True))
+                for name in reversed(value.Attributes):
+                    stack.append((getattr(value, name), False))
+            elif isinstance(value, list):
+                for entry in reversed(value):
+                    stack.append((entry, False))
+
+class TokenTransformer(object):
+    """
+    Base class for passes which rewrite parse trees.
+    
+    `transform` processes a tree bottom-up: the children of a token are
+    transformed first; if any of them was replaced, a new token of the same
+    class is created with the new children. Then the method `transform_X(token)`
+    is called for tokens of class X (or of its nearest base class with such a
+    method) and its return value replaces the token. Tokens without a method are
+    kept. Lists of tokens are transformed element-wise.
+    
+    Like :class:`TokenVisitor`, this works without recursion.
+    """
+    
+    def transform(self, root):
+        """Transforms the tree starting at `root` and returns the new tree."""
+        cls = self.__class__
+        results = []
+        stack = [(root, False)]
+        while len(stack) > 0:
+            value, expanded = stack.pop()
+            if isinstance(value, Token):
+                n = len(value.Attributes)
+                if not expanded and n > 0:
+                    stack.append((value, True))
+                    for name in reversed(value.Attributes):
+                        stack.append((getattr(value, name), False))
+                    continue
+                if n > 0:
+                    args = results[-n:]
+                    del results[-n:]
+                    for i in xrange(n):
+                        if args[i] is not getattr(value, value.Attributes[i]):
+                            value = value.__class__(*args, loc=value.loc)
+                            break
+                handler = findHandler(cls, "transform_", value.__class__)
+                if handler != None:
+                    value = handler(self, value)
+                results.append(value)
+            elif isinstance(value, list):
+                n = len(value)
+                if not expanded and n > 0:
+                    stack.append((value, True))
+                    for entry in reversed(value):
+                        stack.append((entry, False))
+                    continue
+                if n > 0:
+                    entries = results[-n:]
+                    del results[-n:]
+                    for i in xrange(n):
+                        if entries[i] is not value[i]:
+                            value = entries
+                            break
+                results.append(value)
+            else:
+                results.append(value)
+        return results[0]
+
 class Instruction(object):
     """
     Represents an arbitrary instruction for arbitrary virtual machines.
     
     :param name: the name of the instruction
     :param label: an optional label for the instruction, useful in branching
+    :param loc: an optional location within the source the instruction was
+      generated from, usually taken from the `loc` of the originating token
     
     All other arguments will be kept in `args`.
     """
@@ -124,20 +369,19 @@ class Instruction(object):
         self.name = name
         self.args = args
         self.label = kwargs.get("label", None)
+        self.loc = kwargs.get("loc", None)
     
     def clone(self):
         """Creates an exact copy of this instruction."""
-        if self.label != None:
-            return Instruction(self.name, *self.args, label=self.label)
-        else:
-            return Instruction(self.name, *self.args)
+        return Instruction(self.name, *self.args, label=self.label, loc=self.loc)
     
     def __repr__(self):
         sargs = "".join(["," + repr(arg) for arg in self.args])
         if self.label != None:
-            return 'Instruction(%s%s,label=%s)' % (repr(self.name), sargs, repr(self.label))
-        else:
-            return 'Instruction(%s%s)' % (repr(self.name), sargs)
+            sargs += ",label=%s" % (repr(self.label))
+        if self.loc != None:
+            sargs += ",loc=%s" % (repr(self.loc))
+        return 'Instruction(%s%s)' % (repr(self.name), sargs)
     
     def __str__(self):
         sargs = "".join([" " + str(arg) for arg in self.args])
@@ -146,8 +390,16 @@ class Instruction(object):
         else:
             return '%s%s' % (self.name, sargs)
 
+def functionArgs(f):
+    """
+    Returns the names of the positional arguments of the function `f`. This is
+    equivalent to `inspect.getargspec(f).args` but avoids importing `inspect`.
+    """
+    code = f.func_code
+    return list(code.co_varnames[:code.co_argcount])
+
 def makeInstructionConstructor(f):
-    args = inspect.getargspec(f).args
+    args = functionArgs(f)
     argc = len(args)
     name = f.__name__.replace("_", "")
     @wraps(f)
@@ -180,25 +432,57 @@ class InstructionSet(object):
     
     __metaclass__ = InstructionSetMetaClass
 
-class InstructionLabel(object):
+class InstructionLabel(threading.local):
     """
     Instances of this class provide a simple mechanism to create unique labels
     for one compiling pass. Usually the class is instantiated once per compiler
     module.
+    
+    The label counter is kept per thread, so compiling passes can run
+    concurrently. To keep labels of separately compiled modules apart, a
+    namespace can be given on `reset`.
     """
     
     def __init__(self):
         self.reset()
     
-    def reset(self):
-        """Resets the internal label counter."""
+    def reset(self, namespace=None):
+        """
+        Resets the internal label counter and sets the namespace for the
+        following labels.
+        """
         self.label_counter = -1
+        self.namespace = namespace
     
     def new(self):
-        """Returns a new label of the form 'lX' where X is a serial number."""
+        """
+        Returns a new label of the form 'lX' where X is a serial number. If a
+        namespace is set, the label has the form 'namespace.lX' instead.
+        """
         self.label_counter += 1
+        if self.namespace != None:
+            return '%s.l%d' % (self.namespace, self.label_counter)
         return 'l%d' % (self.label_counter)
 
+def funLabel(module, name, arity):
+    """
+    Returns the label for the entry point of the function `module:name/arity`.
+    Compilers put this label on the first instruction of every function and use
+    it as call target, so calls can be resolved by the linker.
+    """
+    return '%s:%s/%d' % (module, name, arity)
+
+def parseFunLabel(label):
+    """
+    Splits a label created by `funLabel` into a tuple `(module, name, arity)`.
+    Returns `None` if `label` is not a function label.
+    """
+    module, sep, rest = label.partition(":")
+    name, sep2, arity = rest.rpartition("/")
+    if sep == "" or sep2 == "" or not arity.isdigit():
+        return None
+    return module, name, int(arity)
+
 def putLabel(label, instrs):
     """
     Helper function which puts a label onto the first instruction in the list
@@ -209,6 +493,73 @@ def putLabel(label, instrs):
     instrs[0].label = label
     return instrs
 
+class CompilerMetrics(object):
+    """
+    Collects figures about one compiler run: the duration of each phase in
+    `phases` (a list of `(name, seconds)` tuples in the order the phases were
+    run) and arbitrary named values like node and instruction counts in
+    `values`.
+    
+    Compilers only collect metrics if they are given an instance of this class,
+    so there is no overhead otherwise.
+    
+    :param name: an optional name for the compiled unit, e.g. a module name
+    """
+    
+    def __init__(self, name=None):
+        self.name = name
+        self.phases = []
+        self.values = {}
+    
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager which measures the duration of the enclosed block and
+        records it as phase `name`.
+        """
+        t = time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time() - t))
+    
+    def set(self, name, value):
+        """Sets the named value `name`."""
+        self.values[name] = value
+    
+    def recordPeakMemory(self):
+        """
+        Records the peak resident memory of the process in kilobytes as the
+        value `peak_memory`, if the platform supports it.
+        """
+        if resource == None:
+            return
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak //= 1024 # reported in bytes instead of kilobytes
+        self.values["peak_memory"] = peak
+    
+    def duration(self, name):
+        """Returns the total duration of all phases called `name`."""
+        return sum([t for phase, t in self.phases if phase == name])
+    
+    def asDict(self):
+        """
+        Returns the metrics as a dictionary of plain values, e.g. for
+        serialization to JSON.
+        """
+        return {"name": self.name, "phases": [list(p) for p in self.phases], "values": dict(self.values)}
+    
+    def __str__(self):
+        lines = []
+        if self.name != None:
+            lines.append("%s:" % (self.name))
+        for phase, t in self.phases:
+            lines.append("  %s time: %dms" % (phase, int(t*1000)))
+        for name, value in sorted(self.values.iteritems()):
+            lines.append("  %s: %s" % (name, value))
+        return "\n".join(lines)
+
 class AbstractOptimizer(object):
     """
     Abstract base class for optimizers.
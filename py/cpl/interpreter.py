@@ -0,0 +1,689 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+The reference virtual machine for the instruction set of :mod:`cpl.compiler`.
+
+Terms are represented by python values: numbers by `int`, `long` and `float`,
+atoms by strings, tuples by tuples, binaries by
+:class:`cpl.binary.BinaryData` and funs by pointers to :class:`Closure`
+objects on the heap. Lists are chains of :class:`Cons` cells ending with
+`NIL`; packed numeric lists are :class:`cpl.vector.NumericArray` objects and
+are unpacked into cells as soon as they are matched.
+
+The state consists of the registers `PC` and `FP` and the memories `S` (the
+operand stack), `X` (the registers variables are allocated to), `F` (the
+frames), `R` (the return records) and `H` (the heap). `FP` points to the
+first slot of the current frame in `F`. A return record holds the return
+address, the frame pointer of the caller and the fun running in the callee,
+if any, whose environment `envget` reads. Funs capturing nothing share one
+closure per fun, which `funs` maps to by label.
+
+`arith` observes the types of its operands and quickens itself into the
+variant specialized for them (see `Interpreter.quickenVM`). A variant which
+gets operands of other types turns back into `arith`, which then stays
+generic; `generic` holds the indexes of these instructions.
+"""
+
+__all__ = ["VM", "Cons", "NIL", "fromPython", "toPython", "compareTerms"]
+
+from array import array
+
+from interpreter_base import Interpreter, Pointer, Stack, Heap, Closure, InterpreterHalt, error
+from compiler import specializedArithmetic
+import binary
+import vector
+
+#=============================================================================#
+#                                  Terms                                      #
+#=============================================================================#
+
+class Cons(object):
+    """A list cell. Cells are immutable."""
+    
+    __slots__ = ("head", "tail")
+    
+    def __init__(self, head, tail):
+        self.head = head
+        self.tail = tail
+    
+    def __repr__(self):
+        return "Cons(%r, %r)" % (self.head, self.tail)
+
+class Nil(object):
+    """The type of the empty list `NIL`, of which there is only one."""
+    
+    def __reduce__(self):
+        return "NIL"
+    
+    def __repr__(self):
+        return "NIL"
+
+NIL = Nil()
+
+def asCons(value):
+    """Returns the cells of `value` if it is a packed list, else `value`."""
+    if isinstance(value, vector.NumericArray):
+        result = NIL
+        for element in reversed(value.numbers):
+            result = Cons(element, result)
+        return result
+    return value
+
+def numericValues(value):
+    """
+    Returns the numbers of the list `value` as array if they are either all
+    integers or all floats, otherwise `None`.
+    """
+    if isinstance(value, vector.NumericArray):
+        return value.numbers
+    numbers = []
+    while isinstance(value, Cons):
+        numbers.append(value.head)
+        value = value.tail
+    if isinstance(value, vector.NumericArray):
+        numbers.extend(value.numbers)
+    elif value is not NIL:
+        return None
+    return vector.pack(numbers)
+
+def vectorOperand(value):
+    if isinstance(value, vector.NumericArray):
+        return value.numbers
+    elif not isNumber(value):
+        error("badarg")
+    return value
+
+def isNumber(value):
+    return isinstance(value, (int, long, float))
+
+#: The classes of integers, without `bool`.
+intClasses = (int, long)
+
+def termRank(value):
+    if isinstance(value, (int, long, float)):
+        return 0
+    elif isinstance(value, str):
+        return 1
+    elif isinstance(value, Pointer):
+        return 2
+    elif isinstance(value, tuple):
+        return 3
+    elif value is NIL or isinstance(value, (Cons, vector.NumericArray)):
+        return 4
+    return 5
+
+def compareTerms(a, b, exact=False):
+    """
+    Compares two terms in the term order (numbers < atoms < funs < tuples <
+    lists < binaries) and returns a negative number, 0 or a positive number
+    like `cmp`. If `exact` is `True`, integers and floats are never equal.
+    """
+    rank = termRank(a)
+    result = cmp(rank, termRank(b))
+    if result != 0:
+        return result
+    if rank == 0:
+        result = cmp(a, b)
+        if result == 0 and exact:
+            result = cmp(isinstance(a, float), isinstance(b, float))
+        return result
+    elif rank == 1:
+        return cmp(a, b)
+    elif rank == 2:
+        return cmp(a.v, b.v)
+    elif rank == 3:
+        result = cmp(len(a), len(b))
+        for x, y in zip(a, b):
+            if result != 0:
+                break
+            result = compareTerms(x, y, exact)
+        return result
+    elif rank == 4:
+        while True:
+            a = asCons(a)
+            b = asCons(b)
+            if a is NIL or b is NIL:
+                return cmp(a is not NIL, b is not NIL)
+            if not isinstance(a, Cons) or not isinstance(b, Cons):
+                # Improper lists
+                return compareTerms(a, b, exact)
+            result = compareTerms(a.head, b.head, exact)
+            if result != 0:
+                return result
+            a = a.tail
+            b = b.tail
+    return cmp(a.tobytes(), b.tobytes())
+
+def comparison(op, a, b):
+    """Applies the comparison operator `op` and returns the atom of the result."""
+    if op == "==":
+        result = compareTerms(a, b) == 0
+    elif op == "/=":
+        result = compareTerms(a, b) != 0
+    elif op == "<":
+        result = compareTerms(a, b) < 0
+    elif op == ">":
+        result = compareTerms(a, b) > 0
+    elif op == "=<":
+        result = compareTerms(a, b) <= 0
+    else:
+        result = compareTerms(a, b) >= 0
+    return "true" if result else "false"
+
+def arithmetic(op, a, b):
+    """
+    Applies the arithmetic operator `op` to two numbers. Raises
+    `InterpreterError` with "badarith" for other operands or a division by
+    zero.
+    """
+    if not isNumber(a) or not isNumber(b):
+        error("badarith")
+    if op == "+":
+        return a + b
+    elif op == "-":
+        return a - b
+    elif op == "*":
+        return a * b
+    elif op == "/":
+        if b == 0:
+            error("badarith")
+        return float(a) / b
+    if isinstance(a, float) or isinstance(b, float) or b == 0:
+        error("badarith")
+    if op == "div":
+        return vector.intdiv(a, b)
+    return intmod(a, b)
+
+def intmod(a, b):
+    """The remainder of `vector.intdiv`, with the sign of `a`."""
+    return a - vector.intdiv(a, b) * b
+
+def fromPython(value):
+    """
+    Converts python lists (also nested in tuples) to cells and booleans to
+    atoms. Other values are returned unchanged.
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, list):
+        result = NIL
+        for element in reversed(value):
+            result = Cons(fromPython(element), result)
+        return result
+    elif isinstance(value, tuple):
+        return tuple([fromPython(element) for element in value])
+    return value
+
+def toPython(value):
+    """
+    Converts proper lists (also nested in tuples) to python lists. Other
+    values, including improper lists, are returned unchanged.
+    """
+    if isinstance(value, vector.NumericArray):
+        return list(value.numbers)
+    elif value is NIL or isinstance(value, Cons):
+        result = []
+        cell = value
+        while isinstance(cell, Cons):
+            result.append(toPython(cell.head))
+            cell = asCons(cell.tail)
+        if cell is not NIL:
+            return value
+        return result
+    elif isinstance(value, tuple):
+        return tuple([toPython(element) for element in value])
+    return value
+
+#=============================================================================#
+#                                Interpreter                                  #
+#=============================================================================#
+
+class VM(Interpreter):
+    """
+    Runs the code generated by :func:`cpl.compiler.compile`. Use `enterVM`
+    or `callVM` to call a function of the loaded program.
+    """
+    
+    registerNames = ["PC", "FP"]
+    memoryNames = ["S", "X", "F", "R", "H"]
+    
+    def __init__(self):
+        Interpreter.__init__(self)
+        self.generic = set()
+        self.S = Stack()
+        self.X = Stack()
+        self.F = Stack()
+        self.R = Stack()
+        self.H = Heap()
+        self.FP = self.F.ptr(0)
+        self.funs = {}
+    
+    def resetVM(self):
+        Interpreter.resetVM(self)
+        self.S.clear()
+        self.X.clear()
+        self.F.clear()
+        self.R.clear()
+        self.H.clear()
+        self.FP.v = 0
+        self.funs.clear()
+    
+    def enterVM(self, target, args):
+        """
+        Prepares calling the function `target` (a label or index) with the
+        python values `args`, which are converted by :func:`fromPython`. The
+        interpreter halts when the function returns, leaving the result on
+        the stack.
+        """
+        index = self.resolveVMCallee(target, len(args))
+        self.S.extend([fromPython(arg) for arg in args])
+        self.R.append((None, self.FP.v, None))
+        self.FP.v = len(self.F)
+        self.PC.v = index
+    
+    def callVM(self, target, *args):
+        """
+        Calls the function `target` with `args` and returns the result,
+        converted by :func:`toPython`.
+        """
+        self.enterVM(target, args)
+        if not self.runVM():
+            error("stopped at a breakpoint")
+        return toPython(self.S.pop())
+    
+    def loadVM(self, instructions):
+        Interpreter.loadVM(self, instructions)
+        self.generic.clear()
+    
+    def loadVMModule(self, name, instructions):
+        self.generic.clear()
+        return Interpreter.loadVMModule(self, name, instructions)
+    
+    def genericVMArithmetic(self, op, left, right, a, b):
+        """
+        Called by the specialized variants of `arith` for operands of other
+        types: turns the executing instruction back into `arith` for good
+        and returns the result of the generic operation.
+        """
+        self.generic.add(self.vmExecutingIndex())
+        self.quickenVM("arith", op, left, right)
+        return arithmetic(op, a, b)
+    
+    def resolveVMJump(self, target):
+        """
+        Returns the program storage index of the jump target `target`, which
+        is a label or an index already bound by the linker.
+        """
+        if isinstance(target, (int, long)):
+            return target
+        return self.PS.indexOfLabel(target)
+    
+    # ------------------------------------------------------------------------ #
+    
+    def jmp(target):
+        PC.v = resolveVMJump(target)
+    
+    def jmpf(target):
+        if S.pop() == "false":
+            PC.v = resolveVMJump(target)
+    
+    def enter(arity, size):
+        start = len(S) - arity
+        frame = S.values(start)
+        S.truncate(start)
+        F.extend(frame + [None] * (size - arity))
+    
+    def call(target, arity):
+        index = resolveVMCall(target, arity)
+        R.append((PC.copy(), FP.v, None))
+        FP.v = len(F)
+        PC.v = index
+    
+    def callext(target, arity):
+        index = resolveVMCall(target, arity)
+        R.append((PC.copy(), FP.v, None))
+        FP.v = len(F)
+        PC.v = index
+    
+    def callfun(arity):
+        fun = S.pop()
+        if not isinstance(fun, Pointer) or fun.target is not H or not isinstance(H[fun], Closure):
+            error("badfun")
+        index = resolveVMCall(H[fun], arity)
+        R.append((PC.copy(), FP.v, fun))
+        FP.v = len(F)
+        PC.v = index
+    
+    def ret():
+        F.truncate(FP.v)
+        address, fp, fun = R.pop()
+        FP.v = fp
+        if address is None:
+            raise InterpreterHalt
+        PC.v = address.v
+    
+    def mkclosure(target, arity, size):
+        start = len(S) - size
+        env = S.values(start)
+        S.truncate(start)
+        S.append(H.new(Closure(target, arity, env)))
+    
+    def loadfun(target, arity):
+        entry = funs.get(target)
+        # The heap may have been reset or restored since the closure was made
+        if entry == None or entry[0].v >= len(H) or H[entry[0]] is not entry[1]:
+            closure = Closure(target, arity, [])
+            entry = funs[target] = (H.new(closure), closure)
+        S.append(entry[0].copy())
+    
+    def envget(slot):
+        S.append(H[R[-1][2]].env[slot])
+    
+    def fail(reason):
+        error(reason)
+    
+    def push(value):
+        S.append(value)
+    
+    def pop():
+        S.pop()
+    
+    def dup():
+        S.append(S[-1])
+    
+    def load(reg):
+        S.append(X[reg])
+    
+    def store(reg):
+        X[reg] = S.pop()
+    
+    def sload(slot):
+        S.append(F[FP.v + slot])
+    
+    def sstore(slot):
+        F[FP.v + slot] = S.pop()
+    
+    def move(dst, src):
+        X[dst] = X[src]
+    
+    def spill(reg, slot):
+        # Registers are saved before they are written in some paths
+        F[FP.v + slot] = X[reg] if reg < len(X) else None
+    
+    def reload(slot, reg):
+        X[reg] = F[FP.v + slot]
+    
+    def arith(op, left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if vmExecutingIndex() not in generic:
+            name = specializedArithmetic(op, a, b)
+            if name != None:
+                quickenVM(name, left, right)
+        S.append(arithmetic(op, a, b))
+    
+    def addi(left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if a.__class__ in intClasses and b.__class__ in intClasses:
+            S.append(a + b)
+        else:
+            S.append(genericVMArithmetic("+", left, right, a, b))
+    
+    def subi(left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if a.__class__ in intClasses and b.__class__ in intClasses:
+            S.append(a - b)
+        else:
+            S.append(genericVMArithmetic("-", left, right, a, b))
+    
+    def muli(left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if a.__class__ in intClasses and b.__class__ in intClasses:
+            S.append(a * b)
+        else:
+            S.append(genericVMArithmetic("*", left, right, a, b))
+    
+    def divi(left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if a.__class__ in intClasses and b.__class__ in intClasses and b != 0:
+            S.append(vector.intdiv(a, b))
+        else:
+            S.append(genericVMArithmetic("div", left, right, a, b))
+    
+    def modi(left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if a.__class__ in intClasses and b.__class__ in intClasses and b != 0:
+            S.append(intmod(a, b))
+        else:
+            S.append(genericVMArithmetic("mod", left, right, a, b))
+    
+    def addf(left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if a.__class__ is float and b.__class__ is float:
+            S.append(a + b)
+        else:
+            S.append(genericVMArithmetic("+", left, right, a, b))
+    
+    def subf(left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if a.__class__ is float and b.__class__ is float:
+            S.append(a - b)
+        else:
+            S.append(genericVMArithmetic("-", left, right, a, b))
+    
+    def mulf(left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if a.__class__ is float and b.__class__ is float:
+            S.append(a * b)
+        else:
+            S.append(genericVMArithmetic("*", left, right, a, b))
+    
+    def divf(left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        if a.__class__ is float and b.__class__ is float and b != 0.0:
+            S.append(a / b)
+        else:
+            S.append(genericVMArithmetic("/", left, right, a, b))
+    
+    def cmp(op, left, right):
+        b = S.pop() if right == None else X[right]
+        a = S.pop() if left == None else X[left]
+        S.append(comparison(op, a, b))
+    
+    def logic(op):
+        b = S.pop()
+        a = S.pop()
+        if a not in ("true", "false") or b not in ("true", "false"):
+            error("badarg")
+        if op == "and":
+            S.append("true" if a == "true" and b == "true" else "false")
+        else:
+            S.append("true" if a == "true" or b == "true" else "false")
+    
+    def neg():
+        value = S.pop()
+        if not isNumber(value):
+            error("badarith")
+        S.append(-value)
+    
+    def not_():
+        value = S.pop()
+        if value == "true":
+            S.append("false")
+        elif value == "false":
+            S.append("true")
+        else:
+            error("badarg")
+    
+    def nil():
+        S.append(NIL)
+    
+    def cons():
+        tail = S.pop()
+        S.append(Cons(S.pop(), tail))
+    
+    def mklist(size):
+        start = len(S) - size
+        result = NIL
+        for value in reversed(S.values(start)):
+            result = Cons(value, result)
+        S.truncate(start)
+        S.append(result)
+    
+    def mktuple(size):
+        start = len(S) - size
+        result = tuple(S.values(start))
+        S.truncate(start)
+        S.append(result)
+    
+    def mconst(value, fail):
+        if compareTerms(S.pop(), value, True) != 0:
+            PC.v = resolveVMJump(fail)
+    
+    def mequal(fail):
+        b = S.pop()
+        if compareTerms(S.pop(), b, True) != 0:
+            PC.v = resolveVMJump(fail)
+    
+    def mtuple(size, fail):
+        value = S.pop()
+        if isinstance(value, tuple) and len(value) == size:
+            S.extend(value[::-1])
+        else:
+            PC.v = resolveVMJump(fail)
+    
+    def mcons(fail):
+        value = asCons(S.pop())
+        if isinstance(value, Cons):
+            S.extend((value.tail, value.head))
+        else:
+            PC.v = resolveVMJump(fail)
+    
+    def mnil(fail):
+        value = S.pop()
+        if value is not NIL and not (isinstance(value, vector.NumericArray) and len(value) == 0):
+            PC.v = resolveVMJump(fail)
+    
+    def bbuild(specs):
+        start = len(S) - len(specs)
+        values = S.values(start)
+        S.truncate(start)
+        try:
+            S.append(binary.build(specs, values))
+        except (ValueError, TypeError):
+            error("badarg")
+    
+    def bmatch(specs, fail):
+        data = S.pop()
+        values = binary.match(data, specs) if isinstance(data, binary.BinaryData) else None
+        if values == None:
+            S.append(data)
+            PC.v = resolveVMJump(fail)
+        else:
+            S.extend(values)
+    
+    def bslice():
+        length = S.pop()
+        offset = S.pop()
+        try:
+            S.append(S.pop().slice(offset, length))
+        except (IndexError, AttributeError):
+            error("badarg")
+    
+    def bsize():
+        value = S.pop()
+        if not isinstance(value, binary.BinaryData):
+            error("badarg")
+        S.append(len(value))
+    
+    def bop(op):
+        b = S.pop()
+        a = S.pop()
+        try:
+            S.append(binary.bitwise(op, a, b))
+        except (ValueError, TypeError):
+            error("badarith")
+    
+    def bnot():
+        try:
+            S.append(binary.bnot(S.pop()))
+        except TypeError:
+            error("badarith")
+    
+    def bload():
+        path = S.pop()
+        if isinstance(path, binary.BinaryData):
+            path = path.tobytes()
+        try:
+            S.append(nondeterministic("asset", binary.loadAsset, path))
+        except (IOError, ValueError):
+            error("badarg")
+    
+    def vconst(values):
+        S.append(vector.NumericArray(values))
+    
+    def vpack():
+        value = S.pop()
+        values = numericValues(value)
+        S.append(value if values == None else vector.NumericArray(values))
+    
+    def vop(op):
+        b = vectorOperand(S.pop())
+        a = vectorOperand(S.pop())
+        try:
+            result = vector.elementwise(op, a, b)
+        except (ValueError, ZeroDivisionError, vector.VectorOverflow):
+            error("badarith")
+        S.append(vector.NumericArray(result) if isinstance(result, array) else result)
+    
+    def vmap(kernel, fallback):
+        value = S.pop()
+        values = numericValues(value)
+        if values != None:
+            try:
+                S.append(vector.NumericArray(vector.applyKernel(kernel, values)))
+                return
+            except (ZeroDivisionError, vector.VectorOverflow):
+                # The fallback raises the error or computes big integers
+                pass
+        S.append(value)
+        PC.v = resolveVMJump(fallback)
+    
+    def vfold(op, kernel, fallback):
+        acc = S.pop()
+        value = S.pop()
+        values = numericValues(value)
+        if values != None and isNumber(acc):
+            try:
+                S.append(vector.fold(op, acc, vector.applyKernel(kernel, values)))
+                return
+            except (ZeroDivisionError, vector.VectorOverflow):
+                pass
+        S.extend((value, acc))
+        PC.v = resolveVMJump(fallback)
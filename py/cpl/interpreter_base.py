@@ -18,12 +18,15 @@
 #  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import inspect, sys
+import sys
+from bisect import bisect_left
 from weakref import WeakKeyDictionary
 from functools import wraps
 from types import FunctionType
 
 from kvo.broker import KVOBroker, ROBroker
+from kvo.interface import IRangeObserver, implements
+from compiler_base import Instruction, functionArgs, parseFunLabel
 
 def makeInterpreterMethodWrapper(method_name, method):
     @wraps(method)
@@ -44,15 +47,16 @@ class InterpreterMetaClass(type):
             nmethods = []
             imethods = {}
         elif base is Interpreter:
-            nmethods = base.__cglobals__["__nmethods__"]
-            imethods = base.__cglobals__["__imethods__"]
+            # Copies, or the methods of all interpreters would end up in each
+            nmethods = list(base.__cglobals__["__nmethods__"])
+            imethods = dict(base.__cglobals__["__imethods__"])
         else:
             raise ValueError("Interpreters cannot inherit from other interpreters.")
         
         replace = {}
         for name, obj in classDict.iteritems():
             if isinstance(obj, FunctionType):
-                args = inspect.getargspec(obj).args
+                args = functionArgs(obj)
                 if len(args) == 0 or args[0] != "self":
                     if name.endswith("_"):
                         replace[name] = name[:-1]
@@ -97,6 +101,9 @@ class Interpreter(object):
     #: A list of attribute names which form the registers of the interpreter. Make sure to add the program counter `PC`.
     registerNames = ["PC"]
     
+    #: A list of attribute names of the memories (stacks and heaps) of the interpreter. Together with the registers, they form the state saved in snapshots (see :mod:`cpl.snapshot`).
+    memoryNames = []
+    
     def __init__(self):
         iglobals = self.__cglobals__.copy()
         for name in iglobals["__nmethods__"]:
@@ -110,8 +117,14 @@ class Interpreter(object):
         self.PS = ProgramStorage()
         self.PC = Pointer(self.PS)
         
-        self.__breakpointHit = False
+        self.__executing = None
+        self.__breakpointHit = None
         self.__breakpoints = set()
+        self.__watchpoints = []
+        self.__watchHit = None
+        self.__profiler = None
+        self.__replay = None
+        self.__callCache = InlineCache(self.PS, self.resolveVMCallee)
     
     def __getattr__(self, name):
         if name == "__iglobals__":
@@ -132,18 +145,20 @@ class Interpreter(object):
         Resets the interpreters state. Should be overriden and called by
         subclasses.
         """
-        self.PC.setTo(0)
-        self.__breakpointHit = False
+        self.PC.v = 0
+        self.__breakpointHit = None
+        self.__watchHit = None
     
     def loadVM(self, instructions):
         """Loads a program into the program storage."""
         self.PS.load(instructions)
+        self.__patchBreakpoints()
     
     def runVM(self):
         """
         Runs the loaded program by calling `stepVM()` until `InterpreterHalt` or
         `InterpreterBreakpoint` is raised. Returns `True` on halt and `False` on
-        a breakpoint.
+        a breakpoint. The attached recorder, if any, is flushed afterwards.
         """
         try:
             while True:
@@ -152,35 +167,84 @@ class Interpreter(object):
             return True
         except InterpreterBreakpoint:
             return False
+        finally:
+            if self.__replay is not None:
+                self.__replay.flush()
+    
+    def runVMSlice(self, budget):
+        """
+        Performs at most `budget` steps. Returns `True` on halt, `False` on a
+        breakpoint and `None` if the budget was used up. Used by runners which
+        interleave the interpreter with other work, see :mod:`cpl.runner`. The
+        attached recorder, if any, is flushed after each slice.
+        """
+        try:
+            for i in xrange(budget):
+                self.stepVM()
+        except InterpreterHalt:
+            return True
+        except InterpreterBreakpoint:
+            return False
+        finally:
+            if self.__replay is not None:
+                self.__replay.flush()
+        return None
     
     def stepVM(self):
-        """Performs one computation step."""
-        if not self.__breakpointHit and int(self.PC) in self.__breakpoints:
-            self.__breakpointHit = True
-            raise InterpreterBreakpoint
-        
-        self.__breakpointHit = False
-        
+        """
+        Performs one computation step. Breakpoints are trap instructions
+        patched into the program storage, so no check is needed here; only
+        watchpoints which were hit by the instruction are reported after it.
+        """
+        # This runs for every instruction, so the state is accessed in the
+        # instance globals directly instead of through __getattr__
+        state = self.__iglobals__
+        PC = state["PC"]
+        index = state["_Interpreter__executing"] = PC.v
+        hit = state["_Interpreter__breakpointHit"]
+        if hit is not None and hit != index:
+            # The program counter was moved away from the breakpoint
+            state["_Interpreter__breakpointHit"] = None
+        state["_Interpreter__watchHit"] = None
         IR = self.nextVMInstruction()
-        self.PC >> 1
+        PC >> 1
         
         f = getattr(self, IR.name)
-        f(*IR.args)
+        profiler = state["_Interpreter__profiler"]
+        if profiler is None:
+            f(*IR.args)
+        else:
+            profiler.step(index, f, IR.args)
+        
+        hit = state["_Interpreter__watchHit"]
+        if hit is not None:
+            state["_Interpreter__watchHit"] = None
+            raise InterpreterWatchpoint(*hit)
     
     def nextVMInstruction(self):
         """Returns the next instruction to execute."""
         return self.PS[self.PC]
     
+    def vmExecutingIndex(self):
+        """
+        Returns the program storage index of the instruction being executed.
+        Unlike the program counter, it stays the same when the handler jumps.
+        """
+        return self.__executing
+    
     def setVMBreakpoint(self, index):
         """
         Sets a breakpoint at the instruction specified by `index`.
         
         Running `stepVM` will raise `InterpreterBreakpoint` on that instruction.
-        A second call to `stepVM` continues normally.
+        A second call to `stepVM` continues normally. Breakpoints are kept when
+        loading programs and patched in as soon as their instruction exists.
         """
         self.__breakpoints.add(index)
+        if index < len(self.PS):
+            self.PS.setTrap(index)
         if self.PC == index:
-            self.__breakpointHit = True
+            self.__breakpointHit = index
     
     def setVMBreakpoints(self, indexes):
         """
@@ -188,13 +252,15 @@ class Interpreter(object):
         
         Replaces the existing set of breakpoints.
         """
-        self.__breakpoints = set(indexes)
-        if self.PC.v in indexes:
-            self.__breakpointHit = True
+        self.clearVMBreakpoints()
+        for index in indexes:
+            self.setVMBreakpoint(index)
     
     def resetVMBreakpoint(self, index):
         """Removes a breakpoint at the instruction specified by `index`."""
         self.__breakpoints.remove(index)
+        if self.PS.hasTrap(index):
+            self.PS.clearTrap(index)
     
     def hasVMBreakpoint(self, index):
         """
@@ -209,7 +275,236 @@ class Interpreter(object):
     
     def clearVMBreakpoints(self):
         """Removes all breakpoints."""
-        self.__breakpoints.remove()
+        self.__breakpoints.clear()
+        self.PS.clearTraps()
+    
+    def __patchBreakpoints(self):
+        for index in self.__breakpoints:
+            if index < len(self.PS) and not self.PS.hasTrap(index):
+                self.PS.setTrap(index)
+    
+    def setVMWatchpoint(self, memory, start, end=None):
+        """
+        Sets a watchpoint on the values from `start` to `end` (exclusive,
+        `start + 1` by default) of `memory`, which is a stack or heap or the
+        name of one. When an instruction changes, adds or removes watched
+        values, `stepVM` raises `InterpreterWatchpoint` after the instruction
+        has been executed. Returns the :class:`Watchpoint`.
+        """
+        if isinstance(memory, basestring):
+            memory = getattr(self, memory)
+        watchpoint = Watchpoint(memory, start, start + 1 if end == None else end, self.__watchpointHit)
+        self.__watchpoints.append(watchpoint)
+        return watchpoint
+    
+    def resetVMWatchpoint(self, watchpoint):
+        """Removes the given watchpoint."""
+        self.__watchpoints.remove(watchpoint)
+        watchpoint.detach()
+    
+    def allVMWatchpoints(self):
+        """Returns a list of all watchpoints."""
+        return list(self.__watchpoints)
+    
+    def clearVMWatchpoints(self):
+        """Removes all watchpoints."""
+        for watchpoint in self.__watchpoints:
+            watchpoint.detach()
+        self.__watchpoints = []
+    
+    def discardVMWatchpointHit(self):
+        """
+        Discards a watchpoint hit which has not been reported yet. Call this
+        after changing watched memory from outside of `stepVM`, e.g. when
+        restoring a snapshot.
+        """
+        self.__watchHit = None
+    
+    def __watchpointHit(self, watchpoint, rangeFrom, rangeTo):
+        if self.__watchHit is None:
+            self.__watchHit = (watchpoint, rangeFrom, rangeTo)
+    
+    def attachVMProfiler(self, profiler):
+        """
+        Attaches a profiler to this interpreter. Every instruction executed by
+        `stepVM` will be reported to the profiler's `step` method from now on.
+        Only one profiler can be attached at a time. See
+        :class:`cpl.profiler.Profiler`.
+        """
+        self.__profiler = profiler
+    
+    def detachVMProfiler(self):
+        """Detaches the currently attached profiler, if any."""
+        self.__profiler = None
+    
+    def vmProfiler(self):
+        """Returns the currently attached profiler or `None`."""
+        return self.__profiler
+    
+    def attachVMReplay(self, replay):
+        """
+        Attaches a recorder or replayer for nondeterministic inputs, see
+        :mod:`cpl.replay`. Only one can be attached at a time. It must provide
+        `value(kind, producer, args)`, `flush()` and the `replaying` flag.
+        """
+        self.__replay = replay
+    
+    def detachVMReplay(self):
+        """Detaches the currently attached recorder or replayer, if any."""
+        self.__replay = None
+    
+    def vmReplay(self):
+        """Returns the attached recorder or replayer or `None`."""
+        return self.__replay
+    
+    def nondeterministic(self, kind, producer, *args):
+        """
+        Returns the result of calling `producer` with `args`. Instruction
+        handlers must obtain all inputs which are not determined by the
+        program through this method, e.g. `nondeterministic("time", time)`;
+        `kind` names the input. While recording, the value is logged; while
+        replaying, the recorded value is returned and `producer` is not
+        called.
+        """
+        if self.__replay is None:
+            return producer(*args)
+        return self.__replay.value(kind, producer, args)
+    
+    def waitVM(self, future):
+        """
+        Returns the result of `future`, which is an `asyncio` future or any
+        object with the same `done` and `result` methods. If it is not done
+        yet, the program counter is moved back to the current instruction and
+        `InterpreterWait` is raised; a runner resumes the interpreter once the
+        future is done, which executes the instruction again. Instruction
+        handlers must therefore wait before changing any state. The result is
+        an input in the sense of `nondeterministic`; while replaying, the
+        recorded result is returned right away.
+        """
+        replay = self.__replay
+        if (replay is None or not replay.replaying) and not future.done():
+            self.PC.v = self.__executing
+            raise InterpreterWait(future)
+        return self.nondeterministic("future", future.result)
+    
+    def resolveVMCall(self, callee, arity):
+        """
+        Returns the program storage index of the code to run for calling
+        `callee` with `arity` arguments from the currently executing
+        instruction. Call instructions should use this instead of looking up
+        the callee themselves, as the result is cached per call site; see
+        :class:`InlineCache`. Closures are cached by their code, so all
+        closures of a fun share one entry.
+        """
+        if isinstance(callee, Closure):
+            if callee.arity != arity:
+                error("bad arity: fun of arity %d called with %d arguments" % (callee.arity, arity))
+            callee = callee.target
+        return self.__callCache.lookup(self.__executing, callee, arity)
+    
+    def resolveVMCallee(self, callee, arity):
+        """
+        Looks up the program storage index for calling `callee` with `arity`
+        arguments, bypassing the inline cache. By default `callee` is a label
+        or an index already bound by the linker or `ProgramStorage.loadModule`;
+        function labels (see :func:`cpl.compiler_base.funLabel`) are checked
+        for the right arity, as are closures. Override this to support other
+        kinds of callees.
+        """
+        if isinstance(callee, (int, long)):
+            return callee
+        if isinstance(callee, Closure):
+            if callee.arity != arity:
+                error("bad arity: fun of arity %d called with %d arguments" % (callee.arity, arity))
+            return self.resolveVMCallee(callee.target, arity)
+        label = parseFunLabel(callee)
+        if label != None and label[2] != arity:
+            error("bad arity: %s called with %d arguments" % (callee, arity))
+        try:
+            return self.PS.indexOfLabel(callee)
+        except KeyError:
+            error("undefined function %s" % (callee))
+    
+    def quickenVM(self, name, *args):
+        """
+        Replaces the currently executing instruction by the instruction `name`
+        with `args`, so following executions run the specialized variant (see
+        `ProgramStorage.quicken`). Handlers call this after their first
+        execution, e.g. with a resolved label, a cached constant or typed
+        arithmetic. Nothing is done if the interpreter has no handler for
+        `name`. Returns `True` if the instruction was replaced.
+        """
+        if not hasattr(self, name):
+            return False
+        self.PS.quicken(self.__executing, Instruction(name, *args))
+        return True
+    
+    def loadVMModule(self, name, instructions):
+        """
+        Loads a new version of a module while the program keeps running. See
+        `ProgramStorage.loadModule`. Purged code which is not referenced any
+        more is reclaimed first, so the new version may take its place.
+        """
+        self.reclaimVMCode()
+        version = self.PS.loadModule(name, instructions)
+        self.__patchBreakpoints()
+        return version
+    
+    def purgeVMModule(self, name, soft=False):
+        """
+        Purges the old code of a module. If `soft` is `True`, nothing is purged
+        if the interpreter state still refers to that code (see
+        `vmCodeReferences`). Returns `True` if old code was purged.
+        """
+        if soft:
+            versions = self.PS.moduleVersions(name)
+            if len(versions) > 1:
+                for index in self.vmCodeReferences():
+                    if index in versions[-1]:
+                        return False
+        purged = self.PS.purgeModule(name)
+        self.__patchBreakpoints()
+        return purged
+    
+    def vmCodeReferences(self):
+        """
+        Returns the set of program storage indexes the interpreter state refers
+        to: the program counter and the pointers into the program storage found
+        in the registers and memories, also inside heap objects and closures
+        bound to indexes. Return addresses have to be kept as such pointers
+        (see `ProgramStorage.ptr`) to be found.
+        """
+        PS = self.PS
+        references = set([self.PC.v])
+        todo = [getattr(self, name) for name in self.registerNames]
+        for name in self.memoryNames:
+            todo.extend(getattr(self, name).values())
+        while len(todo) > 0:
+            value = todo.pop()
+            if isinstance(value, Pointer):
+                if value.target is PS:
+                    references.add(value.v)
+            elif isinstance(value, Closure):
+                if isinstance(value.target, (int, long)):
+                    references.add(value.target)
+                todo.extend(value.env)
+            elif isinstance(value, HeapObject):
+                todo.extend(getattr(value, "values", ()))
+            elif isinstance(value, (list, tuple)):
+                todo.extend(value)
+        return references
+    
+    def reclaimVMCode(self):
+        """
+        Frees the slots of purged code the interpreter state does not refer to
+        any more, see `ProgramStorage.reclaim`. Returns the number of freed
+        slots.
+        """
+        return self.PS.reclaim(self.vmCodeReferences())
+    
+    def vmCallCache(self):
+        """Returns the inline cache used by `resolveVMCall`."""
+        return self.__callCache
     
     # ------------------------------------------------------------------------ #
     
@@ -220,6 +515,33 @@ class Interpreter(object):
     def halt(self):
         """Generic instruction. Raises `InterpreterHalt`."""
         raise InterpreterHalt
+    
+    def purged(self):
+        """
+        Generic instruction. Takes the place of purged code and raises
+        `InterpreterError`.
+        """
+        error("executing purged code")
+    
+    def trap(self):
+        """
+        Generic instruction. Patched into the program storage at breakpoints;
+        raises `InterpreterBreakpoint` the first time and executes the
+        instruction it displaced the next time.
+        """
+        index = self.__executing
+        if self.__breakpointHit != index:
+            self.__breakpointHit = index
+            self.PC << 1
+            raise InterpreterBreakpoint
+        self.__breakpointHit = None
+        IR = self.PS.trapped(index)
+        try:
+            getattr(self, IR.name)(*IR.args)
+        except InterpreterWait:
+            # The instruction will be executed again, not the breakpoint
+            self.__breakpointHit = index
+            raise
 
 class Pointer(KVOBroker):
     """
@@ -249,6 +571,11 @@ class Pointer(KVOBroker):
         self.__t = target
         self.__v = int(initial)
     
+    @property
+    def target(self):
+        """The list-like object the pointer points into."""
+        return self.__t
+    
     @property
     def v(self):
         return self.__v
@@ -312,25 +639,100 @@ class Pointer(KVOBroker):
     def __str__(self):
         return "-> %s[%d]" % (str(self.__t), self.__v)
 
+class ModuleVersion(object):
+    """
+    A version of a module loaded into a program storage, occupying the
+    instructions from `start` to `end` (exclusive). `labels` maps the labels of
+    this version to their indexes.
+    """
+    
+    def __init__(self, name, start, end, labels):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.labels = labels
+    
+    def __contains__(self, index):
+        return self.start <= index < self.end
+    
+    def __repr__(self):
+        return "ModuleVersion(%r, %d, %d)" % (self.name, self.start, self.end)
+
 class ProgramStorage(object):
     """
     Instances of this class hold instructions for virtual machines. On the first
     setup, all labels are resolved to their indexes and stored for faster
     lookup.
     
-    Instructions can only be loaded in bulk and are later read-only. Otherwise
-    this object behaves like a list.
+    Instructions are either loaded in bulk or module by module. Afterwards
+    the only change allowed is quickening: an instruction handler may replace
+    its own slot with a specialized variant (see `quicken`), which keeps the
+    label and source location of the slot. The original instructions are
+    remembered and restored whenever code is loaded, purged or deleted, as
+    quickened instructions may depend on resolved labels.
+    
+    Breakpoints are implemented by patching `trapInstruction` into slots (see
+    `setTrap`); the displaced instruction is executed by the trap's handler.
+    Otherwise this object behaves like a list.
+    
+    Modules support hot code loading like in Erlang: loading a new version of a
+    module appends it to the storage and makes it the current version, while the
+    previous one stays in place as old version. Code running in the old version
+    keeps doing so until it calls a function by label, which resolves to the
+    current version. The old version has to be purged before yet another version
+    can be loaded. Purged code stays in place as `purgedInstruction` until
+    nothing refers to it any more; then its slots are reused for later versions
+    (see `reclaim`), so the storage does not grow with each reload.
+    
+    The code of a module may also be part of a program loaded in bulk, which
+    makes it possible to load a whole program first and reload its modules later
+    on. Loading the module for the first time then turns that code into its old
+    version.
     """
     
+    #: Instructions whose label arguments are not bound to indexes when loading a module, so they always reach the current version.
+    lateBoundInstructions = set(["callext", "callfun"])
+    
+    #: Placeholder for the instructions of purged code.
+    purgedInstruction = Instruction("purged")
+    
+    #: Name of the instruction patched in at breakpoints.
+    trapInstruction = "trap"
+    
     def __init__(self):
+        self.__generation = -1
         self.clear()
     
     def clear(self):
         """
-        Removes all instructions and clears the label lookup dictionary.
+        Removes all instructions and modules and clears the label lookup
+        dictionary.
         """
         self.__l = []
         self.__lbl = {}
+        self.__owners = {}
+        self.__modules = {}
+        self.__bulk = {}
+        self.__bulkEnd = 0
+        self.__adopted = set()
+        self.__purged = []
+        self.__free = []
+        self.__originals = {}
+        self.__traps = {}
+        self.__generation += 1
+    
+    def __changed(self):
+        self.restoreAll()
+        self.__generation += 1
+    
+    @property
+    def generation(self):
+        """
+        A counter which is increased whenever the contents of the program
+        storage change. Caches of resolved indexes must be discarded if it
+        differs from the value they were filled at.
+        """
+        return self.__generation
     
     def load(self, instructions):
         """
@@ -345,6 +747,319 @@ class ProgramStorage(object):
             if instr.label != None:
                 self.__lbl[instr.label] = i
             i += 1
+        self.__bulk = dict(self.__lbl)
+        self.__bulkEnd = i
+    
+    def loadModule(self, name, instructions):
+        """
+        Loads a new version of the module `name` without touching the rest of
+        the program. `instructions` is a list of instructions compiled with
+        `name` as label namespace (or a :class:`cpl.build.CompiledModule`).
+        
+        Label arguments referring to the module's own labels are bound to the
+        indexes of this version, except for the `lateBoundInstructions`. The
+        module's labels are looked up in this version from now on. Raises
+        `ValueError` if the module still has old code or a label is already
+        defined by another module. The new version is placed into the slots of
+        reclaimed code if a large enough range is free and appended otherwise.
+        
+        If the module has no version yet, the code loaded in bulk which carries
+        its labels (its function labels, labels in its namespace and labels of
+        the new version) becomes the old version. Its label arguments are bound
+        to its own indexes first, so it keeps running in itself like any other
+        old version. This code has to be contiguous.
+        """
+        versions = self.__modules.get(name, [])
+        if len(versions) > 1:
+            raise ValueError("old code of module %s must be purged first" % (name))
+        
+        instructions = list(getattr(instructions, "instructions", instructions))
+        for instr in instructions:
+            if instr.label != None and self.__owners.get(instr.label, name) != name:
+                raise ValueError("label %s of module %s is already defined by module %s" % (instr.label, name, self.__owners[instr.label]))
+        
+        if len(versions) == 0:
+            old = self.__adoptBulk(name, set([instr.label for instr in instructions if instr.label != None]))
+            if old != None:
+                versions = [old]
+        
+        start = self.__allocate(len(instructions))
+        labels = {}
+        i = start
+        for instr in instructions:
+            if instr.label != None:
+                labels[instr.label] = i
+            i += 1
+        
+        i = start
+        for instr in instructions:
+            instr = self.__bind(instr, labels)
+            if i < len(self.__l):
+                self.__l[i] = instr
+            else:
+                self.__l.append(instr)
+            i += 1
+        
+        if len(versions) > 0:
+            for label in versions[0].labels:
+                del self.__lbl[label]
+                del self.__owners[label]
+        self.__lbl.update(labels)
+        for label in labels:
+            self.__owners[label] = name
+        self.__modules[name] = [ModuleVersion(name, start, start + len(instructions), labels)] + versions
+        self.__changed()
+        return self.__modules[name][0]
+    
+    def __bind(self, instr, labels):
+        if instr.name in self.lateBoundInstructions:
+            return instr
+        args = [labels.get(arg, arg) if isinstance(arg, str) else arg for arg in instr.args]
+        if args == list(instr.args):
+            return instr
+        return Instruction(instr.name, *args, label=instr.label, loc=instr.loc)
+    
+    def __adoptBulk(self, name, labels):
+        prefix = name + "."
+        own = {}
+        for label, index in self.__bulk.iteritems():
+            if label in self.__adopted:
+                continue
+            fun = parseFunLabel(label)
+            if label in labels or label.startswith(prefix) or (fun != None and fun[0] == name):
+                own[label] = index
+        if len(own) == 0:
+            return None
+        
+        # The module's code ends where the code of the next one begins
+        start = min(own.itervalues())
+        last = max(own.itervalues())
+        end = self.__bulkEnd
+        for label, index in self.__bulk.iteritems():
+            if own.has_key(label) or index < start:
+                continue
+            if index <= last:
+                raise ValueError("code of module %s loaded in bulk is interrupted by label %s" % (name, label))
+            end = min(end, index)
+        
+        self.restoreAll()
+        for i in xrange(start, end):
+            instr = self.trapped(i)
+            bound = self.__bind(instr, own)
+            if bound is not instr:
+                self.__put(i, bound)
+        for label in own:
+            self.__owners[label] = name
+        self.__adopted.update(own)
+        return ModuleVersion(name, start, end, own)
+    
+    def purgeModule(self, name):
+        """
+        Removes the old version of the module `name`. Its instructions are
+        replaced by `purgedInstruction`, so code still running in it fails.
+        The slots are not reused before `reclaim` finds no references to them.
+        Returns `True` if there was old code.
+        """
+        versions = self.__modules.get(name, [])
+        if len(versions) < 2:
+            return False
+        self.__changed()
+        old = versions.pop()
+        for index in self.__traps.keys():
+            if index in old:
+                del self.__traps[index]
+        if old.start < old.end:
+            self.__l[old.start:old.end] = [self.purgedInstruction] * (old.end - old.start)
+            self.__purged.append((old.start, old.end))
+        if versions[0].start == versions[0].end:
+            # The module was deleted
+            del self.__modules[name]
+        return True
+    
+    def deleteModule(self, name):
+        """
+        Makes the current version of the module `name` old, so it can be
+        purged; its labels cannot be looked up any more. Returns `False` if
+        the module still had old code and nothing was changed.
+        """
+        versions = self.__modules.get(name, [])
+        if len(versions) != 1:
+            return False
+        for label in versions[0].labels:
+            del self.__lbl[label]
+            del self.__owners[label]
+        versions.insert(0, ModuleVersion(name, versions[0].end, versions[0].end, {}))
+        self.__changed()
+        return True
+    
+    def __allocate(self, size):
+        # First fit among the ranges of purged code
+        if size > 0:
+            for i, (start, end) in enumerate(self.__free):
+                if end - start >= size:
+                    if end - start == size:
+                        del self.__free[i]
+                    else:
+                        self.__free[i] = (start + size, end)
+                    return start
+        return len(self.__l)
+    
+    def reclaim(self, references):
+        """
+        Frees the slots of purged code for reuse, except for ranges containing
+        one of the instruction indexes in `references`, which lists the places
+        in the program that may still be executed (the program counter, return
+        addresses, ...). Returns the number of freed slots.
+        """
+        references = sorted(references)
+        kept = []
+        freed = 0
+        for start, end in self.__purged:
+            i = bisect_left(references, start)
+            if i < len(references) and references[i] < end:
+                kept.append((start, end))
+            else:
+                self.__release(start, end)
+                freed += end - start
+        self.__purged = kept
+        return freed
+    
+    def __release(self, start, end):
+        i = bisect_left(self.__free, (start, end))
+        if i < len(self.__free) and self.__free[i][0] == end:
+            end = self.__free.pop(i)[1]
+        if i > 0 and self.__free[i-1][1] == start:
+            i -= 1
+            start = self.__free.pop(i)[0]
+        if end == len(self.__l):
+            del self.__l[start:]
+        else:
+            self.__free.insert(i, (start, end))
+    
+    def freeRanges(self):
+        """
+        Returns the ranges of reclaimed code as `(start, end)` tuples, which are
+        reused for later module versions.
+        """
+        return list(self.__free)
+    
+    def purgedRanges(self):
+        """
+        Returns the ranges of purged code which have not been reclaimed yet as
+        `(start, end)` tuples.
+        """
+        return sorted(self.__purged)
+    
+    def moduleVersions(self, name):
+        """
+        Returns the loaded versions of the module `name`, current version
+        first.
+        """
+        return list(self.__modules.get(name, []))
+    
+    def versionAt(self, index):
+        """
+        Returns the module version containing the instruction at `index` or
+        `None` if it was not loaded by `loadModule`.
+        """
+        for versions in self.__modules.itervalues():
+            for version in versions:
+                if index in version:
+                    return version
+        return None
+    
+    def isOldCode(self, index):
+        """Returns `True` if the instruction at `index` belongs to old code."""
+        version = self.versionAt(index)
+        return version != None and version is not self.__modules[version.name][0]
+    
+    def quicken(self, index, instruction):
+        """
+        Replaces the instruction at `index` by the specialized `instruction`,
+        which gets the label and source location of the replaced one. Label
+        lookups, breakpoints and profiles by index are not affected. Returns
+        the new instruction.
+        """
+        current = self.trapped(index)
+        if current is self.purgedInstruction:
+            raise ValueError("cannot quicken purged code at %d" % (index))
+        instruction = Instruction(instruction.name, *instruction.args, label=current.label, loc=current.loc)
+        self.__originals.setdefault(index, current)
+        self.__put(index, instruction)
+        return instruction
+    
+    def __put(self, index, instruction):
+        if self.__traps.has_key(index):
+            self.__traps[index] = instruction
+        else:
+            self.__l[index] = instruction
+    
+    def original(self, index):
+        """Returns the instruction at `index` as it was loaded."""
+        original = self.__originals.get(index)
+        if original != None:
+            return original
+        return self.trapped(index)
+    
+    def isQuickened(self, index):
+        """Returns `True` if the instruction at `index` has been quickened."""
+        return self.__originals.has_key(index)
+    
+    def quickened(self):
+        """Returns the sorted indexes of all quickened instructions."""
+        return sorted(self.__originals)
+    
+    def restore(self, index):
+        """Restores the original instruction at `index` if it was quickened."""
+        original = self.__originals.pop(index, None)
+        if original != None:
+            self.__put(index, original)
+    
+    def restoreAll(self):
+        """Restores all quickened instructions."""
+        for index, original in self.__originals.iteritems():
+            self.__put(index, original)
+        self.__originals = {}
+    
+    def setTrap(self, index):
+        """
+        Patches a trap instruction into the slot at `index`. It keeps the
+        label and source location of the displaced instruction, which is
+        returned by `trapped`.
+        """
+        if self.__traps.has_key(index):
+            return
+        current = self.__l[index]
+        self.__traps[index] = current
+        self.__l[index] = Instruction(self.trapInstruction, label=current.label, loc=current.loc)
+    
+    def clearTrap(self, index):
+        """Puts the instruction displaced by the trap at `index` back."""
+        self.__l[index] = self.__traps.pop(index)
+    
+    def clearTraps(self):
+        """Removes all traps."""
+        for index, instruction in self.__traps.iteritems():
+            self.__l[index] = instruction
+        self.__traps = {}
+    
+    def hasTrap(self, index):
+        """Returns `True` if a trap is patched in at `index`."""
+        return self.__traps.has_key(index)
+    
+    def traps(self):
+        """Returns the sorted indexes of all traps."""
+        return sorted(self.__traps)
+    
+    def trapped(self, index):
+        """
+        Returns the instruction to execute at `index`, i.e. the one displaced
+        by a trap if there is one there.
+        """
+        instruction = self.__traps.get(index)
+        if instruction != None:
+            return instruction
+        return self.__l[index]
     
     def ptr(self, loc):
         """
@@ -375,7 +1090,12 @@ class ProgramStorage(object):
         """
         i = 0
         for obj in self.__l:
-            print "%2d:" % i, obj
+            if self.__traps.has_key(i):
+                obj = "* %s" % (self.__traps[i])
+            if self.__originals.has_key(i):
+                print "%2d:" % i, obj, "(quickened from %s)" % (self.__originals[i].name)
+            else:
+                print "%2d:" % i, obj
             i += 1
     
     def __str__(self):
@@ -384,6 +1104,95 @@ class ProgramStorage(object):
     def __repr__(self):
         return "ProgramStorage(%s)" % repr(self.__l)
 
+MEGAMORPHIC = object()
+
+class InlineCache(object):
+    """
+    Per call site caches of resolved call targets.
+    
+    Every call instruction, identified by its index in the program storage,
+    gets its own cache entry. It starts out monomorphic, holding the one callee
+    and arity seen so far along with the resolved index. If a site sees
+    different callees, the entry becomes polymorphic and holds up to `size` of
+    them; beyond that it is marked megamorphic and every call is resolved
+    again. All entries are discarded when the generation of the program storage
+    changes, i.e. when code is (re)loaded.
+    
+    `resolve(callee, arity)` is called on cache misses and must return the
+    program storage index to call.
+    """
+    
+    def __init__(self, storage, resolve, size=4):
+        self.storage = storage
+        self.resolve = resolve
+        self.size = size
+        self.clear()
+    
+    def clear(self):
+        """Discards all entries and resets the statistics."""
+        self.__sites = {}
+        self.__generation = self.storage.generation
+        self.hits = 0
+        self.misses = 0
+    
+    def lookup(self, site, callee, arity):
+        """
+        Returns the index to call for `callee` with `arity` arguments at the
+        call site `site`.
+        """
+        if self.__generation != self.storage.generation:
+            self.__sites = {}
+            self.__generation = self.storage.generation
+        
+        entry = self.__sites.get(site)
+        if entry.__class__ is tuple:
+            if entry[0] == callee and entry[1] == arity:
+                self.hits += 1
+                return entry[2]
+            index = self.resolve(callee, arity)
+            self.misses += 1
+            if self.size > 1:
+                self.__sites[site] = {(entry[0], entry[1]): entry[2], (callee, arity): index}
+            else:
+                self.__sites[site] = MEGAMORPHIC
+            return index
+        elif entry is None:
+            index = self.resolve(callee, arity)
+            self.misses += 1
+            self.__sites[site] = (callee, arity, index)
+            return index
+        elif entry is MEGAMORPHIC:
+            self.misses += 1
+            return self.resolve(callee, arity)
+        
+        index = entry.get((callee, arity))
+        if index != None:
+            self.hits += 1
+            return index
+        index = self.resolve(callee, arity)
+        self.misses += 1
+        if len(entry) < self.size:
+            entry[(callee, arity)] = index
+        else:
+            self.__sites[site] = MEGAMORPHIC
+        return index
+    
+    def state(self, site):
+        """
+        Returns the state of the call site `site`: "uninitialized",
+        "monomorphic", "polymorphic" or "megamorphic".
+        """
+        if self.__generation != self.storage.generation:
+            return "uninitialized"
+        entry = self.__sites.get(site)
+        if entry is None:
+            return "uninitialized"
+        elif entry is MEGAMORPHIC:
+            return "megamorphic"
+        elif entry.__class__ is tuple:
+            return "monomorphic"
+        return "polymorphic"
+
 class Stack(ROBroker):
     """
     Instances of this class represent stacks for virtual machines. They act
@@ -410,10 +1219,10 @@ class Stack(ROBroker):
         resizing = False
         if key >= len(self.__l):
             resizing = True
-            self.notifyRangeWillIncrease(len(self.__l), key)
+            self.notifyRangeWillIncrease(len(self.__l), key+1)
             self.__l += [None] * (key - len(self.__l) + 1)
         else:
-            self.notifyRangeWillChange(key, key)
+            self.notifyRangeWillChange(key, key+1)
         
         if isinstance(value, Pointer):
             self.__l[key] = value.copy()
@@ -429,23 +1238,63 @@ class Stack(ROBroker):
         if len(self.__l) == 0:
             return
         
-        self.notifyRangeWillDecrease(0, len(self.__l)-1)
+        self.notifyRangeWillDecrease(0, len(self.__l))
         self.__l = []
         self.notifyRangeDidDecrease()
     
     def append(self, value):
-        self.notifyRangeWillIncrease(len(self.__l), len(self.__l))
+        self.notifyRangeWillIncrease(len(self.__l), len(self.__l)+1)
         self.__l.append(value)
         self.notifyRangeDidIncrease()
     
+    def extend(self, values):
+        """Appends all of the list `values`."""
+        if len(values) == 0:
+            return
+        
+        self.notifyRangeWillIncrease(len(self.__l), len(self.__l)+len(values))
+        self.__l.extend([value.copy() if isinstance(value, Pointer) else value for value in values])
+        self.notifyRangeDidIncrease()
+    
+    def truncate(self, length):
+        """Removes all values from the position `length` on."""
+        if length >= len(self.__l):
+            return
+        
+        self.notifyRangeWillDecrease(length, len(self.__l))
+        del self.__l[length:]
+        self.notifyRangeDidDecrease()
+    
+    def insert(self, index, value):
+        """Inserts `value` before the position `index`."""
+        self.notifyRangeWillIncrease(index, index+1)
+        self.__l.insert(index, value.copy() if isinstance(value, Pointer) else value)
+        self.notifyRangeDidIncrease()
+    
     def pop(self, index = -1):
         if index < 0:
             index = len(self.__l) + index
-        self.notifyRangeWillDecrease(index, index)
+        self.notifyRangeWillDecrease(index, index+1)
         item = self.__l.pop(index)
         self.notifyRangeDidDecrease()
         return item
     
+    def values(self, start=0, end=None):
+        """Returns a copy of the contents from `start` to `end` as list."""
+        if end == None:
+            return self.__l[start:]
+        return self.__l[start:end]
+    
+    def setValues(self, values):
+        """Replaces the whole contents by the list `values`."""
+        self.clear()
+        if len(values) == 0:
+            return
+        
+        self.notifyRangeWillIncrease(0, len(values))
+        self.__l = [value.copy() if isinstance(value, Pointer) else value for value in values]
+        self.notifyRangeDidIncrease()
+    
     def ptr(self, loc):
         """Returns a pointer object pointing to the specified location."""
         return Pointer(self, loc)
@@ -480,6 +1329,50 @@ class Heap(Stack):
         self.append(value)
         return p
 
+class Watchpoint(object):
+    """
+    Range observer on `memory` which calls `callback(watchpoint, rangeFrom,
+    rangeTo)` before values from `start` to `end` (exclusive) are changed,
+    added or removed. Removing values before the range also counts, as it
+    moves the watched values. See `Interpreter.setVMWatchpoint`.
+    """
+    
+    implements(IRangeObserver)
+    
+    def __init__(self, memory, start, end, callback):
+        self.memory = memory
+        self.start = start
+        self.end = end
+        self.callback = callback
+        memory.addRangeObserver(self)
+    
+    def detach(self):
+        self.memory.removeRangeObserver(self)
+    
+    def observedRangeWillChange(self, srcobject, rangeFrom, rangeTo):
+        if rangeFrom < self.end and rangeTo > self.start:
+            self.callback(self, rangeFrom, rangeTo)
+    
+    def observedRangeDidChange(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeWillIncrease(self, srcobject, rangeFrom, rangeTo):
+        if rangeFrom < self.end and rangeTo > self.start:
+            self.callback(self, rangeFrom, rangeTo)
+    
+    def observedRangeDidIncrease(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeWillDecrease(self, srcobject, rangeFrom, rangeTo):
+        if rangeFrom < self.end:
+            self.callback(self, rangeFrom, rangeTo)
+    
+    def observedRangeDidDecrease(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def __repr__(self):
+        return "Watchpoint(%s, %d, %d)" % (self.memory, self.start, self.end)
+
 class HeapObjAttr(object):
     """
     Descriptor for heap object attributes. Will be filled by the heap object
@@ -544,6 +1437,21 @@ class HeapObject(object):
                 svalues.append(str(v))
         return "%s{%s}" % (self.tag, ", ".join(svalues))
 
+class Closure(HeapObject):
+    """
+    Heap object for a fun value. `target` is the label of the fun's code,
+    `arity` its number of arguments and `env` the flat list of captured
+    values, indexed by environment slot. Funs which capture nothing should
+    share a single closure.
+    """
+    
+    target = HeapObjAttr()
+    arity = HeapObjAttr()
+    env = HeapObjAttr()
+    
+    def __init__(self, target, arity, env):
+        HeapObject.__init__(self, target, arity, [v.copy() if isinstance(v, Pointer) else v for v in env])
+
 class InterpreterError(Exception):
     """
     Marker exception for errors raised by the interpreter.
@@ -554,11 +1462,34 @@ class InterpreterBreakpoint(Exception):
     Marker exception which occurs on a breakpoint.
     """
 
+class InterpreterWatchpoint(InterpreterBreakpoint):
+    """
+    Exception which occurs after an instruction changed values watched by the
+    `watchpoint`; `rangeFrom` and `rangeTo` (exclusive) give the changed
+    range.
+    """
+    
+    def __init__(self, watchpoint, rangeFrom, rangeTo):
+        InterpreterBreakpoint.__init__(self, watchpoint, rangeFrom, rangeTo)
+        self.watchpoint = watchpoint
+        self.rangeFrom = rangeFrom
+        self.rangeTo = rangeTo
+
 class InterpreterHalt(Exception):
     """
     Marker exception which occurs on halt.
     """
 
+class InterpreterWait(Exception):
+    """
+    Exception which occurs if an instruction has to wait for `future`, see
+    `Interpreter.waitVM`. The instruction was not executed.
+    """
+    
+    def __init__(self, future):
+        Exception.__init__(self, future)
+        self.future = future
+
 def error(descr):
     """
     Small helper function that raises an InterpreterError with the given
@@ -19,7 +19,7 @@
 #
 
 from interface import *
-from zope.interface import implements
+from interface import implements
 from weakref import WeakKeyDictionary
 
 try:
@@ -18,7 +18,41 @@
 #  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from zope.interface import Interface, Attribute
+import sys
+
+try:
+    from zope.interface import Interface, Attribute, implements
+except ImportError:
+    # zope.interface is optional; these stand-ins provide the parts used here.
+    
+    class Interface(object):
+        """
+        Minimal replacement for `zope.interface.Interface`. Supports
+        `providedBy` for classes which declared the interface via `implements`.
+        """
+        
+        @classmethod
+        def providedBy(cls, obj):
+            for klass in type(obj).__mro__:
+                for iface in klass.__dict__.get("__implemented_interfaces__", ()):
+                    if issubclass(iface, cls):
+                        return True
+            return False
+    
+    class Attribute(object):
+        """Minimal replacement for `zope.interface.Attribute`."""
+        
+        def __init__(self, __name__, __doc__=""):
+            self.__name__ = __name__
+            self.__doc__ = __doc__
+    
+    def implements(*interfaces):
+        """
+        Minimal replacement for `zope.interface.implements`. Declares that the
+        class in whose body this is called implements the given interfaces.
+        """
+        classLocals = sys._getframe(1).f_locals
+        classLocals["__implemented_interfaces__"] = tuple(classLocals.get("__implemented_interfaces__", ())) + interfaces
 
 __all__ = ["IKeyValueObserver", "IKeyValueObservable", "IRangeObserver", "IRangeObservable"]
 
@@ -0,0 +1,196 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__all__ = ["link", "ProgramImage", "LinkError"]
+
+from bisect import bisect_right
+
+from compiler_base import Instruction, funLabel, parseFunLabel
+
+class LinkError(Exception):
+    """
+    Raised if modules cannot be linked. `errors` holds a list of
+    `(module, message)` tuples.
+    """
+    
+    def __init__(self, errors):
+        Exception.__init__(self, "\n".join(["%s: %s" % e for e in errors]))
+        self.errors = errors
+
+class ProgramImage(object):
+    """
+    A linked program: the instructions of several modules merged into one list
+    with all jump and call target arguments replaced by absolute instruction
+    indexes. Instances behave like a read-only list of instructions and can be
+    loaded into a program storage directly.
+    
+    `symbols` maps every label in the image to its index; `entries` holds the
+    labels of the entry points the image was linked for.
+    """
+    
+    def __init__(self, instructions, symbols, entries):
+        self.instructions = instructions
+        self.symbols = symbols
+        self.entries = entries
+        self.__functions = sorted([(index, label) for label, index in symbols.iteritems() if parseFunLabel(label) != None])
+        self.__findex = [index for index, label in self.__functions]
+    
+    def __len__(self):
+        return len(self.instructions)
+    
+    def __iter__(self):
+        return iter(self.instructions)
+    
+    def __getitem__(self, key):
+        return self.instructions[int(key)]
+    
+    def functionAt(self, index):
+        """
+        Returns the label of the function containing the instruction at `index`
+        or `None` if it is not part of any function.
+        """
+        i = bisect_right(self.__findex, index) - 1
+        if i < 0:
+            return None
+        return self.__functions[i][1]
+    
+    def writeSymbolMap(self, f):
+        """
+        Writes the symbol map to the file object `f`; one line per label holding
+        the index and the label, ordered by index.
+        """
+        for label, index in sorted(self.symbols.iteritems(), key=lambda item: (item[1], item[0])):
+            f.write("%6d %s\n" % (index, label))
+
+class Block(object):
+    """A function (or the code before the first function) of a module."""
+    
+    def __init__(self, module, label):
+        self.module = module
+        self.label = label
+        self.instructions = []
+        self.refs = set()
+
+def link(modules, entries=None, semantics=None):
+    """
+    Links compiled modules into a single :class:`ProgramImage`.
+    
+    `modules` is a dictionary mapping module names to either instruction lists
+    or :class:`cpl.build.CompiledModule` objects. Functions are recognized by
+    the labels created with :func:`cpl.compiler_base.funLabel`. The target
+    arguments of jumps, branches and calls, as described by `semantics` (an
+    :class:`cpl.cfg.InstructionSemantics` object, by default the one of
+    :mod:`cpl.compiler`), are references to labels and get replaced by their
+    absolute indexes; other arguments are left alone, even if they happen to
+    equal a label. Labels have to be unique across modules (see the
+    `namespace` compile option).
+    
+    Only functions reachable from the `entries` are kept in the image. Entries
+    are given as function labels or `(module, name, arity)` tuples and default
+    to the exported functions if the modules are compiled module objects, or to
+    all functions otherwise. Code before the first function of a module is
+    always kept.
+    
+    Raises :class:`LinkError` on duplicate labels, calls to undefined functions
+    and unknown entries.
+    """
+    if semantics == None:
+        from compiler import semantics
+    
+    errors = []
+    blocks = []
+    labels = {}
+    defaultEntries = []
+    
+    for mname in sorted(modules.iterkeys()):
+        module = modules[mname]
+        instructions = getattr(module, "instructions", module)
+        interface = getattr(module, "interface", None)
+        if interface != None:
+            defaultEntries.extend([funLabel(mname, name, arity) for name, arity in sorted(interface.exports)])
+        
+        block = Block(mname, None)
+        blocks.append(block)
+        for instr in instructions:
+            if instr.label != None:
+                if parseFunLabel(instr.label) != None:
+                    block = Block(mname, instr.label)
+                    blocks.append(block)
+                    if interface == None:
+                        defaultEntries.append(instr.label)
+                if labels.has_key(instr.label):
+                    errors.append((mname, "duplicate label %s" % (instr.label)))
+                labels[instr.label] = block
+            block.instructions.append(instr)
+    
+    for block in blocks:
+        for instr in block.instructions:
+            for i in semantics.targetArgs(instr):
+                arg = instr.args[i]
+                if not isinstance(arg, str):
+                    continue
+                target = labels.get(arg)
+                if target != None:
+                    block.refs.add(target)
+                elif parseFunLabel(arg) != None:
+                    errors.append((block.module, "call to undefined function %s" % (arg)))
+    
+    if entries == None:
+        entries = defaultEntries
+    entries = [e if isinstance(e, basestring) else funLabel(*e) for e in entries]
+    
+    live = set()
+    todo = [block for block in blocks if block.label == None and len(block.instructions) > 0]
+    for entry in entries:
+        if not labels.has_key(entry):
+            errors.append(("", "entry point %s not found" % (entry)))
+        else:
+            todo.append(labels[entry])
+    while len(todo) > 0:
+        block = todo.pop()
+        if block in live:
+            continue
+        live.add(block)
+        todo.extend(block.refs)
+    
+    if len(errors) > 0:
+        raise LinkError(errors)
+    
+    symbols = {}
+    index = 0
+    for block in blocks:
+        if block not in live:
+            continue
+        for instr in block.instructions:
+            if instr.label != None:
+                symbols[instr.label] = index
+            index += 1
+    
+    image = []
+    for block in blocks:
+        if block not in live:
+            continue
+        for instr in block.instructions:
+            args = list(instr.args)
+            for i in semantics.targetArgs(instr):
+                if isinstance(args[i], str):
+                    args[i] = symbols.get(args[i], args[i])
+            image.append(Instruction(instr.name, *args, label=instr.label, loc=instr.loc))
+    
+    return ProgramImage(image, symbols, entries)
@@ -0,0 +1,207 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import defaultdict
+from random import randint
+from time import time
+
+from compiler_base import parseFunLabel
+
+__all__ = ["Profiler", "sourcePosition"]
+
+def sourcePosition(source, loc):
+    """
+    Converts the location offset `loc` within `source` into a tuple
+    `(line, column)`. Both values start at 1, like the ones used by pyparsing.
+    """
+    line = source.count("\n", 0, loc) + 1
+    column = loc - source.rfind("\n", 0, loc)
+    return line, column
+
+class Profiler(object):
+    """
+    Instruction-level profiler for interpreters.
+    
+    Execution counts are recorded exactly for every instruction. Timing is
+    sampled: on average only every `interval`-th instruction is measured and
+    its duration is weighted by `interval`. That way the expensive timer calls
+    are kept out of most steps and the profiler can stay attached during long
+    runs. The distance between two samples is chosen at random, so loops whose
+    length is a multiple of `interval` do not always sample the same
+    instruction. Use an `interval` of 1 to measure every instruction.
+    
+    All statistics are kept by program storage index and mapped to labels,
+    instruction names and source locations only when a report is requested.
+    
+    :param interpreter: the interpreter to profile; the profiler attaches
+      itself immediately
+    :param source: the source code of the loaded program, used to map the
+      `loc` of instructions to lines and columns
+    :param interval: the mean timing sample interval
+    :param timer: a function returning the current time in seconds
+    """
+    
+    def __init__(self, interpreter, source=None, interval=10, timer=time):
+        if interval < 1:
+            raise ValueError("interval must be at least 1")
+        self.interpreter = interpreter
+        self.source = source
+        self.interval = interval
+        self.timer = timer
+        self.reset()
+        self.attach()
+    
+    def reset(self):
+        """Discards all recorded statistics."""
+        self.__counts = defaultdict(int)
+        self.__times = defaultdict(float)
+        self.__countdown = self.__nextSample()
+    
+    def attach(self):
+        """Attaches the profiler to its interpreter."""
+        self.interpreter.attachVMProfiler(self)
+    
+    def detach(self):
+        """Detaches the profiler from its interpreter if it is attached."""
+        if self.interpreter.vmProfiler() is self:
+            self.interpreter.detachVMProfiler()
+    
+    def step(self, index, f, args):
+        """
+        Called by `Interpreter.stepVM` for every instruction. Executes the
+        instruction handler `f` with `args` and records the statistics for the
+        instruction at `index`.
+        """
+        self.__counts[index] += 1
+        self.__countdown -= 1
+        if self.__countdown:
+            f(*args)
+            return
+        
+        self.__countdown = self.__nextSample()
+        t = self.timer()
+        try:
+            f(*args)
+        finally:
+            self.__times[index] += (self.timer() - t) * self.interval
+    
+    def __nextSample(self):
+        return randint(1, 2 * self.interval - 1)
+    
+    # ------------------------------------------------------------------------ #
+    
+    def location(self, index):
+        """
+        Returns the source location of the instruction at `index` as a string.
+        This is `line:column` if the source is known, `@offset` if only the
+        offset is known or an empty string otherwise.
+        """
+        loc = self.interpreter.PS[index].loc
+        if loc == None:
+            return ""
+        if self.source == None:
+            return "@%d" % (loc)
+        return "%d:%d" % sourcePosition(self.source, loc)
+    
+    def labels(self):
+        """
+        Returns a list which holds the label of the enclosing block for every
+        instruction in the program storage, i.e. the last label at or before
+        the instruction. Instructions before the first label map to `None`.
+        """
+        PS = self.interpreter.PS
+        labels = []
+        current = None
+        for i in xrange(len(PS)):
+            if PS[i].label != None:
+                current = PS[i].label
+            labels.append(current)
+        return labels
+    
+    def instructionStats(self):
+        """
+        Returns a list of `(index, count, time)` tuples for every executed
+        instruction, ordered by index.
+        """
+        return [(index, count, self.__times.get(index, 0.0)) for index, count in sorted(self.__counts.iteritems())]
+    
+    def __aggregate(self, key):
+        stats = {}
+        for index, count, t in self.instructionStats():
+            k = key(index)
+            c, tt = stats.get(k, (0, 0.0))
+            stats[k] = (c + count, tt + t)
+        return stats
+    
+    def nameStats(self):
+        """
+        Returns a dictionary mapping instruction names to `(count, time)`
+        tuples.
+        """
+        PS = self.interpreter.PS
+        return self.__aggregate(lambda index: PS[index].name)
+    
+    def labelStats(self):
+        """
+        Returns a dictionary mapping labels to `(count, time)` tuples, summed up
+        over all instructions in the block following the label.
+        """
+        labels = self.labels()
+        return self.__aggregate(lambda index: labels[index])
+    
+    def callCounts(self):
+        """
+        Returns a dictionary mapping function labels to the number of times
+        the first instruction of the function was executed. This can be passed
+        to the compiler as `profile` option to guide inlining.
+        """
+        PS = self.interpreter.PS
+        counts = {}
+        for index, count in self.__counts.iteritems():
+            label = PS[index].label
+            if label != None and parseFunLabel(label) != None:
+                counts[label] = count
+        return counts
+    
+    def dump(self):
+        """
+        Prints the statistics of all executed instructions in a readable form
+        to stdout.
+        """
+        PS = self.interpreter.PS
+        for index, count, t in self.instructionStats():
+            print "%2d: %-30s %10d %10.3fms %s" % (index, PS[index], count, t * 1000, self.location(index))
+    
+    def writeCollapsed(self, f, counts=False):
+        """
+        Writes the statistics to the file object `f` in the collapsed stack
+        format understood by flamegraph tools. Every line holds the frames
+        `label;instruction` followed by the time in microseconds, or by the
+        execution count if `counts` is `True`.
+        """
+        PS = self.interpreter.PS
+        labels = self.labels()
+        for index, count, t in self.instructionStats():
+            instr = PS[index]
+            frame = "%s@%d" % (instr.name, index)
+            location = self.location(index)
+            if location != "":
+                frame += " [%s]" % (location)
+            value = count if counts else int(round(t * 1000000))
+            f.write("%s;%s %d\n" % (labels[index] or "<start>", frame, value))
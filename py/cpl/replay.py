@@ -0,0 +1,265 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Deterministic record/replay for virtual machines.
+
+Apart from its inputs, a virtual machine is deterministic. Instruction
+handlers obtain nondeterministic inputs (timers, the arrival order of
+messages, external I/O) through `Interpreter.nondeterministic`. While
+recording, each value is appended to a log; while replaying, it is taken from
+the log instead. Replaying therefore reproduces the recorded execution
+exactly, without tracing a single instruction.
+
+The log is a compact binary stream. Each entry consists of the kind of input,
+which is written by name only on its first occurrence and by number
+afterwards, followed by the value. Integers are stored as variable-length
+zigzag encoded numbers, so a typical entry takes three to four bytes. Values
+of types without a dedicated encoding are pickled. If obtaining an input
+raised an exception, the exception is logged instead of the value and raised
+again when replaying.
+
+The interpreter flushes the log at the end of `runVM` and of each slice of
+`runVMSlice`, also when they end with an error, so the entries leading to a
+crash are not lost.
+"""
+
+__all__ = ["Recorder", "Replayer", "ReplayError"]
+
+import sys, struct, cPickle
+from cStringIO import StringIO
+
+from interpreter_base import InterpreterError
+
+MAGIC = "CPLR\x01"
+
+class ReplayError(InterpreterError):
+    """
+    Raised if a replayed execution asks for another input than the one that
+    was recorded, i.e. it diverged, or if the log is exhausted.
+    """
+
+def encodeVarint(out, n):
+    while n > 0x7f:
+        out.write(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.write(chr(n))
+
+def encodeValue(out, value):
+    if value is None:
+        out.write("N")
+    elif value is True:
+        out.write("T")
+    elif value is False:
+        out.write("F")
+    elif isinstance(value, (int, long)):
+        out.write("i")
+        encodeVarint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        out.write("f")
+        out.write(struct.pack("<d", value))
+    elif isinstance(value, str):
+        out.write("s")
+        encodeVarint(out, len(value))
+        out.write(value)
+    elif isinstance(value, unicode):
+        data = value.encode("utf-8")
+        out.write("u")
+        encodeVarint(out, len(data))
+        out.write(data)
+    elif isinstance(value, (tuple, list)):
+        out.write("t" if isinstance(value, tuple) else "l")
+        encodeVarint(out, len(value))
+        for item in value:
+            encodeValue(out, item)
+    else:
+        data = cPickle.dumps(value, 2)
+        out.write("p")
+        encodeVarint(out, len(data))
+        out.write(data)
+
+class Recorder(object):
+    """
+    Writes the nondeterministic inputs of `interpreter` to the file object
+    `f`. The recorder attaches itself to the interpreter immediately. Entries
+    are buffered and written in blocks of `bufferSize` bytes; `detach` writes
+    the rest.
+    """
+    
+    #: Inputs are obtained, not taken from a log.
+    replaying = False
+    
+    def __init__(self, interpreter, f, bufferSize=65536):
+        self.interpreter = interpreter
+        self.f = f
+        self.bufferSize = bufferSize
+        self.kinds = {}
+        self.entries = 0
+        self.buffer = StringIO()
+        self.buffer.write(MAGIC)
+        interpreter.attachVMReplay(self)
+    
+    def value(self, kind, producer, args):
+        """
+        Calls `producer` with `args`, logs the result and returns it. If
+        `producer` raises an exception, the exception is logged, the log is
+        flushed and the exception is passed on.
+        """
+        out = self.buffer
+        index = self.kinds.get(kind)
+        if index == None:
+            self.kinds[kind] = len(self.kinds) + 1
+            out.write("\0")
+            encodeValue(out, kind)
+        else:
+            encodeVarint(out, index)
+        self.entries += 1
+        try:
+            value = producer(*args)
+        except Exception, e:
+            # Pickling may raise as well; keep the producer's exception
+            t, v, tb = sys.exc_info()
+            try:
+                data = cPickle.dumps(e, 2)
+            except Exception:
+                data = cPickle.dumps(Exception("%s: %s" % (e.__class__.__name__, e)), 2)
+            out.write("E")
+            encodeVarint(out, len(data))
+            out.write(data)
+            self.flush()
+            raise t, v, tb
+        encodeValue(out, value)
+        if out.tell() >= self.bufferSize:
+            self.flush()
+        return value
+    
+    def flush(self):
+        """Writes all buffered entries to the file and flushes it."""
+        if self.buffer.tell() == 0:
+            return
+        self.f.write(self.buffer.getvalue())
+        self.buffer = StringIO()
+        if hasattr(self.f, "flush"):
+            self.f.flush()
+    
+    def detach(self):
+        """Writes the buffered entries and detaches from the interpreter."""
+        self.flush()
+        if self.interpreter.vmReplay() is self:
+            self.interpreter.detachVMReplay()
+
+class Replayer(object):
+    """
+    Reads the inputs recorded by a :class:`Recorder` from the file object `f`
+    and hands them out to `interpreter` in the same order. The replayer
+    attaches itself to the interpreter immediately; the interpreter has to be
+    in the state the recording started from.
+    """
+    
+    #: Inputs are taken from the log; futures need not be waited for.
+    replaying = True
+    
+    def __init__(self, interpreter, f):
+        self.interpreter = interpreter
+        self.data = f.read()
+        if not self.data.startswith(MAGIC):
+            raise ValueError("not a replay log")
+        self.pos = len(MAGIC)
+        self.kinds = []
+        self.entries = 0
+        interpreter.attachVMReplay(self)
+    
+    def finished(self):
+        """Returns `True` if all recorded inputs have been replayed."""
+        return self.pos >= len(self.data)
+    
+    def value(self, kind, producer, args):
+        """
+        Returns the next recorded value instead of calling `producer`, or
+        raises the exception recorded instead. Raises :class:`ReplayError` if
+        it was recorded for another kind of input.
+        """
+        if self.finished():
+            raise ReplayError("replay log exhausted at %s input" % (kind))
+        index = self.decodeVarint()
+        if index == 0:
+            self.kinds.append(self.decodeValue())
+            index = len(self.kinds)
+        recorded = self.kinds[index - 1]
+        if recorded != kind:
+            raise ReplayError("execution diverged: %s input requested, but %s input recorded (entry %d)" % (kind, recorded, self.entries))
+        self.entries += 1
+        if self.data[self.pos] == "E":
+            self.pos += 1
+            raise cPickle.loads(self.decodeBytes())
+        return self.decodeValue()
+    
+    def flush(self):
+        """Nothing is written while replaying."""
+        pass
+    
+    def decodeVarint(self):
+        data = self.data
+        n = 0
+        shift = 0
+        while True:
+            byte = ord(data[self.pos])
+            self.pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+    
+    def decodeBytes(self):
+        size = self.decodeVarint()
+        value = self.data[self.pos:self.pos+size]
+        self.pos += size
+        return value
+    
+    def decodeValue(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == "N":
+            return None
+        elif tag == "T":
+            return True
+        elif tag == "F":
+            return False
+        elif tag == "i":
+            n = self.decodeVarint()
+            return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+        elif tag == "f":
+            value = struct.unpack_from("<d", self.data, self.pos)[0]
+            self.pos += 8
+            return value
+        elif tag == "s":
+            return self.decodeBytes()
+        elif tag == "u":
+            return self.decodeBytes().decode("utf-8")
+        elif tag in ("t", "l"):
+            items = [self.decodeValue() for i in xrange(self.decodeVarint())]
+            return tuple(items) if tag == "t" else items
+        elif tag == "p":
+            return cPickle.loads(self.decodeBytes())
+        raise ValueError("corrupt replay log at offset %d" % (self.pos - 1))
+    
+    def detach(self):
+        """Detaches from the interpreter, which then uses real inputs again."""
+        if self.interpreter.vmReplay() is self:
+            self.interpreter.detachVMReplay()
@@ -0,0 +1,240 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Reverse execution of virtual machines.
+
+Registers and memories announce each change to their observers before it
+happens. A :class:`ReverseRecorder` observes the register pointers
+(`Interpreter.registerNames`) and the memories (`Interpreter.memoryNames`) of
+an interpreter and writes the old values into an undo log while it performs
+steps. Stepping back applies the undo entries of a step in reverse order, so
+the state before any recorded step is reached without running the program
+again.
+
+The undo log is divided into segments of bounded size, which form a ring:
+when the maximum number of segments is reached, the oldest segment and the
+steps in it are dropped.
+
+Only changes announced through key-value or range observation can be undone.
+Registers which are no pointers, heap objects and pointers modified in place
+inside a memory are not covered; instruction handlers have to replace such
+values instead of changing them.
+"""
+
+__all__ = ["ReverseRecorder"]
+
+from collections import deque
+
+from interpreter_base import Pointer, InterpreterBreakpoint, InterpreterWatchpoint, InterpreterWait
+from kvo.interface import IKeyValueObserver, IRangeObserver, implements
+
+# Kinds of undo entries
+POINTER, CHANGE, INCREASE, DECREASE = range(4)
+
+class UndoSegment(object):
+    """
+    A part of the undo log. `records` is the flat list of undo entries,
+    `steps` holds the index of the first entry of each step.
+    """
+    
+    __slots__ = ("records", "steps")
+    
+    def __init__(self):
+        self.records = []
+        self.steps = []
+
+def copyValues(values):
+    return tuple([value.copy() if isinstance(value, Pointer) else value for value in values])
+
+class ReverseRecorder(object):
+    """
+    Runs an interpreter step by step and records undo entries for each step.
+    The recorder starts observing the interpreter immediately; the register
+    pointers and memories must not be replaced while it is attached. `steps`
+    is the number of steps which can currently be undone.
+    
+    :param interpreter: the interpreter to run; its program has to be loaded
+      and reset already
+    :param segmentSize: the number of undo entries after which a new segment
+      is started
+    :param segments: the maximum number of segments kept
+    """
+    
+    implements(IKeyValueObserver, IRangeObserver)
+    
+    def __init__(self, interpreter, segmentSize=4096, segments=64):
+        if segments < 1:
+            raise ValueError("at least one segment is required")
+        self.interpreter = interpreter
+        self.segmentSize = segmentSize
+        self.maxSegments = segments
+        self.steps = 0
+        self.__segments = deque([UndoSegment()])
+        self.__log = None
+        self.__names = {}
+        
+        for name in interpreter.registerNames:
+            register = getattr(interpreter, name)
+            if isinstance(register, Pointer):
+                register.addObserver(self, "v")
+                self.__names[id(register)] = name
+        for name in interpreter.memoryNames:
+            memory = getattr(interpreter, name)
+            memory.addRangeObserver(self)
+            self.__names[id(memory)] = name
+    
+    def step(self):
+        """
+        Performs one step of the interpreter and records its undo entries.
+        Exceptions of `stepVM` are passed on; a step interrupted by a
+        breakpoint or a wait did not execute an instruction and is not
+        recorded, but a step interrupted by a watchpoint or an error is.
+        """
+        segment = self.__segments[-1]
+        start = len(segment.records)
+        self.__log = segment.records
+        try:
+            self.interpreter.stepVM()
+        except (InterpreterBreakpoint, InterpreterWait), e:
+            self.__log = None
+            if isinstance(e, InterpreterWatchpoint):
+                self.__finishStep(segment, start)
+            else:
+                # Only the program counter moved back and forth
+                self.__undo(segment.records, start)
+            raise
+        except:
+            self.__log = None
+            self.__finishStep(segment, start)
+            raise
+        self.__log = None
+        self.__finishStep(segment, start)
+    
+    def run(self, steps):
+        """Performs `steps` steps."""
+        for i in xrange(steps):
+            self.step()
+    
+    def stepBack(self, steps=1):
+        """
+        Undoes the last `steps` recorded steps and returns the number of steps
+        actually undone, which is less if the log does not reach back far
+        enough.
+        """
+        segments = self.__segments
+        undone = 0
+        while undone < steps:
+            segment = segments[-1]
+            if len(segment.steps) == 0:
+                if len(segments) == 1:
+                    break
+                segments.pop()
+                continue
+            self.__undo(segment.records, segment.steps.pop())
+            undone += 1
+        self.steps -= undone
+        self.interpreter.discardVMWatchpointHit()
+        return undone
+    
+    def clear(self):
+        """Discards the undo log, e.g. after the state was changed from outside."""
+        self.__segments = deque([UndoSegment()])
+        self.steps = 0
+    
+    def detach(self):
+        """Stops observing the interpreter."""
+        vm = self.interpreter
+        for name in vm.registerNames:
+            register = getattr(vm, name)
+            if isinstance(register, Pointer):
+                register.removeObserver(self, set(["v"]))
+        for name in vm.memoryNames:
+            getattr(vm, name).removeRangeObserver(self)
+    
+    def stats(self):
+        """Returns a dictionary with the size of the undo log."""
+        return {
+            "steps": self.steps,
+            "segments": len(self.__segments),
+            "records": sum(len(segment.records) for segment in self.__segments),
+        }
+    
+    # ------------------------------------------------------------------------ #
+    
+    def __finishStep(self, segment, start):
+        segment.steps.append(start)
+        self.steps += 1
+        if len(segment.records) >= self.segmentSize:
+            self.__segments.append(UndoSegment())
+            if len(self.__segments) > self.maxSegments:
+                self.steps -= len(self.__segments.popleft().steps)
+    
+    def __undo(self, records, start):
+        vm = self.interpreter
+        for i in xrange(len(records) - 1, start - 1, -1):
+            record = records[i]
+            kind = record[0]
+            target = getattr(vm, record[1])
+            if kind == POINTER:
+                target.v = record[2]
+            elif kind == CHANGE:
+                index = record[2]
+                for value in record[3]:
+                    target[index] = value
+                    index += 1
+            elif kind == INCREASE:
+                for j in xrange(record[3] - record[2]):
+                    target.pop(record[2])
+            else:
+                index = record[2]
+                for value in record[3]:
+                    target.insert(index, value)
+                    index += 1
+        del records[start:]
+    
+    # ------------------------------------------------------------------------ #
+    
+    def observedPropertyWillChange(self, srcobject, propertyName):
+        if self.__log != None:
+            self.__log.append((POINTER, self.__names[id(srcobject)], srcobject.v))
+    
+    def observedPropertyDidChange(self, srcobject, propertyName):
+        pass
+    
+    def observedRangeWillChange(self, srcobject, rangeFrom, rangeTo):
+        if self.__log != None:
+            self.__log.append((CHANGE, self.__names[id(srcobject)], rangeFrom, copyValues(srcobject.values(rangeFrom, rangeTo))))
+    
+    def observedRangeDidChange(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeWillIncrease(self, srcobject, rangeFrom, rangeTo):
+        if self.__log != None:
+            self.__log.append((INCREASE, self.__names[id(srcobject)], rangeFrom, rangeTo))
+    
+    def observedRangeDidIncrease(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeWillDecrease(self, srcobject, rangeFrom, rangeTo):
+        if self.__log != None:
+            self.__log.append((DECREASE, self.__names[id(srcobject)], rangeFrom, copyValues(srcobject.values(rangeFrom, rangeTo))))
+    
+    def observedRangeDidDecrease(self, srcobject, rangeFrom, rangeTo):
+        pass
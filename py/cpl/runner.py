@@ -0,0 +1,265 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Running virtual machines on an event loop.
+
+`Interpreter.runVM` blocks until the program halts. A :class:`VMRunner`
+instead runs the interpreter in slices of a fixed number of steps and returns
+to the event loop after each slice, so the other tasks of the loop (editor
+commands, audio callbacks, asset loading) run in between on the same thread.
+
+Instructions which need an external result obtain it through
+`Interpreter.waitVM`. While the future is not done, the runner schedules no
+slices, so a waiting interpreter takes no time of the loop at all.
+
+The runner only needs a small part of an event loop: `call_soon(callback,
+*args)` returning a handle with a `cancel` method, and `create_future()`.
+Futures need `done`, `result` and `add_done_callback`; the ones returned by
+`create_future` also `set_result`, `set_exception` and `cancel`. An `asyncio`
+loop provides all of this, as does the minimal :class:`CallbackLoop`, which
+can be used where `asyncio` is not available (it is not part of Python 2).
+"""
+
+__all__ = ["VMRunner", "CallbackLoop", "Future"]
+
+from collections import deque
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from interpreter_base import InterpreterWait
+
+class Handle(object):
+    """A callback scheduled on a :class:`CallbackLoop`."""
+    
+    __slots__ = ("callback", "args", "cancelled")
+    
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+
+class CallbackLoop(object):
+    """
+    A minimal event loop running callbacks in the order they were scheduled.
+    The host calls `runOnce` or `run` whenever it has time, e.g. once per
+    frame.
+    """
+    
+    def __init__(self):
+        self.ready = deque()
+    
+    def call_soon(self, callback, *args):
+        """Schedules `callback` to be called with `args`; returns a handle."""
+        handle = Handle(callback, args)
+        self.ready.append(handle)
+        return handle
+    
+    def create_future(self):
+        """Returns a new :class:`Future` bound to this loop."""
+        return Future(self)
+    
+    def runOnce(self):
+        """
+        Calls the callbacks scheduled so far, but not the ones they schedule.
+        Returns the number of callbacks called.
+        """
+        called = 0
+        for i in xrange(len(self.ready)):
+            handle = self.ready.popleft()
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+                called += 1
+        return called
+    
+    def run(self):
+        """Calls callbacks until none are left."""
+        while len(self.ready) > 0:
+            self.runOnce()
+
+class CancelledError(Exception):
+    """Raised by `Future.result` if the future was cancelled."""
+
+class Future(object):
+    """
+    The result of an operation which is done later, for use with a
+    :class:`CallbackLoop`. Done callbacks are scheduled on the loop.
+    """
+    
+    def __init__(self, loop):
+        self.loop = loop
+        self.__done = False
+        self.__result = None
+        self.__exception = None
+        self.__callbacks = []
+    
+    def done(self):
+        return self.__done
+    
+    def cancelled(self):
+        return isinstance(self.__exception, CancelledError)
+    
+    def result(self):
+        """Returns the result or raises the exception of the future."""
+        if not self.__done:
+            raise RuntimeError("result is not set yet")
+        if self.__exception != None:
+            raise self.__exception
+        return self.__result
+    
+    def exception(self):
+        return self.__exception
+    
+    def add_done_callback(self, callback):
+        """Calls `callback` with the future once it is done."""
+        if self.__done:
+            self.loop.call_soon(callback, self)
+        else:
+            self.__callbacks.append(callback)
+    
+    def set_result(self, result):
+        self.__result = result
+        self.__finish()
+    
+    def set_exception(self, exception):
+        self.__exception = exception
+        self.__finish()
+    
+    def cancel(self):
+        if self.__done:
+            return False
+        self.set_exception(CancelledError())
+        return True
+    
+    def __finish(self):
+        if self.__done:
+            raise RuntimeError("future is done already")
+        self.__done = True
+        for callback in self.__callbacks:
+            self.loop.call_soon(callback, self)
+        self.__callbacks = []
+
+class VMRunner(object):
+    """
+    Runs an interpreter on an event loop in slices of `budget` steps.
+    `waitingFor` is the future the interpreter waits for, if any, and
+    `slices` counts the slices run so far.
+    
+    :param interpreter: the interpreter to run; its program has to be loaded
+      and reset already
+    :param budget: the number of steps per slice
+    :param loop: the event loop to use; if `None`, the current `asyncio`
+      event loop
+    """
+    
+    def __init__(self, interpreter, budget=1000, loop=None):
+        if budget < 1:
+            raise ValueError("budget must be at least 1")
+        if loop == None:
+            if asyncio == None:
+                raise ValueError("asyncio is not available, an event loop has to be given")
+            loop = asyncio.get_event_loop()
+        self.interpreter = interpreter
+        self.loop = loop
+        self.budget = budget
+        self.future = None
+        self.waitingFor = None
+        self.slices = 0
+        self.__handle = None
+        self.__paused = False
+    
+    def start(self):
+        """
+        Starts running the interpreter and returns a future of the loop, which
+        is resolved with `True` on halt and `False` on a breakpoint like the
+        result of `runVM`. Errors are set as the exception of the future.
+        After a breakpoint, `start` continues the program.
+        """
+        if self.running():
+            raise RuntimeError("the interpreter is running already")
+        self.future = self.loop.create_future()
+        self.waitingFor = None
+        self.__paused = False
+        self.__schedule()
+        return self.future
+    
+    def running(self):
+        """Returns `True` if the future returned by `start` is not done yet."""
+        return self.future != None and not self.future.done()
+    
+    def pause(self):
+        """Stops scheduling slices until `resume` is called."""
+        self.__paused = True
+        if self.__handle != None:
+            self.__handle.cancel()
+            self.__handle = None
+    
+    def resume(self):
+        """Continues running after `pause`."""
+        if not self.__paused:
+            return
+        self.__paused = False
+        if self.running() and self.waitingFor == None:
+            self.__schedule()
+    
+    def cancel(self):
+        """Stops running and cancels the future returned by `start`."""
+        self.pause()
+        self.__paused = False
+        self.waitingFor = None
+        if self.running():
+            self.future.cancel()
+    
+    # ------------------------------------------------------------------------ #
+    
+    def __schedule(self):
+        self.__handle = self.loop.call_soon(self.__slice)
+    
+    def __slice(self):
+        self.__handle = None
+        if not self.running():
+            return
+        self.slices += 1
+        try:
+            result = self.interpreter.runVMSlice(self.budget)
+        except InterpreterWait, e:
+            self.waitingFor = e.future
+            e.future.add_done_callback(self.__wakeUp)
+            return
+        except Exception, e:
+            self.future.set_exception(e)
+            return
+        if result != None:
+            self.future.set_result(result)
+        elif not self.__paused:
+            self.__schedule()
+    
+    def __wakeUp(self, future):
+        if future is not self.waitingFor:
+            # Cancelled or restarted in the meantime
+            return
+        self.waitingFor = None
+        if not self.__paused and self.running():
+            self.__schedule()
@@ -0,0 +1,165 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Streaming serialization of parse trees.
+
+Trees are written as a sequence of records, one per token, in depth-first
+order. A record is a list `[name, loc, attr1, attr2, ...]` holding the token
+class name, its location and its attributes. Attributes which are tokens are
+replaced by an empty dictionary as placeholder; the tokens themselves follow as
+separate records, in the order of the placeholders. Lists are kept as lists,
+arrays are written as `{"a": typecode, "v": values}`.
+
+Two formats are supported: "json" writes one JSON document per line, which is
+well suited for diffing, and "marshal" writes the records in python's compact
+binary marshal format, each prefixed by its length as 32 bit little-endian
+integer.
+
+Neither writing nor reading uses recursion or holds more than the current path
+through the tree in memory, so trees with millions of tokens can be handled.
+"""
+
+__all__ = ["dump", "load", "iterRecords"]
+
+import json, marshal, struct
+from array import array
+
+from compiler_base import Token, TokenMetaClass
+
+PLACEHOLDER = {}
+
+def encodeValue(value, children):
+    """
+    Encodes an attribute value for a record. Tokens within the value are
+    appended to `children` and replaced by placeholders.
+    """
+    if isinstance(value, Token):
+        children.append(value)
+        return PLACEHOLDER
+    elif isinstance(value, list):
+        return [encodeValue(v, children) for v in value]
+    elif isinstance(value, array):
+        return {"a": value.typecode, "v": value.tolist()}
+    return value
+
+def iterRecords(token, locations=True):
+    """
+    Returns an iterator over the records of the tree starting at `token`. If
+    `locations` is `False`, all locations are written as `None`, which makes
+    dumps of slightly different sources easier to diff.
+    """
+    stack = [token]
+    while len(stack) > 0:
+        token = stack.pop()
+        children = []
+        record = [token.tokenName(), token.loc if locations else None]
+        for name in token.Attributes:
+            record.append(encodeValue(getattr(token, name), children))
+        yield record
+        stack.extend(reversed(children))
+
+def dump(token, f, format="json", locations=True):
+    """
+    Writes the tree starting at `token` to the file object `f` in the given
+    format ("json" or "marshal").
+    """
+    if format == "json":
+        for record in iterRecords(token, locations):
+            f.write(json.dumps(record, separators=(",", ":")))
+            f.write("\n")
+    elif format == "marshal":
+        for record in iterRecords(token, locations):
+            data = marshal.dumps(record)
+            f.write(struct.pack("<I", len(data)))
+            f.write(data)
+    else:
+        raise ValueError("unknown format %r" % (format))
+
+def readRecords(f, format):
+    if format == "json":
+        for line in f:
+            if line.strip() != "":
+                yield json.loads(line)
+    elif format == "marshal":
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            yield marshal.loads(f.read(struct.unpack("<I", header)[0]))
+    else:
+        raise ValueError("unknown format %r" % (format))
+
+def countPlaceholders(value):
+    if isinstance(value, dict):
+        return 1 if len(value) == 0 else 0
+    elif isinstance(value, list):
+        return sum([countPlaceholders(v) for v in value])
+    return 0
+
+def decodeValue(value, children):
+    """
+    Decodes an attribute value of a record, taking the tokens for the
+    placeholders from the iterator `children`.
+    """
+    if isinstance(value, dict):
+        if len(value) == 0:
+            return children.next()
+        return array(str(value["a"]), value["v"])
+    elif isinstance(value, list):
+        return [decodeValue(v, children) for v in value]
+    elif isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            return value
+    return value
+
+def load(f, format="json", classes=None):
+    """
+    Reads a tree written by `dump` from the file object `f` and returns its
+    root token.
+    
+    Token classes are looked up by name in `classes` or, by default, among all
+    token classes defined so far. Make sure the compiler module defining the
+    tokens has been imported.
+    """
+    if classes == None:
+        classes = TokenMetaClass.tokenClasses
+    
+    # Every entry holds a record and the list of tokens for its placeholders,
+    # which are filled in as the following records are completed.
+    stack = []
+    root = None
+    for record in readRecords(f, format):
+        record[0] = str(record[0])
+        entry = (record, [], sum([countPlaceholders(v) for v in record[2:]]))
+        stack.append(entry)
+        while len(stack) > 0 and len(stack[-1][1]) == stack[-1][2]:
+            record, children, n = stack.pop()
+            children = iter(children)
+            args = [decodeValue(v, children) for v in record[2:]]
+            token = classes[record[0]](*args, loc=record[1])
+            if len(stack) == 0:
+                root = token
+            else:
+                stack[-1][1].append(token)
+    if len(stack) > 0:
+        raise ValueError("incomplete tree")
+    return root
@@ -0,0 +1,211 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Long-running parse and compile service.
+
+The service keeps the compiler module loaded, so the grammar is only built once,
+and reloads it only if its source files change, including the ones of the
+modules of this package it imports. Requests and responses are JSON
+objects, one per line:
+
+Request: `{"id": ..., "command": "parse", "source": "...", "format": "text"}`
+
+`command` is either "parse" or "compile". The parse tree is returned in the
+given `format`: "text" (pretty-printed, the default), "repr" or "records" (the
+records of :mod:`cpl.serializer`). For "compile", `options` may hold compiler
+options and the instructions are returned as strings.
+
+Response: `{"id": ..., "ok": true, "result": ..., "time": seconds}` or
+`{"id": ..., "ok": false, "error": "..."}`
+"""
+
+__all__ = ["CompilerService", "serveStream", "serveSocket"]
+
+import os, sys, json, socket, traceback
+from time import time
+from types import ModuleType
+
+import compiler_base
+import compiler
+import serializer
+
+def sourceFile(module):
+    """Returns the path of the python source file of `module`."""
+    path = module.__file__
+    if path.endswith(".pyc") or path.endswith(".pyo"):
+        path = path[:-1]
+    return path
+
+def packageModules(roots):
+    """
+    Returns the modules `roots` and the modules of this package they import,
+    directly or indirectly, ordered such that each module comes after the ones
+    it imports. Imports are found among the module attributes: modules and
+    objects imported from other modules.
+    """
+    directory = os.path.dirname(sourceFile(sys.modules[__name__]))
+    result = []
+    visited = set()
+    
+    def visit(module):
+        if module.__name__ in visited:
+            return
+        visited.add(module.__name__)
+        for value in vars(module).values():
+            if isinstance(value, ModuleType):
+                imported = value
+            else:
+                imported = sys.modules.get(getattr(value, "__module__", None) or "")
+            if imported == None or imported is module or getattr(imported, "__file__", None) == None:
+                continue
+            if os.path.dirname(sourceFile(imported)) == directory:
+                visit(imported)
+        result.append(module)
+    
+    for module in roots:
+        visit(module)
+    return result
+
+class CompilerService(object):
+    """
+    Handles requests for parsing and compiling. The compiler modules are
+    reloaded before handling a request if their source files have been modified
+    since they were loaded.
+    """
+    
+    def __init__(self):
+        self.modules = packageModules([compiler, serializer])
+        self.mtimes = self.currentMtimes()
+    
+    def currentMtimes(self):
+        mtimes = []
+        for module in self.modules:
+            try:
+                mtimes.append(os.stat(sourceFile(module)).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+    
+    def reloadIfModified(self):
+        """
+        Reloads the compiler modules if any of their source files changed.
+        Returns `True` if they were reloaded.
+        """
+        mtimes = self.currentMtimes()
+        if mtimes == self.mtimes:
+            return False
+        for module in self.modules:
+            reload(module)
+        # The reloaded modules may import others now
+        self.modules = packageModules([compiler, serializer])
+        self.mtimes = self.currentMtimes()
+        return True
+    
+    def handle(self, request):
+        """Handles a request object and returns the response object."""
+        response = {"id": request.get("id")}
+        try:
+            self.reloadIfModified()
+            t = time()
+            command = request.get("command", "parse")
+            if command == "parse":
+                result = self.parse(request["source"], request.get("format", "text"))
+            elif command == "compile":
+                result = self.compile(request["source"], request.get("options", {}))
+            else:
+                raise ValueError("unknown command %r" % (command))
+            response["ok"] = True
+            response["result"] = result
+            response["time"] = time() - t
+        except Exception, e:
+            response["ok"] = False
+            response["error"] = traceback.format_exception_only(e.__class__, e)[-1].strip()
+        return response
+    
+    def parse(self, source, format):
+        parse_tree = compiler.parse(source)
+        if format == "text":
+            return "".join(parse_tree.iterPrettyPrint())
+        elif format == "repr":
+            return "".join(parse_tree.iterRepr())
+        elif format == "records":
+            return list(serializer.iterRecords(parse_tree))
+        raise ValueError("unknown format %r" % (format))
+    
+    def compile(self, source, options):
+        options = dict(options)
+        options.pop("metrics", None)
+        return [str(instr) for instr in compiler.compile(source, options)]
+
+def serveStream(infile=sys.stdin, outfile=sys.stdout, service=None):
+    """
+    Reads requests line by line from `infile` and writes the responses to
+    `outfile` until the end of the input.
+    """
+    if service == None:
+        service = CompilerService()
+    while True:
+        line = infile.readline()
+        if line == "":
+            break
+        if line.strip() == "":
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError, e:
+            response = {"id": None, "ok": False, "error": "invalid request: %s" % (e)}
+        else:
+            response = service.handle(request)
+        outfile.write(json.dumps(response, separators=(",", ":")))
+        outfile.write("\n")
+        outfile.flush()
+
+def serveSocket(address, service=None):
+    """
+    Listens on `address` and serves one connection at a time. `address` is
+    either a path for a unix domain socket or a `(host, port)` tuple for TCP.
+    Runs until interrupted.
+    """
+    if service == None:
+        service = CompilerService()
+    if isinstance(address, basestring):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(address):
+            os.unlink(address)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(1)
+    try:
+        while True:
+            conn, peer = sock.accept()
+            f = conn.makefile("rw")
+            try:
+                serveStream(f, f, service)
+            except socket.error:
+                pass
+            finally:
+                f.close()
+                conn.close()
+    finally:
+        sock.close()
+        if isinstance(address, basestring):
+            os.unlink(address)
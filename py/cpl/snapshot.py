@@ -0,0 +1,285 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Snapshots of virtual machine state and timelines for fast seeking.
+
+A snapshot holds the values of the registers (`Interpreter.registerNames`)
+and the contents of the memories (`Interpreter.memoryNames`) of an
+interpreter. Interpreters with processes keep them in registers or memories
+as well. Memories are stored as tuples of fixed-size chunks. Range observers
+track which chunks change between snapshots, so unchanged chunks are shared
+with the previous snapshot instead of being copied again.
+
+A :class:`Timeline` records such snapshots as checkpoints while running an
+interpreter and seeks to any step by restoring the nearest checkpoint before
+it and replaying only the steps in between.
+"""
+
+__all__ = ["Snapshot", "Timeline"]
+
+import cPickle, zlib
+from bisect import bisect_right
+from cStringIO import StringIO
+
+from interpreter_base import Pointer, InterpreterBreakpoint, InterpreterWatchpoint
+from kvo.interface import IRangeObserver, implements
+
+class Snapshot(object):
+    """
+    The state of an interpreter after `position` steps. `registers` maps
+    register names to their values (the index for pointers), `memories` maps
+    memory names to tuples of chunks, which are tuples of values.
+    """
+    
+    def __init__(self, position, registers, memories):
+        self.position = position
+        self.registers = registers
+        self.memories = memories
+    
+    def __repr__(self):
+        return "Snapshot(%d)" % (self.position)
+
+class DirtyChunks(object):
+    """
+    Range observer recording which chunks of `memory` have changed since the
+    last call to `clean`. Initially, all chunks are dirty.
+    """
+    
+    implements(IRangeObserver)
+    
+    def __init__(self, memory, chunkSize):
+        self.memory = memory
+        self.chunkSize = chunkSize
+        self.chunks = set()
+        self.tail = 0
+        memory.addRangeObserver(self)
+    
+    def clean(self):
+        self.chunks = set()
+        self.tail = None
+    
+    def isDirty(self, chunk):
+        return chunk in self.chunks or (self.tail != None and chunk >= self.tail)
+    
+    def markTail(self, rangeFrom):
+        chunk = rangeFrom // self.chunkSize
+        if self.tail == None or chunk < self.tail:
+            self.tail = chunk
+    
+    def observedRangeWillChange(self, srcobject, rangeFrom, rangeTo):
+        for chunk in xrange(rangeFrom // self.chunkSize, (rangeTo - 1) // self.chunkSize + 1):
+            self.chunks.add(chunk)
+    
+    def observedRangeDidChange(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeWillIncrease(self, srcobject, rangeFrom, rangeTo):
+        self.markTail(rangeFrom)
+    
+    def observedRangeDidIncrease(self, srcobject, rangeFrom, rangeTo):
+        pass
+    
+    def observedRangeWillDecrease(self, srcobject, rangeFrom, rangeTo):
+        # Following values move down
+        self.markTail(rangeFrom)
+    
+    def observedRangeDidDecrease(self, srcobject, rangeFrom, rangeTo):
+        pass
+
+def copyChunk(values):
+    return tuple([value.copy() if isinstance(value, Pointer) else value for value in values])
+
+class Timeline(object):
+    """
+    Runs an interpreter step by step and records a checkpoint every
+    `interval` steps. `position` is the number of steps executed since the
+    timeline was created or last restored to position 0.
+    
+    :param interpreter: the interpreter to run; its program has to be loaded
+      and reset already
+    :param interval: the number of steps between checkpoints
+    :param chunkSize: the number of memory values per chunk
+    """
+    
+    def __init__(self, interpreter, interval=10000, chunkSize=256):
+        if interval < 1:
+            raise ValueError("interval must be at least 1")
+        self.interpreter = interpreter
+        self.interval = interval
+        self.chunkSize = chunkSize
+        self.position = 0
+        self.checkpoints = []
+        self.__positions = []
+        self.__trackers = {}
+        self.__last = {}
+    
+    def snapshot(self):
+        """
+        Returns a snapshot of the current state. Only chunks which changed
+        since the last snapshot or restore are copied.
+        """
+        vm = self.interpreter
+        registers = {}
+        for name in vm.registerNames:
+            value = getattr(vm, name)
+            registers[name] = int(value) if isinstance(value, Pointer) else value
+        
+        size = self.chunkSize
+        memories = {}
+        for name in vm.memoryNames:
+            memory = getattr(vm, name)
+            tracker = self.__trackers.get(name)
+            if tracker == None or tracker.memory is not memory:
+                # The memory was replaced, start over
+                tracker = DirtyChunks(memory, size)
+                self.__trackers[name] = tracker
+            previous = self.__last.get(name, ())
+            chunks = []
+            for i in xrange((len(memory) + size - 1) // size):
+                if i < len(previous) and not tracker.isDirty(i):
+                    chunks.append(previous[i])
+                else:
+                    chunks.append(copyChunk(memory.values(i * size, (i + 1) * size)))
+            memories[name] = self.__last[name] = tuple(chunks)
+            tracker.clean()
+        
+        return Snapshot(self.position, registers, memories)
+    
+    def restore(self, snapshot):
+        """Restores the state and position saved in `snapshot`."""
+        vm = self.interpreter
+        for name, value in snapshot.registers.iteritems():
+            current = getattr(vm, name)
+            if isinstance(current, Pointer):
+                current.v = value
+            else:
+                setattr(vm, name, value)
+        
+        for name, chunks in snapshot.memories.iteritems():
+            memory = getattr(vm, name)
+            values = []
+            for chunk in chunks:
+                values.extend(chunk)
+            memory.setValues(values)
+            tracker = self.__trackers.get(name)
+            if tracker == None or tracker.memory is not memory:
+                tracker = DirtyChunks(memory, self.chunkSize)
+                self.__trackers[name] = tracker
+            self.__last[name] = chunks
+            tracker.clean()
+        vm.discardVMWatchpointHit()
+        
+        self.position = snapshot.position
+    
+    def checkpoint(self):
+        """Records a checkpoint at the current position and returns it."""
+        snapshot = self.snapshot()
+        i = bisect_right(self.__positions, self.position)
+        if i > 0 and self.__positions[i-1] == self.position:
+            self.checkpoints[i-1] = snapshot
+        else:
+            self.__positions.insert(i, self.position)
+            self.checkpoints.insert(i, snapshot)
+        return snapshot
+    
+    def step(self):
+        """
+        Performs one step of the interpreter, recording a checkpoint first if
+        the position is a multiple of `interval` and there is none yet.
+        Exceptions of `stepVM` are passed on; the position only advances if
+        the step was performed (which it was for watchpoints).
+        """
+        if self.position % self.interval == 0:
+            i = bisect_right(self.__positions, self.position)
+            if i == 0 or self.__positions[i-1] != self.position:
+                self.checkpoint()
+        try:
+            self.interpreter.stepVM()
+        except InterpreterWatchpoint:
+            self.position += 1
+            raise
+        self.position += 1
+    
+    def run(self, steps):
+        """Performs `steps` steps."""
+        for i in xrange(steps):
+            self.step()
+    
+    def seek(self, position):
+        """
+        Brings the interpreter to the state after `position` steps. The
+        nearest checkpoint at or before `position` is restored, unless the
+        current position lies between it and `position` already, and the
+        remaining steps are replayed. Breakpoints are ignored while replaying.
+        """
+        i = bisect_right(self.__positions, position) - 1
+        if i < 0:
+            raise ValueError("no checkpoint at or before position %d" % (position))
+        if not (self.__positions[i] <= self.position <= position):
+            self.restore(self.checkpoints[i])
+        while self.position < position:
+            try:
+                self.step()
+            except InterpreterBreakpoint:
+                pass
+    
+    def discardAfter(self, position):
+        """
+        Discards the checkpoints after `position`, e.g. after the state was
+        changed from outside.
+        """
+        i = bisect_right(self.__positions, position)
+        del self.__positions[i:]
+        del self.checkpoints[i:]
+    
+    # ------------------------------------------------------------------------ #
+    
+    def __persistentIds(self):
+        vm = self.interpreter
+        ids = {id(vm.PS): "PS"}
+        for name in vm.memoryNames:
+            ids[id(getattr(vm, name))] = name
+        return ids
+    
+    def save(self, f):
+        """
+        Writes the checkpoints to the file object `f` in a compressed binary
+        format. Chunks shared between checkpoints are written only once.
+        """
+        ids = self.__persistentIds()
+        data = StringIO()
+        pickler = cPickle.Pickler(data, 2)
+        pickler.persistent_id = lambda obj: ids.get(id(obj))
+        pickler.dump([(s.position, s.registers, s.memories) for s in self.checkpoints])
+        f.write(zlib.compress(data.getvalue()))
+    
+    def load(self, f):
+        """
+        Replaces the checkpoints by the ones read from the file object `f`.
+        Pointers to memories and the program storage are bound to the ones of
+        this timeline's interpreter.
+        """
+        vm = self.interpreter
+        objects = dict((name, getattr(vm, name)) for name in vm.memoryNames)
+        objects["PS"] = vm.PS
+        unpickler = cPickle.Unpickler(StringIO(zlib.decompress(f.read())))
+        unpickler.persistent_load = objects.__getitem__
+        self.checkpoints = [Snapshot(*entry) for entry in unpickler.load()]
+        self.__positions = [s.position for s in self.checkpoints]
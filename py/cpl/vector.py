@@ -0,0 +1,210 @@
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Packed numeric lists and bulk arithmetic kernels for virtual machines.
+
+Numeric lists are stored as arrays of machine integers (typecode 'l') or
+doubles (typecode 'd') in :class:`NumericArray` heap objects. The kernels in this
+module operate on whole arrays at once; they are used by the bulk instructions
+`vop`, `vmap` and `vfold` of the instruction set.
+
+A kernel describes an arithmetic expression over a single list element in
+postfix notation as a tuple of steps:
+
+`("x",)`
+    pushes the element
+`("c", value)`
+    pushes a constant
+`("op", op)`
+    pops two operands and pushes the result of the binary operator `op`
+`("neg",)`
+    negates the topmost operand
+
+If NumPy is installed, it is used for elementwise operations on doubles.
+Integer operations always use the array module, as NumPy would silently wrap
+around on overflow.
+"""
+
+__all__ = ["NumericArray", "pack", "elementwise", "applyKernel", "fold", "VectorOverflow"]
+
+import operator
+from array import array
+from itertools import imap, repeat
+
+from interpreter_base import HeapObject, HeapObjAttr
+
+try:
+    import numpy
+except ImportError:
+    # optional
+    numpy = None
+
+class VectorOverflow(Exception):
+    """
+    Raised if an integer result does not fit into a machine integer. The VM
+    should fall back to the element-by-element code in that case.
+    """
+
+def intdiv(a, b):
+    """Integer division truncating towards zero, like Erlang's `div`."""
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        return -q
+    return q
+
+def floatdiv(a, b):
+    return float(a) / b
+
+operators = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": floatdiv,
+    "div": intdiv,
+}
+
+numpyOperators = {
+    "+": "add",
+    "-": "subtract",
+    "*": "multiply",
+    "/": "true_divide",
+}
+
+class NumericArray(HeapObject):
+    """
+    Heap object for a packed numeric list. `numbers` is an array with typecode
+    'l' (integers) or 'd' (floats).
+    """
+    
+    numbers = HeapObjAttr()
+    
+    def __len__(self):
+        return len(self.numbers)
+    
+    def __str__(self):
+        return "%s{%d x %s}" % (self.tag, len(self.numbers), "float" if self.numbers.typecode == 'd' else "int")
+
+def pack(numbers):
+    """
+    Returns an array holding the given numbers if all of them are integers or
+    all of them are floats, or `None` otherwise (or if an integer does not fit
+    into a machine integer).
+    """
+    if isinstance(numbers, array):
+        return numbers
+    numbers = list(numbers)
+    if len(numbers) == 0:
+        return array('l')
+    if isinstance(numbers[0], float):
+        kind = float
+        typecode = 'd'
+    else:
+        kind = (int, long)
+        typecode = 'l'
+    for n in numbers:
+        if not isinstance(n, kind) or isinstance(n, bool):
+            return None
+    try:
+        return array(typecode, numbers)
+    except OverflowError:
+        return None
+
+def resultTypecode(op, a, b):
+    if op == "/":
+        return 'd'
+    if op == "div":
+        return 'l'
+    for x in (a, b):
+        if (x.typecode if isinstance(x, array) else ('d' if isinstance(x, float) else 'l')) == 'd':
+            return 'd'
+    return 'l'
+
+def elementwise(op, a, b):
+    """
+    Applies the arithmetic operator `op` elementwise. Each operand is either an
+    array or a single number; arrays must have the same length. Returns an array
+    (or a number if both operands are numbers).
+    """
+    f = operators[op]
+    aIsArray = isinstance(a, array)
+    bIsArray = isinstance(b, array)
+    if not aIsArray and not bIsArray:
+        return f(a, b)
+    if aIsArray and bIsArray and len(a) != len(b):
+        raise ValueError("operands differ in length (%d and %d)" % (len(a), len(b)))
+    
+    typecode = resultTypecode(op, a, b)
+    n = len(a) if aIsArray else len(b)
+    
+    if numpy != None and typecode == 'd' and numpyOperators.has_key(op):
+        na = numpy.frombuffer(a, dtype=numpy.float64 if a.typecode == 'd' else numpy.int_) if aIsArray else a
+        nb = numpy.frombuffer(b, dtype=numpy.float64 if b.typecode == 'd' else numpy.int_) if bIsArray else b
+        result = getattr(numpy, numpyOperators[op])(na, nb, dtype=numpy.float64)
+        out = array('d')
+        out.fromstring(result.tostring())
+        return out
+    
+    ia = a if aIsArray else repeat(a, n)
+    ib = b if bIsArray else repeat(b, n)
+    try:
+        return array(typecode, imap(f, ia, ib))
+    except OverflowError:
+        raise VectorOverflow
+
+def applyKernel(kernel, values):
+    """
+    Evaluates the postfix `kernel` for every element of the array `values` and
+    returns the results as array. The whole array is processed by each step of
+    the kernel at once.
+    """
+    stack = []
+    for step in kernel:
+        kind = step[0]
+        if kind == "x":
+            stack.append(values)
+        elif kind == "c":
+            stack.append(step[1])
+        elif kind == "neg":
+            stack.append(elementwise("-", 0, stack.pop()))
+        elif kind == "op":
+            b = stack.pop()
+            a = stack.pop()
+            stack.append(elementwise(step[1], a, b))
+        else:
+            raise ValueError("invalid kernel step %r" % (step,))
+    result = stack.pop()
+    if not isinstance(result, array):
+        # The kernel did not depend on the element
+        result = pack([result] * len(values))
+        if result == None:
+            raise VectorOverflow
+    return result
+
+def fold(op, init, values):
+    """
+    Folds the array `values` from the left with the operator `op` ("+" or "*"),
+    starting with `init`. The order of operations is the same as the one of the
+    element-by-element code, so float results are identical.
+    """
+    if op == "+":
+        return sum(values, init)
+    elif op == "*":
+        return reduce(operator.mul, values, init)
+    raise ValueError("unsupported fold operator %r" % (op))
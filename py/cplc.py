@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys, cPickle
+from optparse import OptionParser
+
+from cpl.build import build, BuildError
+from cpl.linker import link, LinkError
+
+parser = OptionParser(usage="%prog [options] file.cpl ...")
+parser.add_option("-j", "--jobs", type="int", default=None, help="number of worker processes (default: number of CPUs)")
+parser.add_option("-c", "--cache", default=".cplcache", help="build cache file (default: %default)")
+parser.add_option("-O", "--no-optimize", action="store_false", dest="optimize", default=True, help="do not run the optimizer")
+parser.add_option("-r", "--registers", type="int", default=8, help="number of registers for variables, 0 for a pure stack machine (default: %default)")
+parser.add_option("-o", "--output", help="link the modules and write the program image to this file")
+parser.add_option("-e", "--entry", action="append", dest="entries", metavar="MODULE:NAME/ARITY", help="entry point for linking, may be given multiple times (default: all exported functions)")
+parser.add_option("-m", "--map", help="write the symbol map of the linked image to this file")
+opts, args = parser.parse_args()
+
+if len(args) == 0:
+    parser.error("no input files")
+
+try:
+    modules = build(args, opts.cache, {"optimize": opts.optimize, "registers": opts.registers}, opts.jobs)
+except BuildError, e:
+    for module, message in e.errors:
+        print >>sys.stderr, "%s: %s" % (module, message)
+    sys.exit(1)
+
+for name, module in sorted(modules.iteritems()):
+    print "%-20s %6d instructions %s" % (name, len(module.instructions), "" if module.rebuilt else "(cached)")
+
+if opts.output or opts.map:
+    try:
+        image = link(modules, opts.entries)
+    except LinkError, e:
+        for module, message in e.errors:
+            print >>sys.stderr, "%s: %s" % (module, message)
+        sys.exit(1)
+    
+    print "linked %d instructions" % (len(image))
+    if opts.output:
+        with open(opts.output, "wb") as f:
+            cPickle.dump(image, f, 2)
+    if opts.map:
+        with open(opts.map, "w") as f:
+            image.writeSymbolMap(f)
@@ -20,14 +20,33 @@
 #
 
 import cpl.compiler
+import cpl.serializer
+import cpl.server
 
 import sys, readline, traceback
 
-if len(sys.argv) > 1:
-    print cpl.compiler.parse(open(sys.argv[1], "r").read())
+if len(sys.argv) > 1 and sys.argv[1] == "--server":
+    # Serve requests over stdin/stdout, a unix socket or host:port
+    if len(sys.argv) == 2:
+        cpl.server.serveStream()
+    else:
+        address = sys.argv[2]
+        if ":" in address:
+            host, port = address.rsplit(":", 1)
+            address = (host, int(port))
+        try:
+            cpl.server.serveSocket(address)
+        except KeyboardInterrupt:
+            pass
+elif len(sys.argv) > 2 and sys.argv[1] == "--dump":
+    cpl.serializer.dump(cpl.compiler.parse(open(sys.argv[2], "r").read()), sys.stdout)
+elif len(sys.argv) > 1:
+    cpl.compiler.parse(open(sys.argv[1], "r").read()).prettyPrint(sys.stdout)
 else:
     print "Enter a blank line or hit Ctrl+D to leave.\n"
     
+    service = cpl.server.CompilerService()
+    
     while True:
         try:
             s = raw_input("> ")
@@ -38,7 +57,7 @@ else:
             break
         
         try:
-            reload(cpl.compiler)
+            service.reloadIfModified()
             print cpl.compiler.parse(s)
         except:
             traceback.print_exc()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+
+from cpl.compiler_base import Instruction
+from cpl.interpreter_base import Interpreter, Stack, InterpreterWatchpoint
+
+class CountingVM(Interpreter):
+    """Pushes the values of `count` and jumps with `jmp`."""
+    
+    memoryNames = ["S"]
+    
+    def __init__(self):
+        Interpreter.__init__(self)
+        self.S = Stack()
+        self.counter = 0
+    
+    def resetVM(self):
+        Interpreter.resetVM(self)
+        self.S.clear()
+        self.counter = 0
+    
+    def count(self):
+        self.counter += 1
+        self.S.append(self.counter)
+    
+    def jmp(target):
+        PC.v = target
+
+def program(counts):
+    return [Instruction("count")] * counts + [Instruction("halt")]
+
+class BreakpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vm = CountingVM()
+        self.vm.loadVM(program(5))
+        self.vm.resetVM()
+    
+    def testBreakAndContinue(self):
+        self.vm.setVMBreakpoint(2)
+        self.assertFalse(self.vm.runVM())
+        # The instruction at the breakpoint was not executed yet
+        self.assertEqual(self.vm.PC.v, 2)
+        self.assertEqual(self.vm.S.values(), [1, 2])
+        self.assertTrue(self.vm.runVM())
+        self.assertEqual(self.vm.S.values(), [1, 2, 3, 4, 5])
+    
+    def testTraps(self):
+        self.vm.setVMBreakpoints([1, 3])
+        self.assertEqual(sorted(self.vm.allVMBreakpoints()), [1, 3])
+        self.assertEqual(self.vm.PS.traps(), [1, 3])
+        self.assertEqual(self.vm.PS[1].name, "trap")
+        self.assertEqual(self.vm.PS.trapped(1).name, "count")
+        self.vm.resetVMBreakpoint(1)
+        self.assertFalse(self.vm.hasVMBreakpoint(1))
+        self.assertEqual(self.vm.PS[1].name, "count")
+        self.assertFalse(self.vm.runVM())
+        self.assertEqual(self.vm.PC.v, 3)
+        self.vm.clearVMBreakpoints()
+        self.assertEqual(self.vm.PS.traps(), [])
+        self.assertTrue(self.vm.runVM())
+    
+    def testBreakpointKeptOnLoad(self):
+        self.vm.setVMBreakpoint(7)
+        self.assertTrue(self.vm.runVM())
+        self.vm.loadVM(program(10))
+        self.vm.resetVM()
+        self.assertFalse(self.vm.runVM())
+        self.assertEqual(self.vm.PC.v, 7)
+    
+    def testBreakpointAtPC(self):
+        # Setting a breakpoint at the current instruction does not stop there
+        self.vm.setVMBreakpoint(0)
+        self.assertTrue(self.vm.runVM())
+    
+    def testBreakAgainAfterMovingAway(self):
+        self.vm.loadVM(program(3) + [Instruction("jmp", 1)])
+        self.vm.resetVM()
+        self.vm.setVMBreakpoint(2)
+        self.assertFalse(self.vm.runVM())
+        self.vm.PC.v = 0
+        self.assertFalse(self.vm.runVM())
+        self.assertEqual(self.vm.PC.v, 2)
+        self.assertEqual(self.vm.S.values(), [1, 2, 3, 4])
+    
+    def testBreakOnJumpTarget(self):
+        self.vm.loadVM([Instruction("jmp", 3)] + program(3))
+        self.vm.resetVM()
+        self.vm.setVMBreakpoint(3)
+        self.assertFalse(self.vm.runVM())
+        self.assertEqual(self.vm.S.values(), [])
+        self.assertTrue(self.vm.runVM())
+        self.assertEqual(self.vm.S.values(), [1])
+    
+    def testWatchpoint(self):
+        watchpoint = self.vm.setVMWatchpoint("S", 2)
+        self.vm.stepVM()
+        self.vm.stepVM()
+        try:
+            self.vm.stepVM()
+            self.fail("watchpoint not hit")
+        except InterpreterWatchpoint, e:
+            self.assertIs(e.watchpoint, watchpoint)
+            self.assertEqual((e.rangeFrom, e.rangeTo), (2, 3))
+        # The instruction was executed before the watchpoint was reported
+        self.assertEqual(self.vm.S.values(), [1, 2, 3])
+        self.assertTrue(self.vm.runVM())
+        self.vm.resetVMWatchpoint(watchpoint)
+        self.assertEqual(self.vm.allVMWatchpoints(), [])
+    
+    def testWatchpointOutsideStep(self):
+        self.vm.setVMWatchpoint("S", 0)
+        self.assertFalse(self.vm.runVM())
+        # Changes made from outside are not reported by the next instruction
+        self.vm.resetVM()
+        self.vm.loadVM([Instruction("jmp", 1), Instruction("halt")])
+        self.assertTrue(self.vm.runVM())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+
+from cpl.cfg import CFG, optimize
+from cpl.compiler import instrs, semantics
+from cpl.compiler_base import Instruction
+
+def labeled(instr, label):
+    return Instruction(instr.name, *instr.args, label=label)
+
+class CFGTest(unittest.TestCase):
+
+    def testIntegerJumpIntoBlock(self):
+        code = [
+            labeled(instrs.nop(), "m:main/0"),
+            Instruction("push", 1),
+            Instruction("push", 2),
+            instrs.jmpf(2),
+            instrs.ret(),
+        ]
+        cfg = CFG(code, semantics)
+        self.assertEqual([len(block.instructions) for block in cfg.blocks], [2, 2, 1])
+        label = cfg.blocks[1].label
+        self.assertNotEqual(label, None)
+        self.assertEqual(cfg.blocks[1].instructions[-1].args, (label,))
+        self.assertTrue(cfg.blocks[1] in cfg.blocks[1].succs)
+    
+    def testIntegerCall(self):
+        code = [
+            labeled(instrs.call(3, 0), "m:main/0"),
+            instrs.ret(),
+            labeled(instrs.ret(), "m:dead/0"),
+            labeled(Instruction("push", 1), "m:f/0"),
+            instrs.ret(),
+        ]
+        result = optimize(code, semantics)
+        self.assertEqual(result[0].args, ("m:f/0", 0))
+        self.assertEqual([instr.label for instr in result if instr.label != None], ["m:main/0", "m:dead/0", "m:f/0"])
+    
+    def testLayoutChange(self):
+        code = [
+            labeled(instrs.jmp(3), "m:main/0"),
+            Instruction("push", 1),
+            instrs.ret(),
+            Instruction("push", 2),
+            instrs.jmp(1),
+        ]
+        result = optimize(code, semantics)
+        index = dict([(instr.label, i) for i, instr in enumerate(result) if instr.label != None])
+        targets = [result[index[instr.args[0]]].args for instr in result if instr.name == "jmp"]
+        self.assertEqual(targets, [(2,), (1,)])
+    
+    def testOutOfRange(self):
+        self.assertRaises(ValueError, CFG, [instrs.jmp(7), instrs.ret()], semantics)
+    
+    def testJumpThreading(self):
+        code = [
+            labeled(instrs.jmp("a"), "m:main/0"),
+            labeled(instrs.jmp("b"), "a"),
+            labeled(instrs.ret(), "b"),
+        ]
+        result = optimize(code, semantics)
+        self.assertEqual([instr.name for instr in result], ["nop", "ret"])
+
+if __name__ == "__main__":
+    unittest.main()
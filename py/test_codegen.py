@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+from array import array
+
+from cpl.binary import BinaryData
+from cpl.compiler import compile, CompileError
+from cpl.compiler_base import Instruction
+from cpl.interpreter import VM, toPython
+from cpl.interpreter_base import InterpreterError
+from cpl.profiler import Profiler
+
+SOURCE = """
+-module(m).
+run(0, Acc) -> Acc;
+run(N, Acc) -> run(N - 1, step(N, Acc)).
+step(X, A) -> Y = X * X + A, Z = Y - X * 3, (Z + Y) mod 1000003.
+fib(0) -> 0;
+fib(1) -> 1;
+fib(N) -> fib(N - 1) + fib(N - 2).
+len([]) -> 0;
+len([_|T]) -> 1 + len(T).
+rev([], Acc) -> Acc;
+rev([H|T], Acc) -> rev(T, [H|Acc]).
+swap({A, B}) -> {B, A}.
+same(X, X) -> true;
+same(_, _) -> false.
+classify(X) -> case X of {ok, V} -> V; [V|_] -> V; _ -> none end.
+keep(X) -> Y = X * 2, Z = fib(X), {Y, Z, X}.
+split(<<A:8, B:16>>) -> A + B.
+bad(X) -> {ok, Y} = X, Y.
+twice(X) -> Y = X, Y + X.
+"""
+
+CLOSURES = """
+-module(f).
+adder(N) -> fun(X) -> X + N end.
+add(N, X) -> F = adder(N), F(X).
+nested(A, B) -> F = fun(X) -> G = fun(Y) -> X + Y + A end, G(B) end, F(1).
+double(L) -> map(fun(X) -> X * 2 end, L).
+scale(K, L) -> map(fun(X) -> X * K end, L).
+map(_, []) -> [];
+map(F, [H|T]) -> [F(H)|map(F, T)].
+"""
+
+VECTORS = """
+-module(v).
+double([]) -> [];
+double([H|T]) -> [H * 2 + 1 | double(T)].
+total([], A) -> A;
+total([H|T], A) -> total(T, A + H * H).
+sum(L) -> lists:sum(L).
+triple(L) -> lists:map(fun(X) -> X * 3 end, L).
+"""
+
+LISTS = """
+-module(lists).
+sum(L) -> sum(L, 0).
+sum([], A) -> A;
+sum([H|T], A) -> sum(T, A + H).
+map(_, []) -> [];
+map(F, [H|T]) -> [F(H)|map(F, T)].
+"""
+
+def run(code, fun, *args):
+    vm = VM()
+    vm.loadVM(code)
+    vm.resetVM()
+    profiler = Profiler(vm, interval=1)
+    result = vm.callVM(fun, *args)
+    return result, dict([(name, count) for name, (count, time) in profiler.nameStats().iteritems()])
+
+class CodegenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.code = {}
+        for registers in (8, 2, 0):
+            self.code[registers] = compile(SOURCE, {"registers": registers})
+    
+    def call(self, fun, *args):
+        results = [run(self.code[registers], fun, *args)[0] for registers in (8, 2, 0)]
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        return results[0]
+    
+    def testResults(self):
+        self.assertEqual(self.call("m:run/2", 100, 0), run(self.code[0], "m:run/2", 100, 0)[0])
+        self.assertEqual(self.call("m:fib/1", 12), 144)
+        self.assertEqual(self.call("m:len/1", [1, 2, 3]), 3)
+        self.assertEqual(self.call("m:rev/2", [1, (2, 3), [4]], []), [[4], (2, 3), 1])
+        self.assertEqual(self.call("m:swap/1", (1, "a")), ("a", 1))
+        self.assertEqual(self.call("m:same/2", 1, 1), "true")
+        self.assertEqual(self.call("m:same/2", 1, 1.0), "false")
+        self.assertEqual(self.call("m:classify/1", ("ok", 5)), 5)
+        self.assertEqual(self.call("m:classify/1", [7, 8]), 7)
+        self.assertEqual(self.call("m:classify/1", 3), "none")
+        self.assertEqual(self.call("m:keep/1", 10), (20, 55, 10))
+        self.assertEqual(self.call("m:twice/1", 4), 8)
+    
+    def testErrors(self):
+        for registers in (8, 0):
+            self.assertRaises(InterpreterError, run, self.code[registers], "m:bad/1", ("error", 1))
+            self.assertRaises(InterpreterError, run, self.code[registers], "m:swap/1", 1)
+    
+    def testRegisterInstructions(self):
+        names = set([instr.name for instr in self.code[8]])
+        self.assertTrue(set(["move", "reload", "load", "store"]) <= names)
+        names = set([instr.name for instr in self.code[2]])
+        self.assertTrue("spill" in names)
+        names = set([instr.name for instr in self.code[0]])
+        self.assertFalse(set(["move", "spill", "reload", "load", "store"]) & names)
+        
+        # Y is saved around the call, X is an argument and in the frame already
+        result, counts = run(self.code[2], "m:keep/1", 5)
+        self.assertEqual(counts["spill"], 1)
+        self.assertEqual(result, (10, 5, 5))
+    
+    def testFewerInstructions(self):
+        registers = run(self.code[8], "m:run/2", 100, 0)[1]
+        stack = run(self.code[0], "m:run/2", 100, 0)[1]
+        self.assertTrue(sum(registers.values()) < sum(stack.values()))
+        self.assertTrue(registers.get("sload", 0) + registers.get("sstore", 0) < stack["sload"] + stack["sstore"])
+    
+    def testUnbound(self):
+        self.assertRaises(CompileError, compile, "f(X) -> Y.")
+
+class ClosureTest(unittest.TestCase):
+
+    def testCapture(self):
+        for registers in (8, 0):
+            code = compile(CLOSURES, {"registers": registers})
+            names = set([instr.name for instr in code])
+            self.assertTrue(set(["mkclosure", "loadfun", "envget", "callfun"]) <= names)
+            result, counts = run(code, "f:add/2", 3, 4)
+            self.assertEqual(result, 7)
+            self.assertEqual(counts["envget"], 1)
+            self.assertEqual(run(code, "f:nested/2", 10, 100)[0], 111)
+            self.assertEqual(run(code, "f:scale/2", 3, [1, 2, 3])[0], [3, 6, 9])
+    
+    def testShared(self):
+        vm = VM()
+        vm.loadVM(compile(CLOSURES))
+        vm.resetVM()
+        self.assertEqual(vm.callVM("f:double/1", [1, 2]), [2, 4])
+        self.assertEqual(vm.callVM("f:double/1", [3]), [6])
+        self.assertEqual(len(vm.H), 1)
+        vm.callVM("f:scale/2", 2, [1])
+        vm.callVM("f:scale/2", 2, [1])
+        self.assertEqual(len(vm.H), 3)
+        # The shared closure is made again after the heap was cleared
+        vm.resetVM()
+        self.assertEqual(vm.callVM("f:double/1", [5]), [10])
+        self.assertEqual(len(vm.H), 1)
+    
+    def testBadArity(self):
+        vm = VM()
+        vm.loadVM(compile(CLOSURES + "bad() -> F = fun(X) -> X end, F(1, 2).\n"))
+        vm.resetVM()
+        self.assertRaises(InterpreterError, vm.callVM, "f:bad/0")
+
+class QuickeningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vm = VM()
+        self.vm.loadVM(compile("""
+            -module(q).
+            add(A, B) -> A + B.
+            seg(<<A:8, B:8>>) -> A * B + 1.
+        """))
+        self.vm.resetVM()
+    
+    def instruction(self, name):
+        for i in xrange(len(self.vm.PS)):
+            if self.vm.PS[i].name == name:
+                return i
+        return None
+    
+    def testStatic(self):
+        index = self.instruction("muli")
+        self.assertNotEqual(index, None)
+        self.assertNotEqual(self.instruction("addi"), None)
+        self.assertEqual(self.vm.callVM("q:seg/1", BinaryData("\x03\x04")), 13)
+        self.assertFalse(self.vm.PS.isQuickened(index))
+    
+    def testQuicken(self):
+        index = self.instruction("arith")
+        self.assertEqual(self.vm.callVM("q:add/2", 1, 2), 3)
+        self.assertEqual(self.vm.PS[index].name, "addi")
+        self.assertEqual(self.vm.callVM("q:add/2", 3, 4), 7)
+        self.assertEqual(self.vm.PS[index].name, "addi")
+        
+        # Other operands turn it back into arith, which stays generic
+        self.assertEqual(self.vm.callVM("q:add/2", 1.5, 2), 3.5)
+        self.assertEqual(self.vm.PS[index].name, "arith")
+        self.assertEqual(self.vm.callVM("q:add/2", 1, 2), 3)
+        self.assertEqual(self.vm.PS[index].name, "arith")
+    
+    def testFloat(self):
+        index = self.instruction("arith")
+        self.assertEqual(self.vm.callVM("q:add/2", 0.5, 0.25), 0.75)
+        self.assertEqual(self.vm.PS[index].name, "addf")
+        self.assertRaises(InterpreterError, self.vm.callVM, "q:add/2", 0.5, "a")
+
+class VectorTest(unittest.TestCase):
+
+    def vm(self, vectorize):
+        vm = VM()
+        vm.loadVM(compile(VECTORS, {"vectorize": vectorize, "namespace": "v"}))
+        vm.loadVMModule("lists", compile(LISTS, {"vectorize": vectorize, "namespace": "lists"}))
+        vm.resetVM()
+        return vm
+    
+    def testLowering(self):
+        names = set([instr.name for instr in compile(VECTORS)])
+        self.assertTrue(set(["vmap", "vfold"]) <= names)
+        names = set([instr.name for instr in compile(VECTORS, {"vectorize": False})])
+        self.assertFalse(set(["vmap", "vfold"]) & names)
+    
+    def testResults(self):
+        calls = [
+            ("v:double/1", range(10)), ("v:double/1", [1, 2.5, 3]), ("v:double/1", []),
+            ("v:total/2", [1, 2, 3], 0), ("v:total/2", [1, 2.0, 3], 0), ("v:total/2", [2 ** 40], 0),
+            ("v:sum/1", [1, 2, 3]), ("v:sum/1", [1, 2.5]),
+            ("v:triple/1", [1, 2]), ("v:triple/1", [1, 2.5]),
+        ]
+        vector = self.vm(True)
+        scalar = self.vm(False)
+        for call in calls:
+            self.assertEqual(vector.callVM(*call), scalar.callVM(*call))
+    
+    def testFewerInstructions(self):
+        counts = []
+        for vectorize in (True, False):
+            vm = self.vm(vectorize)
+            profiler = Profiler(vm)
+            vm.callVM("v:total/2", range(100), 0)
+            counts.append(sum([count for count, t in profiler.nameStats().itervalues()]))
+        self.assertTrue(counts[0] < 10)
+        self.assertTrue(counts[1] > 100)
+    
+    def testFallbackOnce(self):
+        # The original code recurses without trying the bulk instruction again
+        vm = self.vm(True)
+        profiler = Profiler(vm)
+        vm.callVM("v:double/1", [1.5, 2] * 10)
+        self.assertEqual(profiler.nameStats()["vmap"][0], 1)
+    
+    def testVectorInstructions(self):
+        vm = VM()
+        vm.loadVM([
+            Instruction("push", 2),
+            Instruction("vconst", array('l', [1, 2, 3])),
+            Instruction("vop", "*"),
+            Instruction("push", 0.5),
+            Instruction("nil"),
+            Instruction("cons"),
+            Instruction("vpack"),
+            Instruction("push", 1.0),
+            Instruction("vop", "+"),
+            Instruction("halt"),
+        ])
+        vm.resetVM()
+        vm.runVM()
+        self.assertEqual(toPython(vm.S[1]), [1.5])
+        self.assertEqual(toPython(vm.S[0]), [2, 4, 6])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from cStringIO import StringIO
+
+from cpl import serializer
+from cpl.compiler import parse, Tuple, PackedTuple, FlatList, PackedList
+
+def body(source):
+    """Returns the first expression of the first function in `source`."""
+    module = parse("-module(m).\nf() -> %s.\n" % (source))
+    return module.functions[0].clauses[0].body[0]
+
+class TokenTest(unittest.TestCase):
+
+    def testPackedTuple(self):
+        token = body("{1, 2, 3}")
+        self.assertTrue(isinstance(token, PackedTuple))
+        self.assertTrue(isinstance(token, Tuple))
+        self.assertEqual([e.value for e in token.elements], [1, 2, 3])
+        self.assertTrue(isinstance(body("{1, a}"), Tuple))
+    
+    def testPackedList(self):
+        token = body("[1.5, 2.5]")
+        self.assertTrue(isinstance(token, PackedList))
+        self.assertTrue(isinstance(token, FlatList))
+    
+    def testSerializer(self):
+        token = body("{[1, 2], {3, 4}, x}")
+        out = StringIO()
+        serializer.dump(token, out)
+        out.seek(0)
+        self.assertEqual(repr(serializer.load(out)), repr(token))
+
+if __name__ == "__main__":
+    unittest.main()
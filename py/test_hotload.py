@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+
+from cpl.compiler_base import Instruction
+from cpl.interpreter_base import Interpreter, Stack, InterpreterError
+
+def I(name, *args, **kwargs):
+    return Instruction(name, *args, **kwargs)
+
+class ModuleVM(Interpreter):
+    """Keeps values in `S` and return addresses as pointers in `R`."""
+    
+    memoryNames = ["S", "R"]
+    
+    def __init__(self):
+        Interpreter.__init__(self)
+        self.S = Stack()
+        self.R = Stack()
+    
+    def push(self, value):
+        self.S.append(value)
+    
+    def jmp(self, target):
+        self.PC.v = self.PS.indexOfLabel(target) if isinstance(target, str) else target
+    
+    def call(self, target, arity):
+        self.R.append(self.PC.copy())
+        self.PC.v = self.resolveVMCall(target, arity)
+    
+    callext = call
+    
+    def ret(self):
+        self.PC.v = self.R.pop()
+    
+    def purged(self):
+        raise InterpreterError("purged code")
+
+class HotLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vm = ModuleVM()
+    
+    def testAdoptBulkCode(self):
+        vm = self.vm
+        vm.loadVM([I("push", 1, label="m:main/0"), I("nop", label="m.l0"), I("push", 1), I("jmp", "m.l0"), I("halt", label="n:main/0")])
+        vm.resetVM()
+        for i in xrange(4):
+            vm.stepVM()
+        v2 = vm.loadVMModule("m", [I("push", 2, label="m:main/0"), I("nop", label="m.l0"), I("push", 2), I("jmp", "m.l0")])
+        self.assertEqual((v2.start, v2.end), (5, 9))
+        old = vm.PS.moduleVersions("m")[1]
+        self.assertEqual((old.start, old.end), (0, 4))
+        self.assertTrue(vm.PS.isOldCode(vm.PC.v))
+        # The old code keeps running in itself
+        self.assertEqual(vm.PS[3].args, (1,))
+        for i in xrange(6):
+            vm.stepVM()
+        self.assertTrue(vm.PC.v < 4)
+        self.assertEqual(set(vm.S.values()), set([1]))
+        self.assertEqual(vm.PS.indexOfLabel("m.l0"), 6)
+        
+        self.assertFalse(vm.purgeVMModule("m", soft=True))
+        vm.PC.v = 4
+        self.assertTrue(vm.purgeVMModule("m", soft=True))
+        self.assertEqual(vm.PS.purgedRanges(), [(0, 4)])
+        self.assertEqual(vm.PS.indexOfLabel("n:main/0"), 4)
+    
+    def testBulkCodeNotContiguous(self):
+        vm = self.vm
+        vm.loadVM([I("nop", label="m:f/0"), I("nop", label="n:f/0"), I("ret", label="m:g/0")])
+        self.assertRaises(ValueError, vm.loadVMModule, "m", [I("ret", label="m:f/0")])
+    
+    def testReturnIntoPurgedCode(self):
+        vm = self.vm
+        vm.loadVM([I("call", "m:f/0", 0, label="main"), I("halt")])
+        vm.loadVMModule("m", [I("push", 1, label="m:f/0"), I("callext", "n:g/0", 0), I("ret")])
+        vm.loadVMModule("n", [I("ret", label="n:g/0")])
+        vm.resetVM()
+        for i in xrange(3):
+            vm.stepVM()
+        # Inside n:g/0, called from version 1 of m
+        vm.loadVMModule("m", [I("push", 2, label="m:f/0"), I("ret")])
+        self.assertFalse(vm.purgeVMModule("m", soft=True))
+        self.assertTrue(vm.purgeVMModule("m"))
+        # Loading does not reuse slots a return address points into
+        v3 = vm.loadVMModule("n", [I("ret", label="n:g/0")])
+        self.assertEqual(vm.PS.purgedRanges(), [(2, 5)])
+        self.assertTrue(v3.start >= 5)
+        vm.stepVM()
+        self.assertRaises(InterpreterError, vm.stepVM)
+    
+    def testReclaim(self):
+        vm = self.vm
+        vm.loadVM([I("call", "m:f/0", 0, label="main"), I("halt")])
+        vm.loadVMModule("m", [I("push", 1, label="m:f/0"), I("ret")])
+        vm.loadVMModule("m", [I("push", 2, label="m:f/0"), I("ret")])
+        vm.resetVM()
+        self.assertTrue(vm.purgeVMModule("m", soft=True))
+        self.assertEqual(vm.PS.purgedRanges(), [(2, 4)])
+        self.assertEqual(vm.reclaimVMCode(), 2)
+        self.assertEqual(vm.PS.freeRanges(), [(2, 4)])
+        v3 = vm.loadVMModule("m", [I("push", 3, label="m:f/0"), I("ret")])
+        self.assertEqual(v3.start, 2)
+        self.assertTrue(vm.runVM())
+        self.assertEqual(vm.S.values(), [3])
+        vm.purgeVMModule("m")
+        # Purged code at the end is dropped once reclaimed
+        self.assertEqual(len(vm.PS), 6)
+        self.assertEqual(vm.reclaimVMCode(), 2)
+        self.assertEqual(len(vm.PS), 4)
+        self.assertEqual(vm.PS.freeRanges(), [])
+    
+    def testLabelConflict(self):
+        vm = self.vm
+        vm.loadVMModule("m", [I("ret", label="m:f/0")])
+        self.assertRaises(ValueError, vm.loadVMModule, "n", [I("ret", label="m:f/0")])
+
+if __name__ == "__main__":
+    unittest.main()
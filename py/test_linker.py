@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+
+from cpl.compiler import instrs
+from cpl.compiler_base import Instruction
+from cpl.linker import link, LinkError
+
+def fun(label, *instructions):
+    instructions = list(instructions)
+    first = instructions[0]
+    instructions[0] = Instruction(first.name, *first.args, label=label)
+    return instructions
+
+class LinkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modules = {
+            "a": fun("a:main/0", instrs.call("b:f/0", 0), instrs.jmp("a.l1"), Instruction("push", "a.l1"))
+                + fun("a.l1", instrs.ret()),
+            "b": fun("b:f/0", instrs.mkclosure("b:g/1", 1, 0), instrs.ret())
+                + fun("b:g/1", instrs.ret())
+                + fun("b:unused/0", instrs.ret()),
+        }
+    
+    def testTargets(self):
+        image = link(self.modules, ["a:main/0"])
+        self.assertEqual(image.symbols, {"a:main/0": 0, "a.l1": 3, "b:f/0": 4, "b:g/1": 6})
+        self.assertEqual(image[0].args, (4, 0))
+        self.assertEqual(image[1].args, (3,))
+        # Data operands are not touched even if they equal a label
+        self.assertEqual(image[2].args, ("a.l1",))
+        self.assertEqual(image[4].args, (6, 1, 0))
+        self.assertEqual(image.functionAt(5), "b:f/0")
+    
+    def testDefaultEntries(self):
+        image = link(self.modules)
+        self.assertTrue(image.symbols.has_key("b:unused/0"))
+    
+    def testErrors(self):
+        self.modules["c"] = fun("c:main/0", instrs.call("c:missing/0", 0), instrs.ret())
+        try:
+            link(self.modules, ["c:main/0", "x:y/0"])
+        except LinkError, e:
+            self.assertEqual(e.errors, [("c", "call to undefined function c:missing/0"), ("", "entry point x:y/0 not found")])
+        else:
+            self.fail("LinkError not raised")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import random, unittest
+from cStringIO import StringIO
+
+from cpl.compiler_base import Instruction
+from cpl.interpreter_base import Interpreter
+from cpl.profiler import Profiler, sourcePosition
+
+class LoopVM(Interpreter):
+    """Runs a loop of `nop`s `rounds` times; the clock advances by one per step."""
+    
+    def __init__(self, rounds):
+        Interpreter.__init__(self)
+        self.rounds = rounds
+        self.clock = 0
+    
+    def nop(self):
+        self.clock += 1
+    
+    def loop(self, target):
+        self.clock += 1
+        self.rounds -= 1
+        if self.rounds > 0:
+            self.PC.v = target
+
+def loopProgram(length):
+    program = [Instruction("nop", label="m:main/0")]
+    program += [Instruction("nop") for i in xrange(length - 2)]
+    return program + [Instruction("loop", 0), Instruction("halt")]
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Keep the sampled timings reproducible
+        random.seed(1)
+    
+    def profile(self, rounds, length, interval):
+        vm = LoopVM(rounds)
+        vm.loadVM(loopProgram(length))
+        vm.resetVM()
+        profiler = Profiler(vm, interval=interval, timer=lambda: vm.clock)
+        vm.runVM()
+        profiler.detach()
+        return profiler
+    
+    def testCounts(self):
+        profiler = self.profile(5, 4, 10)
+        stats = profiler.instructionStats()
+        self.assertEqual([(index, count) for index, count, t in stats], [(0, 5), (1, 5), (2, 5), (3, 5), (4, 1)])
+        self.assertEqual(profiler.nameStats()["nop"][0], 15)
+        self.assertEqual(profiler.callCounts(), {"m:main/0": 5})
+    
+    def testExactTiming(self):
+        profiler = self.profile(3, 4, 1)
+        for index, count, t in profiler.instructionStats()[:4]:
+            self.assertEqual(t, count)
+    
+    def testNoAliasing(self):
+        # A loop as long as the interval must not be sampled at one place only
+        profiler = self.profile(1000, 10, 10)
+        times = [t for index, count, t in profiler.instructionStats()[:10]]
+        self.assertTrue(all(t > 0 for t in times))
+        self.assertTrue(5000 < sum(times) < 15000)
+    
+    def testCollapsed(self):
+        profiler = self.profile(2, 3, 1)
+        out = StringIO()
+        profiler.writeCollapsed(out, counts=True)
+        self.assertEqual(out.getvalue().splitlines()[0], "m:main/0;nop@0 2")
+    
+    def testSourcePosition(self):
+        self.assertEqual(sourcePosition("ab\ncd", 4), (2, 2))
+
+if __name__ == "__main__":
+    unittest.main()
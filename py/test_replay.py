@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from cStringIO import StringIO
+
+from cpl.compiler_base import Instruction
+from cpl.interpreter_base import Interpreter, Stack
+from cpl.replay import Recorder, Replayer, ReplayError
+
+class Bad(Exception):
+    """Cannot be pickled because of its argument."""
+
+class InputVM(Interpreter):
+    """Pushes the inputs returned by the functions in `inputs`."""
+    
+    memoryNames = ["S"]
+    
+    def __init__(self, inputs):
+        Interpreter.__init__(self)
+        self.S = Stack()
+        self.inputs = inputs
+    
+    def read(self):
+        self.S.append(self.nondeterministic("input", self.nextInput))
+    
+    def nextInput(self):
+        return self.inputs.pop(0)()
+
+def newVM(inputs, reads):
+    vm = InputVM(inputs)
+    vm.loadVM([Instruction("read")] * reads + [Instruction("halt")])
+    vm.resetVM()
+    return vm
+
+def fail(exception):
+    def producer():
+        raise exception
+    return producer
+
+class ReplayTest(unittest.TestCase):
+
+    def record(self, inputs, reads):
+        log = StringIO()
+        vm = newVM(inputs, reads)
+        recorder = Recorder(vm, log)
+        try:
+            vm.runVM()
+        finally:
+            recorder.detach()
+        log.seek(0)
+        return vm, log
+    
+    def testRoundTrip(self):
+        values = [1, -300, 2.5, "abc", u"\xe4", None, True, (1, [2, "x"]), set([3])]
+        vm, log = self.record([(lambda v=v: v) for v in values], len(values))
+        self.assertEqual(vm.S.values(), values)
+        
+        replayed = newVM([], len(values))
+        replayer = Replayer(replayed, log)
+        self.assertTrue(replayed.runVM())
+        self.assertEqual(replayed.S.values(), values)
+        self.assertTrue(replayer.finished())
+    
+    def testException(self):
+        self.assertRaises(IOError, self.record, [lambda: 1, fail(IOError("gone"))], 2)
+        
+        log = StringIO()
+        vm = newVM([lambda: 1, fail(IOError("gone"))], 2)
+        Recorder(vm, log)
+        self.assertRaises(IOError, vm.runVM)
+        # The log was flushed although the run failed
+        log.seek(0)
+        replayed = newVM([], 2)
+        Replayer(replayed, log)
+        self.assertRaises(IOError, replayed.runVM)
+        self.assertEqual(replayed.S.values(), [1])
+    
+    def testUnpicklableException(self):
+        log = StringIO()
+        vm = newVM([fail(Bad(lambda: 1))], 1)
+        Recorder(vm, log)
+        # Recording must not change the exception the program sees
+        self.assertRaises(Bad, vm.runVM)
+        log.seek(0)
+        replayed = newVM([], 1)
+        Replayer(replayed, log)
+        self.assertRaises(Exception, replayed.runVM)
+    
+    def testExhausted(self):
+        vm, log = self.record([lambda: 1], 1)
+        replayed = newVM([], 2)
+        Replayer(replayed, log)
+        self.assertRaises(ReplayError, replayed.runVM)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+
+from cpl.compiler import compile
+from cpl.compiler_base import Instruction
+from cpl.interpreter import VM
+from cpl.interpreter_base import Interpreter, Stack, InterpreterBreakpoint, InterpreterHalt
+from cpl.reverse import ReverseRecorder
+
+class StackVM(Interpreter):
+    """Pushes constants and adds the two topmost values."""
+    
+    memoryNames = ["S"]
+    
+    def __init__(self):
+        Interpreter.__init__(self)
+        self.S = Stack()
+    
+    def push(value):
+        S.append(value)
+    
+    def add():
+        b = S.pop()
+        S.append(S.pop() + b)
+
+def program(pushes):
+    instructions = [Instruction("push", 0)]
+    for i in xrange(1, pushes + 1):
+        instructions.extend([Instruction("push", i), Instruction("push", i), Instruction("add")])
+    return instructions + [Instruction("halt")]
+
+def state(vm):
+    return tuple([getattr(vm, name).v for name in vm.registerNames] +
+                 [tuple(getattr(vm, name).values()) for name in vm.memoryNames])
+
+class ReverseRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vm = StackVM()
+        self.vm.loadVM(program(20))
+        self.vm.resetVM()
+    
+    def record(self, recorder, steps):
+        states = [state(self.vm)]
+        for i in xrange(steps):
+            recorder.step()
+            states.append(state(self.vm))
+        return states
+    
+    def testStepBack(self):
+        recorder = ReverseRecorder(self.vm)
+        states = self.record(recorder, 30)
+        self.assertEqual(recorder.steps, 30)
+        for position in xrange(29, -1, -1):
+            self.assertEqual(recorder.stepBack(), 1)
+            self.assertEqual(state(self.vm), states[position])
+        self.assertEqual(recorder.stepBack(), 0)
+        # Running again after stepping back gives the same states
+        self.assertEqual(self.record(recorder, 30), states)
+        self.assertEqual(recorder.stepBack(12), 12)
+        self.assertEqual(state(self.vm), states[18])
+    
+    def testSegments(self):
+        recorder = ReverseRecorder(self.vm, segmentSize=8, segments=3)
+        states = self.record(recorder, 40)
+        stats = recorder.stats()
+        self.assertEqual(stats["segments"], 3)
+        self.assertTrue(recorder.steps < 40)
+        steps = recorder.steps
+        self.assertEqual(recorder.stepBack(100), steps)
+        self.assertEqual(recorder.steps, 0)
+        self.assertEqual(state(self.vm), states[40 - steps])
+    
+    def testBreakpointNotRecorded(self):
+        recorder = ReverseRecorder(self.vm)
+        self.vm.setVMBreakpoint(3)
+        states = self.record(recorder, 3)
+        self.assertRaises(InterpreterBreakpoint, recorder.step)
+        self.assertEqual(recorder.steps, 3)
+        self.assertEqual(state(self.vm), states[3])
+        recorder.step()
+        self.assertEqual(recorder.stepBack(), 1)
+        self.assertEqual(state(self.vm), states[3])
+    
+    def testClearDetach(self):
+        recorder = ReverseRecorder(self.vm)
+        recorder.run(5)
+        recorder.clear()
+        self.assertEqual(recorder.stepBack(), 0)
+        recorder.detach()
+        self.vm.stepVM()
+        self.assertEqual(recorder.stats()["records"], 0)
+    
+    def testCompiledProgram(self):
+        vm = VM()
+        vm.loadVM(compile("""
+-module(m).
+range(0) -> [];
+range(N) -> [N | range(N - 1)].
+len([]) -> 0;
+len([_|T]) -> 1 + len(T).
+run(N) -> {len(range(N)), range(2)}.
+""", {"namespace": "m"}))
+        vm.resetVM()
+        vm.enterVM("m:run/1", (5,))
+        start = state(vm)
+        recorder = ReverseRecorder(vm)
+        states = [start]
+        try:
+            while True:
+                recorder.step()
+                states.append(state(vm))
+        except InterpreterHalt:
+            pass
+        self.assertTrue(len(states) > 20)
+        # The halt instruction was recorded as well
+        self.assertEqual(recorder.steps, len(states))
+        for position in xrange(len(states) - 1, -1, -7):
+            recorder.stepBack(recorder.steps - position)
+            self.assertEqual(state(vm), states[position])
+        recorder.stepBack(recorder.steps)
+        self.assertEqual(state(vm), start)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from cStringIO import StringIO
+
+from cpl.compiler_base import Instruction
+from cpl.interpreter_base import Interpreter, Stack
+from cpl.replay import Recorder, Replayer
+from cpl.runner import VMRunner, CallbackLoop
+
+class WaitingVM(Interpreter):
+    """Counts in `tick` and pushes the result of `pending` in `get`."""
+    
+    memoryNames = ["S"]
+    
+    def __init__(self):
+        Interpreter.__init__(self)
+        self.S = Stack()
+        self.ticks = 0
+        self.pending = None
+    
+    def tick(self):
+        self.ticks += 1
+    
+    def get(self):
+        self.S.append(self.waitVM(self.pending))
+
+def program(ticks):
+    return [Instruction("tick")] * ticks + [Instruction("get"), Instruction("tick"), Instruction("halt")]
+
+class VMRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = CallbackLoop()
+        self.vm = WaitingVM()
+        self.vm.pending = self.loop.create_future()
+        self.vm.loadVM(program(10))
+        self.vm.resetVM()
+    
+    def testSlices(self):
+        self.vm.pending.set_result(1)
+        runner = VMRunner(self.vm, budget=4, loop=self.loop)
+        future = runner.start()
+        self.loop.runOnce()
+        self.assertEqual(self.vm.ticks, 4)
+        self.assertFalse(future.done())
+        self.loop.run()
+        self.assertTrue(future.result())
+        self.assertEqual(runner.slices, 4)
+    
+    def testPauseResume(self):
+        self.vm.pending.set_result(1)
+        runner = VMRunner(self.vm, budget=4, loop=self.loop)
+        future = runner.start()
+        self.loop.runOnce()
+        runner.pause()
+        self.loop.run()
+        self.assertEqual(self.vm.ticks, 4)
+        self.assertFalse(future.done())
+        runner.resume()
+        self.loop.run()
+        self.assertTrue(future.result())
+        self.assertEqual(self.vm.ticks, 11)
+    
+    def testWait(self):
+        runner = VMRunner(self.vm, budget=4, loop=self.loop)
+        future = runner.start()
+        self.loop.run()
+        self.assertIs(runner.waitingFor, self.vm.pending)
+        self.assertEqual(self.vm.PC.v, 10)
+        self.assertEqual(self.vm.ticks, 10)
+        slices = runner.slices
+        # Nothing is scheduled while waiting
+        self.assertEqual(self.loop.runOnce(), 0)
+        self.vm.pending.set_result("asset")
+        self.loop.run()
+        self.assertTrue(future.result())
+        self.assertEqual(self.vm.S.values(), ["asset"])
+        self.assertEqual(runner.slices, slices + 1)
+    
+    def testWaitPausedResume(self):
+        runner = VMRunner(self.vm, budget=4, loop=self.loop)
+        future = runner.start()
+        self.loop.run()
+        runner.pause()
+        self.vm.pending.set_result(2)
+        self.loop.run()
+        self.assertFalse(future.done())
+        runner.resume()
+        self.loop.run()
+        self.assertTrue(future.result())
+        self.assertEqual(self.vm.S.values(), [2])
+    
+    def testBreakpointOnWait(self):
+        self.vm.setVMBreakpoint(10)
+        runner = VMRunner(self.vm, budget=4, loop=self.loop)
+        future = runner.start()
+        self.loop.run()
+        self.assertEqual(future.result(), False)
+        future = runner.start()
+        self.loop.run()
+        self.assertIs(runner.waitingFor, self.vm.pending)
+        self.vm.pending.set_result(3)
+        self.loop.run()
+        self.assertTrue(future.result())
+        self.assertEqual(self.vm.S.values(), [3])
+    
+    def testError(self):
+        self.vm.pending.set_exception(IOError("missing"))
+        runner = VMRunner(self.vm, budget=4, loop=self.loop)
+        future = runner.start()
+        self.loop.run()
+        self.assertRaises(IOError, future.result)
+    
+    def testCancel(self):
+        runner = VMRunner(self.vm, budget=4, loop=self.loop)
+        future = runner.start()
+        self.loop.run()
+        runner.cancel()
+        self.vm.pending.set_result(4)
+        self.loop.run()
+        self.assertTrue(future.cancelled())
+        self.assertEqual(self.vm.S.values(), [])
+    
+    def testReplayDoesNotWait(self):
+        log = StringIO()
+        recorder = Recorder(self.vm, log)
+        runner = VMRunner(self.vm, budget=4, loop=self.loop)
+        runner.start()
+        self.loop.run()
+        self.vm.pending.set_result("command")
+        self.loop.run()
+        recorder.detach()
+        
+        vm = WaitingVM()
+        vm.pending = self.loop.create_future()
+        vm.loadVM(program(10))
+        vm.resetVM()
+        log.seek(0)
+        Replayer(vm, log)
+        self.assertTrue(vm.runVM())
+        self.assertEqual(vm.S.values(), ["command"])
+
+if __name__ == "__main__":
+    unittest.main()
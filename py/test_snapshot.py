@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+#
+#  Copyright (C) 2011  Patrick "p2k" Schneider <patrick.p2k.schneider@gmail.com>
+#
+#  This file is part of :cpl.
+#
+#  :cpl is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  :cpl is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with :cpl.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+from cStringIO import StringIO
+
+from cpl.compiler_base import Instruction
+from cpl.interpreter_base import Interpreter, Stack, InterpreterBreakpoint
+from cpl.snapshot import Timeline
+
+class StackVM(Interpreter):
+    """Pushes constants and adds the two topmost values."""
+    
+    memoryNames = ["S"]
+    
+    def __init__(self):
+        Interpreter.__init__(self)
+        self.S = Stack()
+    
+    def push(value):
+        S.append(value)
+    
+    def add():
+        b = S.pop()
+        S.append(S.pop() + b)
+
+def program(pushes):
+    instructions = [Instruction("push", 0)]
+    for i in xrange(1, pushes + 1):
+        instructions.extend([Instruction("push", i), Instruction("push", i), Instruction("add")])
+    return instructions + [Instruction("halt")]
+
+def newVM(pushes=20):
+    vm = StackVM()
+    vm.loadVM(program(pushes))
+    vm.resetVM()
+    return vm
+
+def state(vm):
+    return (vm.PC.v, vm.S.values())
+
+class TimelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vm = newVM()
+    
+    def record(self, timeline, steps):
+        states = [state(timeline.interpreter)]
+        for i in xrange(steps):
+            timeline.step()
+            states.append(state(timeline.interpreter))
+        return states
+    
+    def testSeek(self):
+        timeline = Timeline(self.vm, interval=4)
+        states = self.record(timeline, 40)
+        self.assertEqual([s.position for s in timeline.checkpoints], range(0, 40, 4))
+        for position in [13, 2, 40, 0, 39, 17, 18, 5]:
+            timeline.seek(position)
+            self.assertEqual(timeline.position, position)
+            self.assertEqual(state(self.vm), states[position])
+        # Running on after seeking gives the same states again
+        timeline.seek(10)
+        self.assertEqual(self.record(timeline, 5)[1:], states[11:16])
+    
+    def testSeekWithoutCheckpoint(self):
+        timeline = Timeline(self.vm, interval=4)
+        self.assertRaises(ValueError, timeline.seek, 3)
+        timeline.run(3)
+        timeline.discardAfter(-1)
+        self.assertRaises(ValueError, timeline.seek, 0)
+    
+    def testSharedChunks(self):
+        timeline = Timeline(self.vm, interval=1000, chunkSize=2)
+        timeline.run(12)
+        first = timeline.snapshot()
+        timeline.run(3)
+        second = timeline.snapshot()
+        # Only the topmost values changed, the chunks below are shared
+        chunks = len(first.memories["S"])
+        self.assertTrue(chunks > 2)
+        for i in xrange(chunks - 1):
+            self.assertIs(first.memories["S"][i], second.memories["S"][i])
+        self.assertIsNot(first.memories["S"][-1], second.memories["S"][-1])
+    
+    def testBreakpointsIgnoredWhileSeeking(self):
+        timeline = Timeline(self.vm, interval=4)
+        states = self.record(timeline, 20)
+        self.vm.setVMBreakpoint(10)
+        timeline.seek(0)
+        timeline.seek(20)
+        self.assertEqual(state(self.vm), states[20])
+    
+    def testSaveLoad(self):
+        timeline = Timeline(self.vm, interval=4)
+        states = self.record(timeline, 30)
+        f = StringIO()
+        timeline.save(f)
+        
+        vm = newVM()
+        loaded = Timeline(vm, interval=4)
+        f.seek(0)
+        loaded.load(f)
+        self.assertEqual(len(loaded.checkpoints), len(timeline.checkpoints))
+        for position in [30, 7, 0, 21]:
+            loaded.seek(position)
+            self.assertEqual(state(vm), states[position])
+
+if __name__ == "__main__":
+    unittest.main()